@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, g, has_request_context, request, jsonify, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import os
@@ -6,15 +6,65 @@ from pathlib import Path
 from zoneinfo import ZoneInfo
 from hmac import compare_digest
 import logging
-from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from datetime import date, datetime, timedelta, timezone, time as dt_time
 from dateutil import parser
 from io import BytesIO
+import numpy as np
 import openpyxl
 from openpyxl.styles import Font, PatternFill
 import re
-from random import choice
-from flask import request
+import csv
+import io
+import json
+import hashlib
+import tempfile
+import time
+import unicodedata
+import multiprocessing
+import cProfile
+import pstats
+import random
+import sys
+import uuid
+import threading
+import sqlite3
+import click
+import fcntl
+from contextlib import contextmanager
+import queue
+import atexit
+import zipfile
+import struct
+from xml.etree import ElementTree
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import defaultdict
+from random import Random, choice, choices
+from sqlalchemy import create_engine, event, func, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, validates
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.schema import AddConstraint
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+import gzip
 from dotenv import load_dotenv
+
+try:
+    import orjson
+except ImportError:  # optional: jsonify falls back to the stdlib encoder
+    orjson = None
+try:
+    import brotli
+except ImportError:  # optional: responses are gzip-compressed only
+    brotli = None
+try:
+    import redis
+except ImportError:  # optional: CACHE_BACKEND=redis falls back to the SQLite cache
+    redis = None
 if os.getenv("FLASK_ENV", "production") != "production":
     load_dotenv()
 
@@ -22,6 +72,30 @@ load_dotenv()
 
 app = Flask(__name__)
 
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    jsonify() through orjson when it is installed. Types orjson doesn't know
+    (and datetimes, to keep Flask's format) go through Flask's default hook.
+    Debug mode keeps the stdlib encoder for its pretty-printing.
+    """
+    orjson_options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.orjson_options).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self._app.debug:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.orjson_options)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+app.json = FastJSONProvider(app)
+
 ALLOWED_ORIGINS = [
     o.strip() for o in os.getenv("FRONTEND_ORIGINS", "").split(",") if o.strip()
 ] or ["*"]  
@@ -31,7 +105,7 @@ CORS(
     resources={r"/*": {"origins": ALLOWED_ORIGINS if "*" not in ALLOWED_ORIGINS else "*"}},
     supports_credentials=False,
     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    allow_headers=["Content-Type", "Authorization"],
+    allow_headers=["Content-Type", "Authorization", "X-Site-ID"],
 )
 
 
@@ -41,253 +115,2737 @@ def add_cors_headers(resp):
     allow_all = "*" in ALLOWED_ORIGINS
     if origin and (allow_all or origin in ALLOWED_ORIGINS):
         resp.headers["Access-Control-Allow-Origin"] = origin
-        resp.headers["Vary"] = "Origin"
-        resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+        resp.vary.add("Origin")
+        resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, X-Site-ID"
         resp.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
         resp.headers["Access-Control-Max-Age"] = "86400"
     return resp
 
-# database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URI")
+# response compression for larger text payloads (worker lists, exports)
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))  # gzip 1-9
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))  # 0-11; higher is much slower
+COMPRESS_MIMETYPES = {"application/json", "application/x-ndjson", "text/csv", "text/plain"}
+
+
+@app.after_request
+def compress_response(resp):
+    """Brotli or gzip, whichever the client accepts (brotli preferred)."""
+    if (
+        resp.direct_passthrough  # send_file
+        or resp.is_streamed
+        or resp.status_code < 200
+        or resp.status_code in (204, 304)
+        or resp.mimetype not in COMPRESS_MIMETYPES
+        or "Content-Encoding" in resp.headers
+    ):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    data = resp.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return resp
+    if brotli is not None and request.accept_encodings["br"]:
+        resp.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        resp.headers["Content-Encoding"] = "br"
+    elif request.accept_encodings["gzip"]:
+        resp.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+        resp.headers["Content-Encoding"] = "gzip"
+    return resp
+
+
+# opt-in request profiling. A request is profiled when it carries
+# X-Profile-Token matching PROFILE_TOKEN, or when sampled at PROFILE_SAMPLE_RATE.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # 0..1
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "profiles"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # stack sampling period, seconds
+
+
+def profile_token_ok():
+    token = request.headers.get("X-Profile-Token", "")
+    return bool(PROFILE_TOKEN) and compare_digest(token, PROFILE_TOKEN)
+
+
+class StackSampler:
+    """Samples one thread's Python stack every `interval` seconds into collapsed-stack counts."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        """Brendan Gregg's collapsed format, ready for flamegraph.pl or speedscope."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+@app.before_request
+def start_profiling():
+    g.request_id = re.sub(r"[^A-Za-z0-9_-]", "", request.headers.get("X-Request-ID", ""))[:64] or uuid.uuid4().hex
+    g.profiler = None
+    if request.method == "OPTIONS" or request.path.startswith("/admin/profiles"):
+        return
+    if profile_token_ok() or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        g.profile_started = time.perf_counter()
+        g.sampler = StackSampler(threading.get_ident())
+        g.sampler.start()
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def finish_profiling(status):
+    """Stop this request's profiler and write <id>.pstats, <id>.folded and <id>.json."""
+    profiler, g.profiler = g.get("profiler"), None
+    if profiler is None:
+        return
+    profiler.disable()
+    g.sampler.stop()
+    try:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        base = PROFILE_DIR / g.request_id
+        profiler.dump_stats(f"{base}.pstats")
+        Path(f"{base}.folded").write_text(g.sampler.folded())
+        Path(f"{base}.json").write_text(json.dumps({
+            "id": g.request_id,
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "status": status,
+            "elapsed_ms": round((time.perf_counter() - g.profile_started) * 1000, 1),
+            "samples": sum(g.sampler.counts.values()),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }))
+        # keep the newest PROFILE_KEEP profiles
+        for old in sorted(PROFILE_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime)[:-PROFILE_KEEP or None]:
+            for suffix in (".json", ".pstats", ".folded"):
+                old.with_suffix(suffix).unlink(missing_ok=True)
+    except OSError as e:
+        logging.warning("Could not write profile %s: %s", g.request_id, e)
+
+
+@app.after_request
+def stop_profiling(resp):
+    resp.headers["X-Request-ID"] = g.get("request_id", "")
+    if g.get("profiler") is not None:
+        finish_profiling(resp.status_code)
+        resp.headers["X-Profile-Id"] = g.request_id
+    return resp
+
+
+@app.teardown_request
+def abandon_profiling(exc):
+    # after_request is skipped when a view raises; still stop the sampler thread
+    if g.get("profiler") is not None:
+        finish_profiling(500)
+
+
+# database: DATABASE_URI for a networked Postgres/MySQL server (or a
+# sqlite:/// file). Single-site installs opt in to the embedded SQLite file
+# with EMBEDDED_DB=1 (at SQLITE_PATH); with neither set the app refuses to
+# start, so a deploy that lost its DATABASE_URI can't write to a stray file.
+EMBEDDED_DB = os.getenv("EMBEDDED_DB", "0") == "1"
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH", "dayplanner.db")).resolve()
+DATABASE_URI = os.getenv("DATABASE_URI") or (f"sqlite:///{SQLITE_PATH}" if EMBEDDED_DB else None)
+if not DATABASE_URI:
+    raise RuntimeError("DATABASE_URI is not set (set EMBEDDED_DB=1 to run on a local SQLite file)")
+# short id of this deployment's database; namespaces state shared host-wide (cache keys, admission slots)
+DATABASE_KEY = hashlib.sha256(DATABASE_URI.encode()).hexdigest()[:12]
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # readers never block the writer (or each other)
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),  # WAL + NORMAL: durable at checkpoints
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),  # bytes
+    "cache_size": -int(os.getenv("SQLITE_CACHE_KB", "65536")),  # negative = KiB
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),  # wait for a writer instead of failing
+    "foreign_keys": "ON",  # role counters cascade with their worker
+    "temp_store": "MEMORY",
+}
+
+app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune every new SQLite connection (embedded mode and copy-db targets)."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
 # Keep the connection pool healthy on hosts that close idle conns
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,    # tests connections before using
     "pool_recycle": 300,      # recycle connections every 5 mins
 }
 
-# logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
+# logging: structured JSON by default, written by a background thread so
+# request threads only enqueue records. Per-row events go through row_log
+# and are sampled at LOG_ROW_SAMPLE_RATE.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO" if os.getenv("FLASK_ENV", "production") == "production" else "DEBUG").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_ROW_SAMPLE_RATE = float(os.getenv("LOG_ROW_SAMPLE_RATE", "0.01"))  # 0..1
+LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; `extra=` fields become top-level keys."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_FIELDS and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RequestContextFilter(logging.Filter):
+    """Tags records with the current request id and counts warnings per request."""
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get("request_id")
+            if record.levelno >= logging.WARNING and record.name != "dayplanner.request":
+                g.log_warnings = g.get("log_warnings", 0) + 1
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Lets through roughly `rate` of records; warnings and above always pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class Lazy:
+    """Defers an expensive log argument until a handler actually formats it."""
+    __slots__ = ("fn",)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __str__(self):
+        return str(self.fn())
+
+
+row_log = logging.getLogger("dayplanner.rows")
+request_log = logging.getLogger("dayplanner.request")
+plan_log = logging.getLogger("dayplanner.planner")
+# quiet DayPlanners (the absence simulator's thousands of runs) log here, and it drops everything
+quiet_plan_log = logging.getLogger("dayplanner.planner.quiet")
+quiet_plan_log.setLevel(logging.CRITICAL + 1)
+_log_listener = None
+
+
+def log_stream_handler():
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    return handler
+
+
+def configure_logging():
+    """Root logger -> QueueHandler; a QueueListener thread does the formatting and I/O."""
+    global _log_listener
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    root.addHandler(queue_handler)
+    row_log.addFilter(SampleFilter(LOG_ROW_SAMPLE_RATE))
+    _log_listener = QueueListener(log_queue, log_stream_handler(), respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+
+def reset_child_logging():
+    """Pool initializer: a forked child has no listener thread, so log directly."""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(log_stream_handler())
+
+
+configure_logging()
+
+
+@app.before_request
+def start_request_log():
+    g.request_started = time.perf_counter()
+    g.log_summary = {}
+
+
+def log_summary(**fields):
+    """Adds fields to this request's summary event."""
+    if has_request_context():
+        g.setdefault("log_summary", {}).update(fields)
+
+
+@app.after_request
+def emit_request_log(resp):
+    # one event per request in place of per-step info lines
+    if request.method != "OPTIONS" and "request_started" in g:
+        request_log.info(
+            "%s %s %s", request.method, request.path, resp.status_code,
+            extra={
+                "method": request.method,
+                "path": request.path,
+                "status": resp.status_code,
+                "duration_ms": round((time.perf_counter() - g.request_started) * 1000, 1),
+                "warnings": g.get("log_warnings", 0),
+                **g.get("log_summary", {}),
+            },
+        )
+    return resp
+
+
+# admission control. Heavy endpoints take a slot before running; slots are
+# flock()ed files under ADMISSION_DIR, so the limits hold across gunicorn
+# workers (and threads) on one host. ADMISSION_CAPACITY is the number of
+# requests the host serves at once: gunicorn.conf.py's WEB_CONCURRENCY x
+# GUNICORN_THREADS unless set. Running heavy requests never take more than it
+# minus the shares kept for light reads and change streams; a request waiting
+# in its endpoint's queue holds no heavy slot.
+# Change streams are long-lived but idle, so they only take a stream slot
+# (never a heavy one) and are refused at once rather than queued.
+ADMISSION_CAPACITY = int(os.getenv(
+    "ADMISSION_CAPACITY",
+    str(int(os.getenv("WEB_CONCURRENCY", "1")) * int(os.getenv("GUNICORN_THREADS", "8"))),
+))
+ADMISSION_LIGHT_RESERVE = float(os.getenv("ADMISSION_LIGHT_RESERVE", "0.25"))  # share kept for light requests
+ADMISSION_STREAM_SHARE = float(os.getenv("ADMISSION_STREAM_SHARE", "0.25"))  # share open change streams may hold
+ADMISSION_STREAMS = {"stream_worker_changes"}
+ADMISSION_LIMITS = {  # endpoint -> concurrent requests
+    "generate_schedule": 2,
+    "upload_worker_availability": 1,
+    "upload_excel": 1,
+    "simulate": 1,
+    "coverage": 2,
+    "export_workers": 1,
+    "stream_worker_changes": max(1, int(ADMISSION_CAPACITY * ADMISSION_STREAM_SHARE)),
+}
+ADMISSION_LIMITS.update(  # e.g. ADMISSION_LIMITS="generate_schedule=3,simulate=0" (0 = unlimited)
+    (name.strip(), int(limit))
+    for name, _, limit in (item.partition("=") for item in os.getenv("ADMISSION_LIMITS", "").split(","))
+    if limit
+)
+ADMISSION_HEAVY_SLOTS = max(1, int(ADMISSION_CAPACITY * (1 - ADMISSION_LIGHT_RESERVE - ADMISSION_STREAM_SHARE)))
+ADMISSION_QUEUE_DEPTH = int(os.getenv("ADMISSION_QUEUE_DEPTH", "2"))  # waiters per endpoint
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))  # seconds
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))  # seconds
+ADMISSION_POLL_SECONDS = 0.05
+# per database by default, so two deployments on one host don't share slots
+ADMISSION_DIR = Path(os.getenv("ADMISSION_DIR", Path(tempfile.gettempdir()) / f"dayplanner-admission-{DATABASE_KEY}"))
+ADMISSION_DIR.mkdir(parents=True, exist_ok=True)
+admission_rejections = Counter()  # (endpoint, reason) -> count, this process only
+
+
+def acquire_slot(pool, size):
+    """Lock a free slot file of `pool` without blocking; returns the open file or None."""
+    for i in range(size):
+        slot = open(ADMISSION_DIR / f"{pool}.{i}", "a")
+        try:
+            fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot
+        except BlockingIOError:
+            slot.close()
+    return None
+
+
+def slots_in_use(pool, size):
+    """How many of `pool`'s slots are held right now, by any process."""
+    in_use = 0
+    for i in range(size):
+        with open(ADMISSION_DIR / f"{pool}.{i}", "a") as slot:
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                in_use += 1
+    return in_use
+
+
+def reject_request(endpoint, reason, status):
+    admission_rejections[(endpoint, reason)] += 1
+    log_summary(rejected=reason)
+    resp = jsonify({"error": "The server is busy, please retry shortly", "reason": reason})
+    resp.status_code = status
+    resp.headers["Retry-After"] = str(ADMISSION_RETRY_AFTER)
+    return resp
+
+
+@app.before_request
+def admit_request():
+    """
+    Heavy endpoints: take an endpoint slot, waiting up to ADMISSION_QUEUE_TIMEOUT
+    in a queue of ADMISSION_QUEUE_DEPTH (429 when that queue is full), then a
+    heavy slot just before running (503 when heavy work already fills its
+    share of capacity). Streams: 503 when every stream slot is taken.
+    """
+    g.admission = []
+    limit = ADMISSION_LIMITS.get(request.endpoint)
+    if not limit or request.method == "OPTIONS":
+        return
+    endpoint = request.endpoint
+
+    if endpoint in ADMISSION_STREAMS:
+        slot = acquire_slot(endpoint, limit)
+        if slot is None:
+            return reject_request(endpoint, "streams_full", 503)
+        g.admission.append(slot)
+        return
+
+    slot = acquire_slot(endpoint, limit)
+    if slot is None:
+        ticket = acquire_slot(f"{endpoint}.queue", ADMISSION_QUEUE_DEPTH)
+        if ticket is None:
+            return reject_request(endpoint, "queue_full", 429)
+        queued = time.monotonic()
+        try:
+            while slot is None and time.monotonic() - queued < ADMISSION_QUEUE_TIMEOUT:
+                time.sleep(ADMISSION_POLL_SECONDS)
+                slot = acquire_slot(endpoint, limit)
+        finally:
+            ticket.close()
+        log_summary(queued_ms=round((time.monotonic() - queued) * 1000, 1))
+        if slot is None:
+            return reject_request(endpoint, "queue_timeout", 503)
+    g.admission.append(slot)
+
+    heavy = acquire_slot("heavy", ADMISSION_HEAVY_SLOTS)
+    if heavy is None:
+        return reject_request(endpoint, "capacity", 503)
+    g.admission.append(heavy)
+
+
+@app.teardown_request
+def release_admission(exc):
+    # closing the file drops its lock; streamed responses get here once the stream ends
+    for slot in g.pop("admission", ()):
+        slot.close()
 
 db = SQLAlchemy(app)
 
+
+# shared cache for read-heavy JSON responses. sqlite (the default) is a file
+# every worker process on the host shares; redis (REDIS_URL, needs the redis
+# package) is shared across hosts; memory is per process, so only right for a
+# single worker process. Entries expire after CACHE_TTL and the memory and
+# sqlite caches evict least-recently-used entries beyond CACHE_MAX_BYTES.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))  # seconds
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_PATH = Path(os.getenv("CACHE_PATH", Path(tempfile.gettempdir()) / "dayplanner-cache.db"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# keys are prefixed per database, so deployments sharing a cache file or server don't mix
+CACHE_NAMESPACE = os.getenv("CACHE_NAMESPACE") or DATABASE_KEY
+
+
+class Cache:
+    """
+    Byte values under string keys, plus a generation counter per (namespace,
+    site). Cached keys embed the generations they were built at, so bumping
+    one (invalidate) makes every older entry unreachable in every process at
+    once. A generation starts at time_ns(), so one that was lost restarts
+    above any value it had. Backend errors count as misses, never as failures.
+    """
+    name = None
+
+    def __init__(self):
+        self.stats = defaultdict(Counter)  # kind -> hits/misses/errors, for this process
+        self.invalidations = Counter()  # namespace -> generation bumps sent by this process
+
+    def get(self, key, kind):
+        try:
+            value = self._get(f"{CACHE_NAMESPACE}:{key}")
+        except Exception as e:
+            self.stats[kind]["errors"] += 1
+            logging.warning("Cache read failed (%s): %s", self.name, e)
+            return None
+        self.stats[kind]["hits" if value is not None else "misses"] += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        try:
+            self._set(f"{CACHE_NAMESPACE}:{key}", value, ttl or CACHE_TTL)
+        except Exception as e:
+            logging.warning("Cache write failed (%s): %s", self.name, e)
+
+    def generation(self, namespace, site):
+        return self._generation(f"{CACHE_NAMESPACE}:gen:{namespace}:{site}")
+
+    def invalidate(self, namespace, site):
+        try:
+            self._bump(f"{CACHE_NAMESPACE}:gen:{namespace}:{site}")
+            self.invalidations[namespace] += 1
+        except Exception as e:
+            logging.error("Cache invalidation failed (%s) for %s/%s: %s", self.name, namespace, site, e)
+
+    def describe(self):
+        return {}
+
+
+class MemoryCache(Cache):
+    """LRU in this process: an OrderedDict under a lock, bounded by value bytes."""
+    name = "memory"
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, value), least recently used first
+        self._bytes = 0
+        self._generations = {}
+        self.evictions = 0
+
+    def _drop(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _generation(self, name):
+        with self._lock:
+            return self._generations.setdefault(name, time.time_ns())
+
+    def _bump(self, name):
+        with self._lock:
+            self._generations[name] = self._generations.get(name, time.time_ns()) + 1
+
+    def describe(self):
+        return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+
+class SQLiteCache(Cache):
+    """
+    Cache in a local SQLite file (WAL), shared by every process on the host.
+    One autocommit connection per thread (and per process, after a fork).
+    Recency is only rewritten once a second per entry, so hits stay reads.
+    """
+    name = "sqlite"
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        super().__init__()
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entry ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_entry_used ON entry (used)")
+        conn.execute("CREATE TABLE IF NOT EXISTS generation (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _get(self, key):
+        conn = self._connect()
+        row = conn.execute("SELECT value, expires, used FROM entry WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or row[1] < now:
+            return None
+        if now - row[2] > 1:
+            conn.execute("UPDATE entry SET used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def _set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO entry (key, value, size, expires, used) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now + ttl, now),
+        )
+        excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entry").fetchone()[0] - self.max_bytes
+        if excess > 0:
+            # expired entries first, then least recently used, until back under the bound
+            victims = []
+            for victim, size in conn.execute(
+                "SELECT key, size FROM entry WHERE key != ? ORDER BY expires >= ?, used", (key, now)
+            ):
+                victims.append((victim,))
+                excess -= size
+                if excess <= 0:
+                    break
+            conn.executemany("DELETE FROM entry WHERE key = ?", victims)
+
+    def _generation(self, name):
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM generation WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            conn.execute("INSERT OR IGNORE INTO generation (name, value) VALUES (?, ?)", (name, time.time_ns()))
+            row = conn.execute("SELECT value FROM generation WHERE name = ?", (name,)).fetchone()
+        return row[0]
+
+    def _bump(self, name):
+        self._connect().execute(
+            "INSERT INTO generation (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            (name, time.time_ns()),
+        )
+
+    def describe(self):
+        entries, size = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entry").fetchone()
+        return {"path": self.path, "entries": entries, "bytes": size, "max_bytes": self.max_bytes}
+
+
+class RedisCache(Cache):
+    """
+    Cache in Redis, shared across hosts. Entries carry CACHE_TTL; size and LRU
+    eviction are the server's (maxmemory with a volatile-* policy keeps the
+    generation counters, which have no TTL).
+    """
+    name = "redis"
+    prefix = "dayplanner:"
+
+    def __init__(self, url=REDIS_URL):
+        super().__init__()
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    def _get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def _set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def _generation(self, name):
+        value = self.client.get(self.prefix + name)
+        if value is None:
+            self.client.set(self.prefix + name, time.time_ns(), nx=True)
+            value = self.client.get(self.prefix + name)
+        return int(value)
+
+    def _bump(self, name):
+        if not self.client.set(self.prefix + name, time.time_ns(), nx=True):
+            self.client.incr(self.prefix + name)
+
+    def describe(self):
+        return {"url": REDIS_URL.rpartition("@")[2]}
+
+
+def make_cache(backend=CACHE_BACKEND):
+    if backend == "redis":
+        if redis is not None:
+            return RedisCache()
+        logging.warning("CACHE_BACKEND=redis but the redis package is not installed; using the SQLite cache")
+        backend = "sqlite"
+    if backend == "sqlite":
+        try:
+            return SQLiteCache()
+        except sqlite3.Error as e:
+            logging.warning("Could not open the cache at %s (%s); using an in-process cache", CACHE_PATH, e)
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        logging.warning("Response cache is per process: invalidations in one worker won't reach the others until CACHE_TTL")
+    return MemoryCache()
+
+
+response_cache = make_cache()
+
+
+def invalidate_after_commit(namespace, site):
+    """Queue a cache invalidation, broadcast once the current transaction commits (dropped on rollback)."""
+    db.session.info.setdefault("cache_invalidations", set()).add((namespace, site))
+
+
+@event.listens_for(Session, "after_commit")
+def broadcast_invalidations(session):
+    # after the commit, so a reader can't rebuild an entry from the old rows under the new generation
+    for namespace, site in session.info.pop("cache_invalidations", ()):
+        response_cache.invalidate(namespace, site)
+
+
+@event.listens_for(Session, "after_rollback")
+def drop_invalidations(session):
+    session.info.pop("cache_invalidations", None)
+
+
+def cached_json(namespaces, key, build):
+    """
+    JSON response for `key` (scoped to the request's site) from the cache, or
+    build() -> dict serialized and stored. Generations are read before
+    building, so a write that commits mid-build leaves the result unreachable
+    rather than stale.
+    """
+    site = g.site_id
+    kind = request.endpoint
+    try:
+        generations = ".".join(str(response_cache.generation(ns, site)) for ns in namespaces)
+    except Exception as e:
+        logging.warning("Cache unavailable (%s): %s", response_cache.name, e)
+        response_cache.stats[kind]["errors"] += 1
+        return jsonify(build())
+    cache_key = f"{kind}:{site}:{generations}:{key}"
+    body = response_cache.get(cache_key, kind)
+    log_summary(cache="hit" if body is not None else "miss")
+    if body is None:
+        body = app.json.dumps(build()).encode()
+        response_cache.set(cache_key, body)
+    return app.response_class(body, mimetype="application/json")
+
 # storage
 UPLOAD_FOLDER = Path('uploaded_templates')
 UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
+# content-addressed template blobs: objects/<sha256>.xlsx
+TEMPLATE_STORE = UPLOAD_FOLDER / 'objects'
+TEMPLATE_STORE.mkdir(parents=True, exist_ok=True)
 
 # app constants
 TIMEZONE = ZoneInfo("Europe/Dublin")
+IMPORT_TIMEZONE = ZoneInfo("Europe/London")  # imported shift times are wall-clock times here
 ALLOWED_PRINT_HOURS = {16, 17, 18}
 DASH_PATTERN = r"[-–—]"
 
+# training flags, one bit each, used by the columnar availability store
+TRAININGS = ["KITUP", "AATT", "MT", "ICA"]
+TRAINING_BITS = {training: 1 << i for i, training in enumerate(TRAININGS)}
+
+# Define role-to-training mapping
+ROLE_TO_TRAINING = {
+    'KITUP': ['Host', 'Dekit', 'Kit Up 1', 'Kit Up 2', 'Kit Up 3', 'Clip In 1', 'Clip In 2'],
+    'AATT': ['TREE TREK 1', 'TREE TREK 2', 'Course Support 1', 'Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1'],
+    'MT': ['Mini Trek'],
+    'ICA': ['ICA 1', 'ICA 2', 'ICA 3', 'ICA 4']
+}
+
+# Default slot layout and rotation rules for a schedule template; a template can
+# carry its own copy (Template.rotation). Rows are sheet rows, one per slot.
+ROTATION_DEFAULT = {
+    "phases": {
+        "morning": {
+            "rows": [2, 3, 4, 5, 6, 7, 8],  # 9:00 .. 12:00-12:45
+            # from 10:30 the second and third Kit Up swap with the Clip Ins
+            "handovers": {"5": [["Kit Up 2", "Clip In 1"], ["Kit Up 3", "Clip In 2"]]},
+        },
+        "afternoon": {
+            "rows": [10, 11, 12, 13, 14, 15],  # 12:45-1:30 .. 15:30
+            "handovers": {"13": [["Kit Up 2", "Clip In 1"], ["Kit Up 3", "Clip In 2"]]},
+        },
+        "evening": {"rows": [16, 17, 18, 19, 20, 21]},  # 16:00 .. 18:30
+    },
+    # each group moves one post to the right every slot
+    "rotate": [["Course Support 1", "Course Support 2", "Zip Top 1", "Zip Top 2", "Zip Ground", "rotate to course 1"]],
+    # evening posts filled by the late shift, in roster order
+    "late_roles": ["ICA 1", "ICA 2", "ICA 3", "ICA 4"],
+    # evening rows that keep printing the afternoon posts, by print_until_hour
+    "evening_hold": {"16": 0, "17": 2, "18": 4},
+}
+PLANNER_ROLES = {role for roles in ROLE_TO_TRAINING.values() for role in roles}
+# compiled slot programs kept per process (one per template layout and cutoff)
+SLOT_PROGRAM_CACHE_SIZE = int(os.getenv("SLOT_PROGRAM_CACHE_SIZE", "128"))
+
+# cross-day fairness: plans from the last N days count, and a higher strength
+# pushes harder toward people with fewer recent assignments of a role
+FAIRNESS_WINDOW_DAYS = int(os.getenv("FAIRNESS_WINDOW_DAYS", "28"))
+FAIRNESS_STRENGTH = float(os.getenv("FAIRNESS_STRENGTH", "1"))
+
+# half-hour planner slots, 9:00 to 18:30 (start minute of day)
+COVERAGE_SLOTS = np.arange(9 * 60, 19 * 60, 30, dtype=np.int64)
+COVERAGE_MAX_DAYS = int(os.getenv("COVERAGE_MAX_DAYS", "366"))
+
+# absence simulation: default and maximum runs per /simulate request
+SIMULATION_RUNS = int(os.getenv("SIMULATION_RUNS", "2000"))
+SIMULATION_MAX_RUNS = int(os.getenv("SIMULATION_MAX_RUNS", "20000"))
+
+# parse pool for multi-sheet availability uploads (defaults to one process per core)
+IMPORT_WORKERS = max(1, int(os.getenv("IMPORT_WORKERS", "0")) or os.cpu_count() or 1)
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+# how often an import re-reads and retries after losing a version race
+IMPORT_MAX_RETRIES = int(os.getenv("IMPORT_MAX_RETRIES", "3"))
+
+# parsed availability sheets are kept by content hash for this long, so a
+# re-uploaded sheet isn't parsed again
+IMPORT_CACHE_DAYS = int(os.getenv("IMPORT_CACHE_DAYS", "30"))
+# part of every parsed-sheet cache key: bump it when a parser's output changes
+AVAILABILITY_PARSER_VERSION = 2
+
+# fuzzy name suggestions for unmatched import rows (set to 0 to disable)
+FUZZY_NAME_SUGGESTIONS = os.getenv("FUZZY_NAME_SUGGESTIONS", "1") != "0"
+FUZZY_NAME_THRESHOLD = float(os.getenv("FUZZY_NAME_THRESHOLD", "0.3"))
+
+# rows fetched per server-side cursor batch in /workers/export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+
+# worker change feed: how long change-log rows are kept, and how the SSE stream
+# polls. A stream holds a gunicorn thread (gunicorn.conf.py runs gthread
+# workers), so it ends well inside the worker timeout and EventSource reconnects.
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv("CHANGE_LOG_RETENTION_DAYS", "30"))
+CHANGE_STREAM_POLL_SECONDS = float(os.getenv("CHANGE_STREAM_POLL_SECONDS", "2"))
+CHANGE_STREAM_MAX_SECONDS = int(os.getenv("CHANGE_STREAM_MAX_SECONDS", "25"))
+
+# plan pre-generation: the next PREGENERATE_DAYS days on each template (all of
+# them unless PREGENERATE_TEMPLATES names some), for each "<ica morning>-<ica
+# afternoon>-<print until>" option set. PREGENERATE_INTERVAL > 0 runs it in a
+# background thread; otherwise run `flask --app app pregenerate` from cron.
+PREGENERATE_DAYS = int(os.getenv("PREGENERATE_DAYS", "7"))
+PREGENERATE_TEMPLATES = [t.strip() for t in os.getenv("PREGENERATE_TEMPLATES", "").split(",") if t.strip()]
+PREGENERATE_OPTIONS = [
+    tuple(int(n) for n in option.split("-"))
+    for option in os.getenv("PREGENERATE_OPTIONS", "4-4-16").split(",") if option.strip()
+]
+PREGENERATE_INTERVAL = int(os.getenv("PREGENERATE_INTERVAL", "0"))  # seconds, 0 = off
+PREGENERATE_DEBOUNCE_SECONDS = 5  # let a burst of writes land before re-planning
+
+# sites: one deployment serves several activity centres. Each request is scoped
+# to the site named by its X-Site-ID header (or ?site=, for EventSource), and
+# every worker, template and plan belongs to exactly one site. SITES lists
+# sites that get the bundled templates before anything is uploaded to them.
+SITE_HEADER = "X-Site-ID"
+SITE_PATTERN = re.compile(r"[a-z0-9_-]{1,50}")
+DEFAULT_SITE = os.getenv("DEFAULT_SITE", "default")
+SITES = [s.strip() for s in os.getenv("SITES", DEFAULT_SITE).split(",") if s.strip()]
+for _site in [DEFAULT_SITE, *SITES]:
+    if not SITE_PATTERN.fullmatch(_site):
+        raise ValueError(f"Invalid site id {_site!r}: use 1-50 of a-z, 0-9, '_' and '-'")
+
+
+@app.before_request
+def resolve_site():
+    site = (request.headers.get(SITE_HEADER) or request.args.get("site") or DEFAULT_SITE).strip().lower()
+    if not SITE_PATTERN.fullmatch(site):
+        return jsonify({"error": f"Invalid site id {site!r}"}), 400
+    g.site_id = site
+    log_summary(site=site)
+
+
+# upload limits: bodies over MAX_UPLOAD_BYTES are refused (413) while they
+# stream in, and .xlsx uploads are checked against the sheet and unpacked-size
+# limits before openpyxl sees them (400)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_UPLOAD_SHEETS = int(os.getenv("MAX_UPLOAD_SHEETS", "100"))
+MAX_UPLOAD_UNPACKED_BYTES = int(os.getenv("MAX_UPLOAD_UNPACKED_BYTES", str(10 * MAX_UPLOAD_BYTES)))
+MAX_UPLOAD_RATIO = int(os.getenv("MAX_UPLOAD_RATIO", "100"))  # per zip member; real sheets compress ~10:1
+UPLOAD_CHUNK_SIZE = 64 * 1024
+WORKSHEET_PART = re.compile(r"xl/worksheets/[^/]+\.xml")
+
+# headroom for the multipart framing and form fields around the file itself
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + UPLOAD_CHUNK_SIZE
+
+
+class UploadRejected(BadRequest):
+    """An upload refused before parsing; answered as a JSON 400."""
+
+
+def check_zip_member(name, compressed, unpacked):
+    """Refuse a single zip member that is a declared zip bomb."""
+    if unpacked > 1024 * 1024 and unpacked > MAX_UPLOAD_RATIO * max(compressed, 1):
+        raise UploadRejected(f"{name} expands more than {MAX_UPLOAD_RATIO}:1")
+
+
+class ZipStreamCheck:
+    """
+    Follows an .xlsx's local file headers as its bytes arrive, so a non-zip,
+    a workbook with too many sheets or a declared zip bomb is refused part
+    way through the upload. Members whose sizes are deferred to a data
+    descriptor (or zip64) end the scan; validate_xlsx covers the rest once
+    the upload is complete.
+    """
+    HEADER = struct.Struct("<4sHHHHHIIIHH")
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.skip = 0  # member data still to pass over
+        self.started = False
+        self.done = False
+        self.sheets = 0
+        self.unpacked = 0
+
+    def feed(self, chunk):
+        if self.done:
+            return
+        if self.skip >= len(chunk):
+            self.skip -= len(chunk)
+            return
+        self.buffer += chunk[self.skip:]
+        self.skip = 0
+        while len(self.buffer) >= self.HEADER.size:
+            signature, _, flags, _, _, _, _, compressed, unpacked, name_len, extra_len = self.HEADER.unpack_from(self.buffer)
+            if signature != b"PK\x03\x04":
+                if not self.started:
+                    raise UploadRejected("Not an .xlsx file (it isn't a zip archive)")
+                self.done = True  # central directory: validate_xlsx takes it from here
+                return
+            self.started = True
+            if flags & 0x08 or compressed == 0xFFFFFFFF:
+                self.done = True
+                return
+            header_len = self.HEADER.size + name_len + extra_len
+            if len(self.buffer) < header_len:
+                return
+            name = bytes(self.buffer[self.HEADER.size:self.HEADER.size + name_len]).decode("utf-8", "replace")
+            if WORKSHEET_PART.fullmatch(name):
+                self.sheets += 1
+                if self.sheets > MAX_UPLOAD_SHEETS:
+                    raise UploadRejected(f"Workbook has more than {MAX_UPLOAD_SHEETS} sheets")
+            self.unpacked += unpacked
+            if self.unpacked > MAX_UPLOAD_UNPACKED_BYTES:
+                raise UploadRejected(f"Workbook unpacks to more than {MAX_UPLOAD_UNPACKED_BYTES} bytes")
+            check_zip_member(name, compressed, unpacked)
+
+            del self.buffer[:header_len]
+            if len(self.buffer) >= compressed:
+                del self.buffer[:compressed]
+            else:
+                self.skip = compressed - len(self.buffer)
+                self.buffer.clear()
+
+
+class UploadSpool:
+    """
+    What the multipart parser writes an uploaded file into: a temp file on
+    disk, hashed and size-checked chunk by chunk (and, for .xlsx, followed
+    by ZipStreamCheck), instead of Werkzeug's default in-memory buffer.
+    Reads, seeks and close go to the temp file, which is removed on close.
+    """
+
+    def __init__(self, filename):
+        suffix = Path(filename or "").suffix.lower()
+        self.file = tempfile.NamedTemporaryFile(prefix="dayplanner-upload-", suffix=suffix if suffix in (".csv", ".ics") else ".xlsx")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.zip_check = ZipStreamCheck() if suffix == ".xlsx" else None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > MAX_UPLOAD_BYTES:
+            raise RequestEntityTooLarge()
+        self.digest.update(chunk)
+        if self.zip_check is not None:
+            self.zip_check.feed(chunk)
+        return self.file.write(chunk)
+
+    @property
+    def path(self):
+        return self.file.name
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpool(filename)
+
+
+app.request_class = UploadRequest
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return jsonify({"error": f"Upload is larger than the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit"}), 413
+
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(e):
+    log_summary(upload_rejected=e.description)
+    return jsonify({"error": e.description}), 400
+
+
+def uploaded_file():
+    """
+    The request's 'file' part, spooled and hashed by UploadSpool, or None.
+    Call it outside the view's catch-all try so 413s and rejections get
+    their own responses rather than a 500.
+    """
+    file = request.files.get("file")
+    return file if file and isinstance(file.stream, UploadSpool) else None
+
+
+def validate_xlsx(path):
+    """
+    Central-directory checks on an uploaded workbook before any parse: a
+    readable zip with xl/workbook.xml, within the sheet-count and unpacked
+    size limits. Raises UploadRejected.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            members = archive.infolist()
+    except (zipfile.BadZipFile, OSError):
+        raise UploadRejected("Not a valid .xlsx file")
+    names = {member.filename for member in members}
+    if "xl/workbook.xml" not in names:
+        raise UploadRejected("Not an Excel workbook (no xl/workbook.xml)")
+    sheets = sum(1 for name in names if WORKSHEET_PART.fullmatch(name))
+    if sheets > MAX_UPLOAD_SHEETS:
+        raise UploadRejected(f"Workbook has {sheets} sheets, more than the {MAX_UPLOAD_SHEETS} allowed")
+    if sum(member.file_size for member in members) > MAX_UPLOAD_UNPACKED_BYTES:
+        raise UploadRejected(f"Workbook unpacks to more than {MAX_UPLOAD_UNPACKED_BYTES} bytes")
+    for member in members:
+        check_zip_member(member.filename, member.compress_size, member.file_size)
+
+
+def normalize_name(name):
+    """
+    Lookup key for a worker name: accents stripped, casefolded and
+    whitespace collapsed, so 'Ciara ', 'ciara' and 'Cíara' all match.
+    """
+    decomposed = unicodedata.normalize("NFKD", str(name or ""))
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(stripped.casefold().split())
+
+
 # Define a Worker model
 class Worker(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
+    # normalized copy of name used for lookups (kept in sync by the validator below)
+    name_normalized = db.Column(db.String(100), nullable=False)
     roles = db.Column(db.JSON, nullable=False)  # Roles as a JSON column
     availability = db.Column(db.JSON, nullable=False)  # Availability as a JSON column
+    # TRAINING_BITS of roles (kept in sync by the validator below), indexed for role filters
+    roles_mask = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # bumped on every write; UPDATE/DELETE only match the version that was read
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    site_id = db.Column(db.String(50), nullable=False, default=DEFAULT_SITE, server_default=DEFAULT_SITE)
+
+    __mapper_args__ = {"version_id_col": version}
+    # names are unique per site; every lookup and role filter leads with the site
+    __table_args__ = (
+        db.Index("ix_worker_site_name", "site_id", "name_normalized", unique=True),
+        db.Index("ix_worker_site_roles", "site_id", "roles_mask"),
+    )
+
+    @validates("name")
+    def sync_name_normalized(self, key, value):
+        self.name_normalized = normalize_name(value)
+        return value
+
+    @validates("roles")
+    def sync_roles_mask(self, key, value):
+        self.roles_mask = roles_mask(value)
+        return value
+
+    @classmethod
+    def with_trainings(cls, *trainings):
+        """
+        Filter for workers holding every one of `trainings`. Written as an IN
+        over the masks that include those bits, so it can use the index.
+        """
+        required = sum(TRAINING_BITS[t] for t in trainings)
+        return cls.roles_mask.in_([m for m in range(1 << len(TRAININGS)) if m & required == required])
+
+    def to_dict(self):
+        """The one JSON shape of a worker, shared by every endpoint."""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "roles": self.roles,
+            "availability": self.availability,
+            "version": self.version,
+        }
 
     def __repr__(self):
         return f"<Worker {self.name}>"
 
+
+class Template(db.Model):
+    """
+    Index of uploaded schedule templates. The workbook itself is stored once per
+    content hash in TEMPLATE_STORE; several names may point at the same blob.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer, nullable=False)
+    sheet_names = db.Column(db.JSON, nullable=False)
+    role_columns = db.Column(db.JSON, nullable=False)  # {role header: column} from row 1
+    rotation = db.Column(db.JSON, nullable=True)  # slot/rotation rules; None means ROTATION_DEFAULT
+    uploaded_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    site_id = db.Column(db.String(50), nullable=False, default=DEFAULT_SITE, server_default=DEFAULT_SITE)
+
+    __table_args__ = (db.Index("ix_template_site_name", "site_id", "name", unique=True),)
+
+    @property
+    def path(self):
+        return TEMPLATE_STORE / f"{self.sha256}.xlsx"
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "sha256": self.sha256,
+            "size": self.size,
+            "sheet_names": self.sheet_names,
+            "roles": [r for r in sorted(self.role_columns, key=self.role_columns.get) if r != "Time"],
+            "rotation": self.rotation or ROTATION_DEFAULT,
+            "uploaded_at": self.uploaded_at.isoformat(),
+        }
+
+
+class DayPlan(db.Model):
+    """A generated day plan: who worked which role, keyed by worker id."""
+    id = db.Column(db.Integer, primary_key=True)
+    plan_date = db.Column(db.Date, nullable=False, index=True)
+    template = db.Column(db.String(255), nullable=False)
+    assignments = db.Column(db.JSON, nullable=False)  # {"morning": {role: id}, "afternoon": {role: id}}
+    counted = db.Column(db.Boolean, nullable=False, default=True)  # still inside the fairness window
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    site_id = db.Column(db.String(50), nullable=False, default=DEFAULT_SITE, server_default=DEFAULT_SITE)
+
+    __table_args__ = (
+        db.UniqueConstraint("site_id", "plan_date", "template", name="uq_day_plan_site_date_template"),
+    )
+
+
+class GeneratedPlan(db.Model):
+    """
+    A finished schedule workbook, so repeat requests for a day (and the
+    morning burst) skip planning. roster_key fingerprints the inputs; a plan
+    whose key no longer matches them is stale and is rebuilt on next use.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    plan_date = db.Column(db.Date, nullable=False, index=True)
+    template = db.Column(db.String(255), nullable=False)
+    options = db.Column(db.String(20), nullable=False)  # "<ica morning>-<ica afternoon>-<print until>"
+    roster_key = db.Column(db.String(64), nullable=False)
+    workbook = db.deferred(db.Column(db.LargeBinary, nullable=False))
+    source = db.Column(db.String(20), nullable=False, default="request")  # request | pregenerate
+    # a pre-generated plan's assignments, held back from the fairness counters
+    # until a request first serves it (NULL once counted)
+    pending_assignments = db.Column(db.JSON(none_as_null=True), nullable=True)
+    generated_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    site_id = db.Column(db.String(50), nullable=False, default=DEFAULT_SITE, server_default=DEFAULT_SITE)
+
+    __table_args__ = (
+        db.UniqueConstraint("site_id", "plan_date", "template", "options", name="uq_generated_plan_site"),
+    )
+
+
+class RoleAssignmentCount(db.Model):
+    """Running count of a worker's assignments to a role over the fairness window."""
+    worker_id = db.Column(db.Integer, db.ForeignKey("worker.id", ondelete="CASCADE"), primary_key=True)
+    role = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class WorkerChange(db.Model):
+    """
+    Append-only log of worker writes. The id is the change feed cursor:
+    clients ask for everything after the last id they saw.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    worker_id = db.Column(db.Integer, nullable=False)  # no FK: deletes are logged too
+    op = db.Column(db.String(10), nullable=False)  # create | update | delete
+    worker_version = db.Column(db.Integer, nullable=True)
+    source = db.Column(db.String(20), nullable=False, default="api")  # api | import
+    changed_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+    site_id = db.Column(db.String(50), nullable=False, default=DEFAULT_SITE, server_default=DEFAULT_SITE)
+
+    __table_args__ = (db.Index("ix_worker_change_site", "site_id", "id"),)
+
+
+class ParsedSheet(db.Model):
+    """
+    Rows parsed from one availability sheet (or CSV/iCalendar file), keyed by
+    a hash of its content, format and parser version (parsed_sheet_key).
+    Parsing doesn't depend on the site, so neither does this.
+    """
+    sha256 = db.Column(db.String(64), primary_key=True)
+    rows = db.Column(db.JSON, nullable=False)  # [[date, name, start, end], ...]
+    parsed_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+
+class AvailabilityImport(db.Model):
+    """
+    The response of an applied availability upload, by file hash, so an
+    identical re-upload is answered without parsing or writing. It only
+    stands while the site's change log is still at change_cursor; any later
+    worker write means the file could change something again.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    site_id = db.Column(db.String(50), nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    format = db.Column(db.String(10), nullable=False)
+    change_cursor = db.Column(db.Integer, nullable=False)
+    result = db.deferred(db.Column(db.JSON, nullable=False))
+    imported_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (db.UniqueConstraint("site_id", "sha256", name="uq_availability_import"),)
+
+
+def record_worker_changes(workers, op, source="api"):
+    """
+    Log writes to `workers` in the current transaction, so the log commits
+    (or rolls back) with them. Flushes first so ids and versions are final,
+    and drops rows older than the retention window.
+    """
+    db.session.flush()
+    lock_change_log({w.site_id for w in workers})
+    now = datetime.now(timezone.utc)
+    db.session.add_all([
+        WorkerChange(
+            worker_id=w.id, op=op, worker_version=w.version, source=source, changed_at=now, site_id=w.site_id
+        )
+        for w in workers
+    ])
+    cutoff = now - timedelta(days=CHANGE_LOG_RETENTION_DAYS)
+    WorkerChange.query.filter(WorkerChange.changed_at < cutoff).delete(synchronize_session=False)
+    for site in {w.site_id for w in workers}:
+        invalidate_after_commit("workers", site)
+    pregenerate_wakeup.set()
+
+
+def lock_change_log(sites):
+    """
+    Hold each site's change-log append lock until this transaction ends, so
+    log ids commit in the order they are handed out: a reader whose cursor
+    reached id N never sees a row below N commit afterwards. SQLite allows a
+    single writer anyway; Postgres takes a transaction-level advisory lock,
+    and other servers lock the site's newest log row (InnoDB also locks the
+    gap above it, which covers an empty log).
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "sqlite":
+        return
+    for site in sorted(sites):
+        if dialect == "postgresql":
+            db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": advisory_lock_key(f"worker_change:{site}")})
+        else:
+            db.session.query(WorkerChange.id).filter(WorkerChange.site_id == site).order_by(
+                WorkerChange.id.desc()
+            ).limit(1).with_for_update().all()
+
+
+def advisory_lock_key(name):
+    """Postgres advisory lock id (a signed 64-bit int) for a lock name."""
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:8], "big", signed=True)
+
+
+def change_cursor(site):
+    """Id of the site's latest change-log row (0 if none)."""
+    return db.session.query(db.func.max(WorkerChange.id)).filter(WorkerChange.site_id == site).scalar() or 0
+
+
+def worker_changes_since(since, site):
+    """
+    Net effect of a site's change log after `since`: (cursor, upserted
+    workers, deleted ids, reset). reset means the log no longer reaches back
+    to `since` (or since is 0) and the upserts are the site's full worker list.
+    """
+    log = db.session.query(WorkerChange).filter(WorkerChange.site_id == site)
+    cursor = change_cursor(site)
+    oldest = log.with_entities(db.func.min(WorkerChange.id)).scalar()
+    if since <= 0 or since > cursor or (oldest is not None and since < oldest - 1):
+        return cursor, Worker.query.filter_by(site_id=site).order_by(Worker.id).all(), [], True
+
+    latest_op = {}
+    for worker_id, op in (
+        log.with_entities(WorkerChange.worker_id, WorkerChange.op)
+        .filter(WorkerChange.id > since, WorkerChange.id <= cursor)
+        .order_by(WorkerChange.id)
+    ):
+        latest_op[worker_id] = op
+    deleted = sorted(worker_id for worker_id, op in latest_op.items() if op == "delete")
+    changed = [worker_id for worker_id, op in latest_op.items() if op != "delete"]
+    upserts = Worker.query.filter(Worker.id.in_(changed)).order_by(Worker.id).all() if changed else []
+    return cursor, upserts, deleted, False
+
+
+def plan_role_deltas(assignments, sign):
+    """(worker id, role) -> +/-1 for every assignment in a stored plan."""
+    deltas = defaultdict(int)
+    for half in ("morning", "afternoon"):
+        for role, worker_id in ((assignments or {}).get(half) or {}).items():
+            if worker_id is not None:
+                deltas[(int(worker_id), role)] += sign
+    return deltas
+
+
+def apply_role_deltas(deltas):
+    """Add deltas to the counters, touching only the affected rows."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    worker_ids = {wid for wid, _ in deltas}
+    existing = {
+        (c.worker_id, c.role): c
+        for c in RoleAssignmentCount.query.filter(RoleAssignmentCount.worker_id.in_(worker_ids))
+    }
+    known_workers = {wid for (wid,) in db.session.query(Worker.id).filter(Worker.id.in_(worker_ids))}
+    for (wid, role), delta in deltas.items():
+        counter = existing.get((wid, role))
+        if counter is not None:
+            counter.count = max(0, counter.count + delta)
+        elif delta > 0 and wid in known_workers:
+            db.session.add(RoleAssignmentCount(worker_id=wid, role=role, count=delta))
+
+
+def load_role_counts(worker_ids):
+    """{(worker id, role): count} for the given workers; reads only their counter rows."""
+    worker_ids = list(worker_ids)
+    if not worker_ids:
+        return {}
+    rows = db.session.query(
+        RoleAssignmentCount.worker_id, RoleAssignmentCount.role, RoleAssignmentCount.count
+    ).filter(RoleAssignmentCount.worker_id.in_(worker_ids)).all()
+    return {(wid, role): count for wid, role, count in rows}
+
+
+def plan_assignments(morning, afternoon, worker_ids):
+    """{"morning": {role: worker id}, "afternoon": {...}} from role -> name maps."""
+    return {
+        "morning": {role: worker_ids.get(name) for role, name in morning.items() if name},
+        "afternoon": {role: worker_ids.get(name) for role, name in afternoon.items() if name},
+    }
+
+
+def save_day_plan(plan_date, template, assignments, site=DEFAULT_SITE):
+    """
+    Store (or replace) a site's plan for a date/template and update the counters
+    incrementally: a replaced plan is subtracted, the new one added, and plans
+    that fell out of the fairness window are subtracted once and flagged.
+    """
+    window_start = date.fromordinal(datetime.now(TIMEZONE).date().toordinal() - FAIRNESS_WINDOW_DAYS)
+    counted = plan_date >= window_start
+
+    deltas = plan_role_deltas(assignments, +1) if counted else defaultdict(int)
+
+    # age out a bounded batch of plans that left the window since the last save
+    expired = DayPlan.query.filter(
+        DayPlan.site_id == site,
+        DayPlan.counted.is_(True),
+        DayPlan.plan_date < window_start,
+        DayPlan.plan_date != plan_date,
+    ).limit(100).all()
+    for old in expired:
+        for key, delta in plan_role_deltas(old.assignments, -1).items():
+            deltas[key] += delta
+        old.counted = False
+
+    plan = DayPlan.query.filter_by(site_id=site, plan_date=plan_date, template=template).first()
+    if plan is None:
+        plan = DayPlan(site_id=site, plan_date=plan_date, template=template)
+        db.session.add(plan)
+    elif plan.counted:
+        for key, delta in plan_role_deltas(plan.assignments, -1).items():
+            deltas[key] += delta
+
+    plan.assignments = assignments
+    plan.counted = counted
+    plan.created_at = datetime.now(timezone.utc)
+    with db.session.no_autoflush:
+        apply_role_deltas(deltas)
+    db.session.commit()
+
+
+def read_role_columns(sheet, header_row=1):
+    """Map each role header on the template's header row to its column number."""
+    role_to_column = {}
+    for row in sheet.iter_rows(min_row=header_row, max_row=header_row, values_only=True):
+        for col, role in enumerate(row, start=1):
+            if role:  # Skip empty cells
+                role_to_column[str(role).strip()] = col
+    return role_to_column
+
+
+def store_template(stream, name, site=DEFAULT_SITE):
+    """
+    Hash a template while copying it into the content-addressed store, then
+    index it under `name` for `site`. Identical content is kept only once on
+    disk, whichever sites use it.
+    Returns (Template, deduplicated).
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=TEMPLATE_STORE, prefix=".upload-", suffix=".xlsx", delete=False) as tmp:
+        for chunk in iter(lambda: stream.read(64 * 1024), b""):
+            digest.update(chunk)
+            tmp.write(chunk)
+            size += len(chunk)
+    sha256 = digest.hexdigest()
+    blob_path = TEMPLATE_STORE / f"{sha256}.xlsx"
+    deduplicated = blob_path.exists()
+
+    try:
+        template = Template.query.filter_by(site_id=site, name=name).first()
+        if template and template.sha256 == sha256:
+            return template, True
+
+        # Read the metadata once, at upload time (this also rejects non-workbooks)
+        workbook = openpyxl.load_workbook(blob_path if deduplicated else tmp.name, read_only=True)
+        try:
+            sheet_names = workbook.sheetnames
+            role_columns = read_role_columns(workbook.active)
+        finally:
+            workbook.close()
+
+        if not deduplicated:
+            os.replace(tmp.name, blob_path)
+    finally:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+
+    if template is None:
+        template = Template(site_id=site, name=name)
+        db.session.add(template)
+    template.sha256 = sha256
+    template.size = size
+    template.sheet_names = sheet_names
+    template.role_columns = role_columns
+    template.uploaded_at = datetime.now(timezone.utc)
+    invalidate_after_commit("templates", site)
+    db.session.commit()
+    return template, deduplicated
+
+
+def index_legacy_templates():
+    """
+    Import templates saved by name before the store existed (e.g. the bundled
+    ones) into every site in SITES. The blob is shared, so each extra site
+    only costs an index row.
+    """
+    indexed = set(db.session.query(Template.site_id, Template.name))
+    for path in sorted(UPLOAD_FOLDER.glob("*.xlsx")):
+        for site in dict.fromkeys([DEFAULT_SITE, *SITES]):
+            if (site, path.name) in indexed:
+                continue
+            try:
+                with open(path, "rb") as fh:
+                    store_template(fh, path.name, site)
+                logging.info("Indexed template %s for site %s", path.name, site)
+            except Exception as e:
+                db.session.rollback()
+                logging.warning("Could not index template %s for site %s: %s", path.name, site, e)
+
+
+def find_workers_by_names(names, site):
+    """
+    Resolve many of a site's worker names in one indexed query.
+    Returns {normalized name: Worker} for the names that exist.
+    """
+    keys = {normalize_name(n) for n in names} - {""}
+    if not keys:
+        return {}
+    workers = Worker.query.filter(Worker.site_id == site, Worker.name_normalized.in_(keys)).all()
+    return {w.name_normalized: w for w in workers}
+
+
+def parse_timestamp(value):
+    """Stored timestamp -> datetime; fromisoformat for the ISO strings we write, dateutil for anything else."""
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return parser.parse(value)
+
+
+def shift_window(entry):
+    """(start, end) of an availability entry as comparable UTC instants."""
+    return (
+        parse_timestamp(entry["start"]).astimezone(timezone.utc),
+        parse_timestamp(entry["end"]).astimezone(timezone.utc),
+    )
+
+
+def shift_summary(entry):
+    return {"start": entry["start"], "end": entry["end"], "late": bool(entry.get("late", False))}
+
+
+def diff_availability(existing, incoming):
+    """
+    Set-based diff of a worker's stored availability against imported shifts.
+    `incoming` maps date -> new entry; an imported date replaces whatever is
+    stored for that date, other dates are left alone.
+    Returns (new availability list or None if nothing changed, changes dict).
+    """
+    stored_by_date = defaultdict(list)
+    for entry in existing:
+        stored_by_date[parse_timestamp(entry["start"]).date()].append(entry)
+
+    changes = {"added": [], "changed": [], "removed": []}
+    replaced_dates = set()
+    for day, new_entry in sorted(incoming.items()):
+        stored = stored_by_date.get(day, [])
+        new_window = shift_window(new_entry)
+        same = [e for e in stored if shift_window(e) == new_window]
+
+        if same and len(stored) == 1:
+            continue  # unchanged, keep the stored entry (and its late flag)
+
+        replaced_dates.add(day)
+        if same:
+            # keep the matching entry, drop the duplicates around it
+            new_entry = same[0]
+            changes["removed"].extend(shift_summary(e) for e in stored if e is not same[0])
+        elif stored:
+            changes["changed"].append({
+                "date": day.isoformat(),
+                "from": shift_summary(stored[0]),
+                "to": shift_summary(new_entry),
+            })
+            changes["removed"].extend(shift_summary(e) for e in stored[1:])
+        else:
+            changes["added"].append(shift_summary(new_entry))
+        incoming[day] = new_entry
+
+    if not replaced_dates:
+        return None, changes
+
+    kept = [e for e in existing if parse_timestamp(e["start"]).date() not in replaced_dates]
+    return kept + [incoming[day] for day in sorted(replaced_dates)], changes
+
+
+def name_trigrams(key):
+    """Trigrams of a normalized name, padded per word like pg_trgm."""
+    grams = set()
+    for word in key.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NameTrigramIndex:
+    """
+    In-memory trigram postings over worker names. Built from one narrow
+    query, then each unmatched name only scores the workers that share a
+    trigram with it instead of scanning the whole table.
+    """
+
+    def __init__(self, rows):
+        self.names = {}
+        self.grams = {}
+        self.postings = defaultdict(set)
+        for worker_id, name, key in rows:
+            grams = name_trigrams(key)
+            self.names[worker_id] = name
+            self.grams[worker_id] = grams
+            for gram in grams:
+                self.postings[gram].add(worker_id)
+
+    @classmethod
+    def from_db(cls, site):
+        rows = db.session.query(Worker.id, Worker.name, Worker.name_normalized).filter(Worker.site_id == site).all()
+        return cls(rows)
+
+    def suggest(self, name, limit=3, threshold=FUZZY_NAME_THRESHOLD):
+        grams = name_trigrams(normalize_name(name))
+        if not grams:
+            return []
+
+        shared = defaultdict(int)
+        for gram in grams:
+            for worker_id in self.postings.get(gram, ()):
+                shared[worker_id] += 1
+
+        scored = []
+        for worker_id, common in shared.items():
+            score = common / len(grams | self.grams[worker_id])
+            if score >= threshold:
+                scored.append((score, self.names[worker_id]))
+        scored.sort(key=lambda x: (-x[0], x[1]))
+        return [{"name": n, "score": round(sc, 2)} for sc, n in scored[:limit]]
+
+# ---- availability workbook parsing ----
+# Parsing runs sheet-by-sheet in a process pool, so these helpers stay at module
+# level and only return plain tuples: (date 'YYYY-MM-DD', name, 'HH:MM', 'HH:MM').
+
+def parse_time_range(cell_val):
+    """
+    Accepts strings like '08:00 - 16:00', '08:00–16:00', '8:00 AM — 4:30 PM'.
+    Returns (start_time, end_time) as datetime.time.
+    """
+    s = str(cell_val).strip()
+
+    m = re.search(rf"(\d{{1,2}}:\d{{2}})\s*{DASH_PATTERN}\s*(\d{{1,2}}:\d{{2}})", s)
+    if m:
+        t1 = datetime.strptime(m.group(1), "%H:%M").time()
+        t2 = datetime.strptime(m.group(2), "%H:%M").time()
+        return t1, t2
+
+    m = re.search(rf"(\d{{1,2}}:\d{{2}}\s*[APap][Mm])\s*{DASH_PATTERN}\s*(\d{{1,2}}:\d{{2}}\s*[APap][Mm])", s)
+    if m:
+        t1 = datetime.strptime(m.group(1).upper(), "%I:%M %p").time()
+        t2 = datetime.strptime(m.group(2).upper(), "%I:%M %p").time()
+        return t1, t2
+
+    raise ValueError(f"Unrecognized time range: {cell_val!r}")
+
+
+def to_time(val):
+    """
+    Convert an Excel cell value into datetime.time if possible.
+    Handles datetime, time, 'HH:MM', and 'HH:MM AM/PM'.
+    """
+    if val is None:
+        return None
+    if isinstance(val, datetime):
+        return val.time()
+    if isinstance(val, dt_time):
+        return val
+    if isinstance(val, str):
+        s = val.strip().upper()
+        try:
+            return datetime.strptime(s, "%H:%M").time()
+        except ValueError:
+            pass
+        try:
+            return datetime.strptime(s, "%I:%M %p").time()
+        except ValueError:
+            return None
+    return None
+
+
+def parse_availability_sheet(sheet):
+    """Rows of one availability sheet (date on row 22, names from row 24)."""
+    # Step 1: Extract date from B22 area on this sheet
+    target_date = None
+    for row in sheet.iter_rows(min_row=22, max_row=22, values_only=True):
+        for value in row:
+            if value and isinstance(value, str):
+                match = re.search(r"\d{2}/\d{2}/\d{4}", value)
+                if match:
+                    target_date = datetime.strptime(match.group(), "%d/%m/%Y")
+                    break
+
+    if not target_date:
+        logging.warning("Skipping sheet '%s' — no date found on row 22.", sheet.title)
+        return []
+
+    date_str = target_date.strftime("%Y-%m-%d")
+    rows = []
+
+    # Step 2: Collect names and times from row 24 down on this sheet
+    for i, row in enumerate(sheet.iter_rows(min_row=24, values_only=True), start=24):
+        name_val = row[1] if len(row) > 1 else None  # Column B
+
+        # Check columns D, E, F for a single-cell range first
+        time_val = next((row[idx] for idx in (3, 4, 5) if len(row) > idx and row[idx]), None)
+
+        row_log.debug("[%s] Row %d -> name: %s, time: %s", sheet.title, i, name_val, time_val)
+
+        if not name_val:
+            continue
+
+        worker_name = str(name_val).strip()
+
+        # Try single-cell time range first
+        start_t = end_t = None
+        if time_val:
+            try:
+                start_t, end_t = parse_time_range(time_val)
+            except Exception as parse_err:
+                row_log.debug("[%s] Single-cell time parse failed at row %d: %s", sheet.title, i, parse_err)
+
+        # Fallback: if range not found in one cell, try separate start/end in D and E
+        if (start_t is None or end_t is None) and len(row) > 4:
+            start_t = to_time(row[3])
+            end_t = to_time(row[4])
+
+        if not (start_t and end_t):
+            # Nothing parseable on this row; continue to next row
+            continue
+
+        rows.append((date_str, worker_name, start_t.strftime("%H:%M"), end_t.strftime("%H:%M")))
+
+    return rows
+
+
+def parse_availability_sheets(path, sheet_names):
+    """
+    Parse the named sheets of a workbook on disk.
+    Returns [(sheet title, row tuples, parse ms)]; safe to run in a pool process.
+    """
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        results = []
+        for sheet_name in sheet_names:
+            started = time.perf_counter()
+            logging.debug("🔎 Processing sheet: %s", sheet_name)
+            rows = parse_availability_sheet(workbook[sheet_name])
+            results.append((sheet_name, rows, (time.perf_counter() - started) * 1000))
+        return results
+    finally:
+        workbook.close()
+
+
+def import_pool_size(sheet_count):
+    return max(1, min(IMPORT_WORKERS, sheet_count))
+
+
+def get_process_pool():
+    """Process pool shared by CPU-heavy request work, created lazily per gunicorn worker."""
+    global _process_pool
+    with _process_pool_lock:  # gthread workers: one pool per process, whichever thread asks first
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=IMPORT_WORKERS,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=init_pool_process,
+            )
+    return _process_pool
+
+
+def run_in_pool(calls):
+    """
+    Run [(fn, *args), ...] on the process pool; returns their results in order.
+    Once a child dies (an OOM kill mid-parse, say) the executor stays broken,
+    so it is dropped and the batch resubmitted once to a fresh pool.
+    """
+    for attempt in (1, 2):
+        pool = get_process_pool()
+        try:
+            futures = [pool.submit(*call) for call in calls]
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            discard_process_pool(pool)
+            if attempt == 2:
+                raise
+            logging.warning("Process pool lost a worker process; starting a new pool and retrying")
+
+
+def discard_process_pool(pool):
+    """Forget a broken pool so the next get_process_pool() starts a new one."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def init_pool_process():
+    """
+    Pool initializer: log directly, drop the database connections inherited
+    through fork, and replace state guarded by locks. The fork can happen
+    while another request thread holds one of them, and nothing in the child
+    would ever release it.
+    """
+    global availability_stores, availability_stores_lock, response_cache, _process_pool, _process_pool_lock
+    global _slot_programs, _slot_programs_lock
+    reset_child_logging()
+    availability_stores, availability_stores_lock = {}, threading.Lock()
+    _slot_programs, _slot_programs_lock = OrderedDict(), threading.Lock()
+    _process_pool, _process_pool_lock = None, threading.Lock()
+    if isinstance(response_cache, MemoryCache):
+        response_cache = MemoryCache()
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def parse_availability_workbook(path, sheet_names=None):
+    """
+    Parse the named sheets (default all) of an availability workbook, one pool
+    task per sheet when there is more than one sheet and more than one pool worker.
+    """
+    if sheet_names is None:
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        sheet_names = workbook.sheetnames
+        workbook.close()
+
+    if import_pool_size(len(sheet_names)) == 1:
+        return parse_availability_sheets(path, sheet_names)
+
+    chunks = run_in_pool([(parse_availability_sheets, path, [name]) for name in sheet_names])
+    return [result for chunk in chunks for result in chunk]
+
+
+# ---- repeated uploads ----
+# Uploads are hashed while they spool to disk. An identical re-upload is
+# answered from its AvailabilityImport record; otherwise each sheet is looked
+# up in ParsedSheet by a hash of its cells and only new or changed sheets are
+# parsed. The diff against the database still covers every row, and it only
+# writes shifts that differ.
+
+def xml_local_name(tag):
+    return tag.rpartition("}")[2]
+
+
+def workbook_sheet_hashes(path):
+    """
+    {sheet name: sha256} in workbook order, read straight from the xlsx parts.
+    Each hash covers the sheet's cells with shared strings resolved (plus the
+    workbook's styles, which decide what is a date), so editing one sheet
+    leaves the other sheets' hashes alone.
+    """
+    with zipfile.ZipFile(path) as archive:
+        parts = set(archive.namelist())
+        rels = ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+        targets = {rel.get("Id"): rel.get("Target") for rel in rels}
+        sheets = [
+            (sheet.get("name"), next(v for k, v in sheet.attrib.items() if xml_local_name(k) == "id"))
+            for sheet in ElementTree.fromstring(archive.read("xl/workbook.xml")).iter()
+            if xml_local_name(sheet.tag) == "sheet"
+        ]
+
+        shared = []
+        if "xl/sharedStrings.xml" in parts:
+            for _, element in ElementTree.iterparse(archive.open("xl/sharedStrings.xml")):
+                if xml_local_name(element.tag) == "si":
+                    shared.append("".join(t.text or "" for t in element.iter() if xml_local_name(t.tag) == "t"))
+                    element.clear()
+        styles = archive.read("xl/styles.xml") if "xl/styles.xml" in parts else b""
+
+        hashes = {}
+        for name, rel_id in sheets:
+            target = targets[rel_id]
+            part = target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+            digest = hashlib.sha256(styles)
+            for _, element in ElementTree.iterparse(archive.open(part)):
+                tag = xml_local_name(element.tag)
+                if tag == "c":
+                    children = [(xml_local_name(e.tag), e.text or "") for e in element.iter() if e is not element]
+                    value = next((text for kind, text in children if kind == "v"), "")
+                    if element.get("t") == "s" and value:
+                        value = shared[int(value)]
+                    formula = next((text for kind, text in children if kind == "f"), None)
+                    inline = "".join(text for kind, text in children if kind == "t")
+                    cell = (element.get("r"), element.get("t"), element.get("s"), formula, value, inline)
+                    digest.update(repr(cell).encode())
+                elif tag == "row":
+                    digest.update(f"row {element.get('r')}\n".encode())
+                    element.clear()
+            hashes[name] = digest.hexdigest()
+        return hashes
+
+
+def parsed_sheet_key(import_format, content_sha256):
+    """ParsedSheet key for content parsed as `import_format` by the current parsers."""
+    return hashlib.sha256(f"{import_format}:{AVAILABILITY_PARSER_VERSION}:{content_sha256}".encode()).hexdigest()
+
+
+def parse_with_sheet_cache(import_format, sheet_hashes, parse):
+    """
+    Sheet results for {title: content hash} in that order. Only titles whose
+    content hasn't been parsed as `import_format` before go to parse(titles)
+    -> [(title, rows, ms)]; what it parses is cached. Returns (results,
+    titles served from the cache).
+    """
+    sheet_keys = {title: parsed_sheet_key(import_format, sha256) for title, sha256 in sheet_hashes.items()}
+    keys = list(dict.fromkeys(sheet_keys.values()))
+    cached = {}
+    for i in range(0, len(keys), 500):
+        cached.update(db.session.query(ParsedSheet.sha256, ParsedSheet.rows).filter(ParsedSheet.sha256.in_(keys[i:i + 500])))
+
+    missing = [title for title, key in sheet_keys.items() if key not in cached]
+    parsed = {title: (rows, ms) for title, rows, ms in (parse(missing) if missing else [])}
+    store_parsed_sheets({sheet_keys[title]: rows for title, (rows, _) in parsed.items()})
+
+    results = [
+        (title, *parsed[title]) if title in parsed else (title, [tuple(row) for row in cached[key]], 0.0)
+        for title, key in sheet_keys.items()
+    ]
+    return results, [title for title in sheet_keys if title not in parsed]
+
+
+def store_parsed_sheets(rows_by_hash):
+    """Cache parsed rows by content hash (best effort) and expire entries older than IMPORT_CACHE_DAYS."""
+    if not rows_by_hash:
+        return
+    now = datetime.now(timezone.utc)
+    try:
+        db.session.add_all([ParsedSheet(sha256=sha256, rows=rows, parsed_at=now) for sha256, rows in rows_by_hash.items()])
+        ParsedSheet.query.filter(
+            ParsedSheet.parsed_at < now - timedelta(days=IMPORT_CACHE_DAYS)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # a concurrent upload cached the same sheet first
+
+
+def previous_import(site, sha256, import_format):
+    """The site's recorded import of this exact file in this format, if no worker has been written since."""
+    record = AvailabilityImport.query.filter_by(site_id=site, sha256=sha256).first()
+    if record is not None and record.format == import_format and record.change_cursor == change_cursor(site):
+        return record
+    return None
+
+
+def record_import(site, sha256, import_format, result, since, writes):
+    """
+    Remember an applied upload's response at the site's current change cursor.
+    Skipped when another writer touched the site's workers while it ran (the
+    log grew by more than the import's own `writes` rows after `since`).
+    Records behind the cursor can never be replayed, so they are dropped.
+    """
+    if WorkerChange.query.filter(WorkerChange.site_id == site, WorkerChange.id > since).count() != writes:
+        return
+    cursor = change_cursor(site)
+    try:
+        AvailabilityImport.query.filter(
+            AvailabilityImport.site_id == site,
+            db.or_(AvailabilityImport.change_cursor < cursor, AvailabilityImport.sha256 == sha256),
+        ).delete(synchronize_session=False)
+        db.session.add(AvailabilityImport(
+            site_id=site, sha256=sha256, format=import_format, change_cursor=cursor,
+            result=result, imported_at=datetime.now(timezone.utc),
+        ))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # the same file was recorded concurrently
+
+
+# ---- CSV / iCalendar availability imports ----
+# Both read the upload line by line and produce the same (date, name, start,
+# end) rows as the Excel parser, so they share apply_availability_import.
+
+CSV_COLUMNS = {  # accepted header names (casefolded) -> field
+    "name": "name", "worker": "name", "employee": "name", "staff": "name", "instructor": "name",
+    "date": "date", "day": "date", "shift date": "date",
+    "start": "start", "start time": "start", "from": "start",
+    "end": "end", "end time": "end", "finish": "end", "to": "end",
+    "time": "time", "times": "time", "shift": "time", "hours": "time",
+}
+
+
+def availability_import_format(filename, requested=None):
+    """csv, ics or xlsx, from an explicit ?format= or the file extension."""
+    kind = (requested or Path(filename or "").suffix.lstrip(".")).lower()
+    return kind if kind in ("csv", "ics") else "xlsx"
+
+
+def parse_csv_date(value):
+    value = value.strip()
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, "%d/%m/%Y").date()
+
+
+def parse_availability_csv(stream):
+    """
+    Rows of a CSV rota export. The header needs a name column, a date column
+    (YYYY-MM-DD or DD/MM/YYYY) and either start/end columns or one time-range
+    column ("9:00-17:00"); an end before the start is the next morning, and
+    zero-length rows are skipped. Dates and times repeat a lot, so each
+    distinct string is parsed once.
+    """
+    reader = csv.reader(stream)
+    header = next(reader, None) or []
+    fields = {}
+    for i, column in enumerate(header):
+        field = CSV_COLUMNS.get(column.strip().casefold())
+        if field and field not in fields:
+            fields[field] = i
+    if not {"name", "date"} <= fields.keys() or not ("time" in fields or {"start", "end"} <= fields.keys()):
+        raise ValueError("CSV header needs name and date columns, and start/end or time columns")
+
+    width = max(fields.values()) + 1
+    dates, times, ranges = {}, {}, {}
+
+    def hhmm(value):
+        if value not in times:
+            t = to_time(value)
+            times[value] = t.strftime("%H:%M") if t else None
+        return times[value]
+
+    rows = []
+    for line, record in enumerate(reader, start=2):
+        if len(record) < width:
+            record += [""] * (width - len(record))
+        name = record[fields["name"]].strip()
+        if not name:
+            continue
+        raw_date = record[fields["date"]]
+        if raw_date not in dates:
+            try:
+                dates[raw_date] = parse_csv_date(raw_date).isoformat()
+            except ValueError:
+                dates[raw_date] = None
+        if "time" in fields and record[fields["time"]].strip():
+            raw_range = record[fields["time"]]
+            if raw_range not in ranges:
+                try:
+                    ranges[raw_range] = tuple(t.strftime("%H:%M") for t in parse_time_range(raw_range))
+                except ValueError:
+                    ranges[raw_range] = (None, None)
+            start, end = ranges[raw_range]
+        else:
+            start, end = hhmm(record[fields.get("start", 0)]), hhmm(record[fields.get("end", 0)])
+        if not (dates[raw_date] and start and end) or start == end:
+            row_log.debug("[csv] Skipping line %d: %s", line, record)
+            continue
+        rows.append((dates[raw_date], name, start, end))
+    return rows
+
+
+def iter_ics_lines(stream):
+    """Unfolded content lines of an iCalendar stream (continuation lines start with a space or tab)."""
+    pending = None
+    for raw in stream:
+        line = raw.rstrip("\r\n")
+        if line[:1] in (" ", "\t"):
+            if pending is not None:
+                pending += line[1:]
+            continue
+        if pending is not None:
+            yield pending
+        pending = line
+    if pending is not None:
+        yield pending
+
+
+def parse_ics_datetime(params, value):
+    """DTSTART/DTEND -> datetime in IMPORT_TIMEZONE; None for all-day dates."""
+    value = value.strip()
+    if params.get("VALUE") == "DATE" or len(value) < 15:
+        return None
+    naive = datetime(
+        int(value[0:4]), int(value[4:6]), int(value[6:8]),
+        int(value[9:11]), int(value[11:13]), int(value[13:15]),
+    )
+    if value.endswith("Z"):
+        return naive.replace(tzinfo=timezone.utc).astimezone(IMPORT_TIMEZONE)
+    try:
+        zone = ZoneInfo(params["TZID"].strip('"')) if "TZID" in params else IMPORT_TIMEZONE
+    except (KeyError, ValueError):
+        zone = IMPORT_TIMEZONE
+    return naive.replace(tzinfo=zone).astimezone(IMPORT_TIMEZONE)
+
+
+def ics_unescape(value):
+    return value.replace("\\n", " ").replace("\\N", " ").replace("\\,", ",").replace("\\;", ";").replace("\\\\", "\\")
+
+
+def parse_availability_ics(stream):
+    """
+    Rows of an iCalendar export, one per timed VEVENT. The worker is the
+    event's first ATTENDEE CN, else its SUMMARY. Rows carry no end date, so
+    all-day events and events that don't last between zero and 24 hours are
+    skipped; an overnight event's end is read as the next day on import.
+    """
+    rows = []
+    event = None
+    stamps = {}  # (TZID, VALUE, raw value) -> datetime; shift times repeat a lot
+    for line in iter_ics_lines(stream):
+        if line == "BEGIN:VEVENT":
+            event = {}
+            continue
+        if event is None:
+            continue
+        if line == "END:VEVENT":
+            start, end = event.get("DTSTART"), event.get("DTEND")
+            name = (event.get("ATTENDEE") or event.get("SUMMARY") or "").strip()
+            if start and end and name and 0 < end.timestamp() - start.timestamp() < 86400:
+                rows.append((start.date().isoformat(), name, f"{start:%H:%M}", f"{end:%H:%M}"))
+            else:
+                row_log.debug("[ics] Skipping event %s", event)
+            event = None
+            continue
+
+        head, _, value = line.partition(":")
+        prop, *raw_params = head.split(";")
+        prop = prop.upper()
+        if prop not in ("DTSTART", "DTEND", "SUMMARY", "ATTENDEE"):
+            continue
+        params = dict(p.partition("=")[::2] for p in raw_params)
+        if prop in ("DTSTART", "DTEND"):
+            key = (params.get("TZID"), params.get("VALUE"), value)
+            if key not in stamps:
+                stamps[key] = parse_ics_datetime(params, value)
+            event[prop] = stamps[key]
+        elif prop == "SUMMARY":
+            event[prop] = ics_unescape(value)
+        elif "ATTENDEE" not in event and params.get("CN"):
+            event[prop] = params["CN"].strip('"')
+    return rows
+
+
+AVAILABILITY_TEXT_PARSERS = {"csv": parse_availability_csv, "ics": parse_availability_ics}
+
+
+def parse_availability_text(binary_stream, kind, title):
+    """Parse a CSV or ICS upload straight from its stream; same shape as parse_availability_workbook."""
+    started = time.perf_counter()
+    stream = io.TextIOWrapper(binary_stream, encoding="utf-8-sig", errors="replace", newline="")
+    try:
+        rows = AVAILABILITY_TEXT_PARSERS[kind](stream)
+    finally:
+        stream.detach()
+    return [(title, rows, (time.perf_counter() - started) * 1000)]
+
+
+def import_rows(sheet_results):
+    """
+    (sheet, date, name, start time, end time) for each parsed row, converted
+    as it is read rather than copied into a second list; each distinct date
+    and time string is parsed once.
+    """
+    dates, times = {}, {}
+    for sheet_title, rows, _ in sheet_results:
+        for date_str, worker_name, start_str, end_str in rows:
+            if date_str not in dates:
+                dates[date_str] = date.fromisoformat(date_str)
+            for value in (start_str, end_str):
+                if value not in times:
+                    times[value] = dt_time.fromisoformat(value)
+            yield sheet_title, dates[date_str], worker_name, times[start_str], times[end_str]
+
+
+def apply_availability_import(sheet_results, site, dry_run=False):
+    """
+    Write the parsed rows of [(sheet, rows, ms)] to the site's matching
+    workers. A shift that ends before it starts ends the next day.
+    Raises StaleDataError if another writer committed first; the caller retries.
+    Returns (updates, unchanged, changes per worker, unmatched names).
+    """
+    # Resolve every name in one indexed query instead of one lookup per row
+    workers_by_key = find_workers_by_names((row[1] for _, rows, _ in sheet_results for row in rows), site)
+    unmatched = {}
+
+    # Group the imported shifts per worker and date (a later row for the same date wins)
+    incoming_by_worker = {}
+    for sheet_title, target_date, worker_name, start_t, end_t in import_rows(sheet_results):
+        existing_worker = workers_by_key.get(normalize_name(worker_name))
+        if not existing_worker:
+            row_log.debug("Worker not found in DB: %s", worker_name)
+            unmatched.setdefault(worker_name, [])
+            continue
+
+        # Build datetimes on sheet's target_date using Europe/London timezone
+        start_datetime = datetime.combine(target_date, start_t).replace(tzinfo=IMPORT_TIMEZONE)
+        end_datetime   = datetime.combine(target_date, end_t).replace(tzinfo=IMPORT_TIMEZONE)
+        if end_datetime < start_datetime:
+            end_datetime += timedelta(days=1)  # overnight shift
+
+        incoming_by_worker.setdefault(existing_worker, {})[target_date] = {
+            "start": start_datetime.isoformat(),
+            "end": end_datetime.isoformat(),
+            "late": False
+        }
+
+    # Diff against what is stored and only write workers whose shifts changed
+    changes_by_worker = {}
+    changed_workers = []
+    updated_count = 0
+    unchanged_count = 0
+    for existing_worker, incoming in incoming_by_worker.items():
+        try:
+            updated_availability, changes = diff_availability(existing_worker.availability, incoming)
+        except Exception as parse_err:
+            logging.warning("Could not save times for %s: %s", existing_worker.name, parse_err)
+            continue
+
+        changed_entries = len(changes["added"]) + len(changes["changed"])
+        unchanged_count += len(incoming) - changed_entries
+        if updated_availability is None:
+            continue
+
+        changes_by_worker[existing_worker.name] = changes
+        updated_count += changed_entries
+        if not dry_run:
+            existing_worker.availability = updated_availability
+            changed_workers.append(existing_worker)
+
+    # Commit once after processing all sheets (reduces I/O); a dry run writes nothing
+    if dry_run:
+        db.session.rollback()
+    elif changed_workers:
+        record_worker_changes(changed_workers, "update", source="import")
+        db.session.commit()
+
+    return updated_count, unchanged_count, changes_by_worker, unmatched
+
+
+# ---- columnar availability store ----
+
+def roles_mask(roles):
+    """Bitmask of the trainings in a worker's roles list."""
+    return sum(bit for training, bit in TRAINING_BITS.items() if training in (roles or ()))
+
+
+def to_epoch_minutes(value):
+    """ISO timestamp -> minutes since the epoch (naive values are local time)."""
+    dt = parse_timestamp(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=TIMEZONE)
+    return int(dt.timestamp()) // 60
+
+
+def from_epoch_minutes(minutes, tz=TIMEZONE):
+    return datetime.fromtimestamp(int(minutes) * 60, tz)
+
+
+class RosterWorker(namedtuple("RosterWorker", "id name mask start end late")):
+    """
+    One worker on a day's roster: id, name, trainings bitmask and the one
+    shift that put them there (epoch minutes). No per-instance dict, and
+    hashing/equality only touch ints, a str and a bool.
+    """
+    __slots__ = ()
+
+    def trained(self, training):
+        return bool(self.mask & TRAINING_BITS[training])
+
+
+class AvailabilitySnapshot(namedtuple(
+    "AvailabilitySnapshot", "start end worker late mask local_day local_start workers"
+)):
+    """
+    One generation of a site's shifts, in parallel read-only NumPy arrays
+    (epoch-minute start/end, worker id, late flag, roles mask, local day and
+    local start minute) plus {worker id: (name, roles mask)}. Never changed
+    after it is built, so a reader holding one can't see half a refresh.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, columns, workers):
+        for column in columns:
+            column.flags.writeable = False
+        return cls(*columns, workers)
+
+    @classmethod
+    def empty(cls):
+        return cls.build(
+            [np.empty(0, dtype=dtype) for dtype in (np.int64, np.int64, np.int64, bool, np.int64, np.int64, np.int64)],
+            {},
+        )
+
+    def worker_info(self, wid):
+        return self.workers[wid]
+
+    def overlapping(self, lo, hi):
+        """Indices of shifts overlapping [lo, hi) epoch minutes."""
+        return np.flatnonzero((self.start < hi) & (self.end > lo))
+
+    def on_utc_date(self, day):
+        """Indices of shifts whose UTC start date <= day <= UTC end date."""
+        day_start = int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp()) // 60
+        return np.flatnonzero((self.start < day_start + 1440) & (self.end >= day_start))
+
+    def on_local_days(self, first_day, last_day):
+        """Indices of shifts starting on local days first_day..last_day (inclusive)."""
+        return np.flatnonzero((self.local_day >= first_day.toordinal()) & (self.local_day <= last_day.toordinal()))
+
+    def first_per_worker(self, idx):
+        """Keep only each worker's first shift among `idx` (idx must be ascending)."""
+        _, first = np.unique(self.worker[idx], return_index=True)
+        return idx[np.sort(first)]
+
+    def roster(self, day):
+        """
+        Workers available on `day` (UTC date, as the planner has always used),
+        split into (early, late) lists of RosterWorker in worker id order.
+        """
+        early, late = [], []
+        for i in self.first_per_worker(self.on_utc_date(day)):
+            wid = int(self.worker[i])
+            name, mask = self.workers[wid]
+            record = RosterWorker(wid, name, mask, int(self.start[i]), int(self.end[i]), bool(self.late[i]))
+            (late if record.late else early).append(record)
+        return early, late
+
+
+class AvailabilityStore:
+    """
+    In-process columnar copy of one site's worker shifts, so day and range
+    queries are vectorized instead of re-parsing ISO strings per request.
+
+    refresh() compares worker versions with the database, only re-reads the
+    workers that were created, changed or deleted since the last refresh, and
+    publishes the result as a new AvailabilitySnapshot by swapping a single
+    reference. Readers use the snapshot refresh() returns, never the store.
+    """
+
+    def __init__(self, site=DEFAULT_SITE):
+        self.site = site
+        self._lock = threading.Lock()
+        self._versions = {}  # worker id -> version currently loaded
+        self._workers = {}  # worker id -> (name, roles mask)
+        self._segments = {}  # worker id -> per-column arrays for that worker
+        self.snapshot = AvailabilitySnapshot.empty()
+
+    def refresh(self):
+        """Bring the store up to date with the database; returns the current snapshot."""
+        with self._lock:
+            current = dict(db.session.query(Worker.id, Worker.version).filter(Worker.site_id == self.site).all())
+            changed = [wid for wid, version in current.items() if self._versions.get(wid) != version]
+            removed = [wid for wid in self._versions if wid not in current]
+            if not changed and not removed:
+                return self.snapshot
+
+            for wid in removed:
+                self._versions.pop(wid, None)
+                self._workers.pop(wid, None)
+                self._segments.pop(wid, None)
+
+            for i in range(0, len(changed), 500):
+                rows = db.session.query(
+                    Worker.id, Worker.name, Worker.roles, Worker.availability, Worker.version
+                ).filter(Worker.id.in_(changed[i:i + 500])).all()
+                for wid, name, roles, availability, version in rows:
+                    self._load_worker(wid, name, roles, availability)
+                    self._versions[wid] = version
+
+            self.snapshot = self._build_snapshot()
+            logging.debug("Availability store refreshed: %d changed, %d removed, %d shifts", len(changed), len(removed), len(self.snapshot.start))
+            return self.snapshot
+
+    def _load_worker(self, wid, name, roles, availability):
+        mask = roles_mask(roles)
+        self._workers[wid] = (name, mask)
+
+        starts, ends, lates, days, minutes = [], [], [], [], []
+        for entry in availability or ():
+            try:
+                start = to_epoch_minutes(entry["start"])
+                end = to_epoch_minutes(entry["end"])
+            except Exception as e:
+                logging.error("Error parsing availability for worker %s: %s", name, e)
+                continue
+            local = from_epoch_minutes(start)
+            starts.append(start)
+            ends.append(end)
+            lates.append(bool(entry.get("late", False)))
+            days.append(local.toordinal())
+            minutes.append(local.hour * 60 + local.minute)
+
+        n = len(starts)
+        self._segments[wid] = (
+            np.array(starts, dtype=np.int64),
+            np.array(ends, dtype=np.int64),
+            np.full(n, wid, dtype=np.int64),
+            np.array(lates, dtype=bool),
+            np.full(n, mask, dtype=np.int64),
+            np.array(days, dtype=np.int64),
+            np.array(minutes, dtype=np.int64),
+        )
+
+    def _build_snapshot(self):
+        if not self._segments:
+            return AvailabilitySnapshot.empty()
+        # worker id order, then each worker's own entry order (matches the ORM loop it replaces)
+        segments = [self._segments[wid] for wid in sorted(self._segments)]
+        return AvailabilitySnapshot.build([np.concatenate(col) for col in zip(*segments)], dict(self._workers))
+
+
+availability_stores = {}  # site -> AvailabilityStore, so no site pays for another's workers
+availability_stores_lock = threading.Lock()
+
+
+def get_availability_store(site):
+    """A current AvailabilitySnapshot of the site's shifts (its store is created on first use)."""
+    with availability_stores_lock:
+        store = availability_stores.get(site)
+        if store is None:
+            store = availability_stores[site] = AvailabilityStore(site)
+    return store.refresh()
+
+
+def staffing_coverage(snapshot, first_day, last_day):
+    """
+    Headcount per day and half-hour slot, vectorized over every shift in range.
+    A worker counts for a slot when one of their shifts that day covers the
+    whole half hour; several shifts on one day are merged so nobody counts twice.
+    Returns (total, {training: {"early": counts, "late": counts}}), each a
+    (days, slots) int array.
+    """
+    n_days = last_day.toordinal() - first_day.toordinal() + 1
+    n_slots = len(COVERAGE_SLOTS)
+    total = np.zeros((n_days, n_slots), dtype=np.int64)
+    by_training = {
+        t: {"early": np.zeros_like(total), "late": np.zeros_like(total)} for t in TRAININGS
+    }
+
+    idx = snapshot.on_local_days(first_day, last_day)
+    if not len(idx):
+        return total, by_training
+
+    day = snapshot.local_day[idx] - first_day.toordinal()
+    start = snapshot.local_start[idx]
+    end = start + (snapshot.end[idx] - snapshot.start[idx])
+    covers = (start[:, None] <= COVERAGE_SLOTS) & (end[:, None] >= COVERAGE_SLOTS + 30)
+
+    # merge shifts per (day, worker): sort by key, OR the slot rows of each group
+    key = day * (int(snapshot.worker[idx].max()) + 1) + snapshot.worker[idx]
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    heads = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    covers = np.logical_or.reduceat(covers[order], heads, axis=0)
+    day = day[order][heads]
+    mask = snapshot.mask[idx][order][heads]
+    late = snapshot.late[idx][order][heads]
+
+    def count(selected):
+        rows, slots = np.nonzero(covers[selected])
+        flat = day[selected][rows] * n_slots + slots
+        return np.bincount(flat, minlength=n_days * n_slots).reshape(n_days, n_slots)
+
+    total[:] = count(np.ones(len(day), dtype=bool))
+    for training, bit in TRAINING_BITS.items():
+        trained = (mask & bit) != 0
+        by_training[training]["early"][:] = count(trained & ~late)
+        by_training[training]["late"][:] = count(trained & late)
+    return total, by_training
+
+
 # API endpoint to get all workers
 @app.route("/workers", methods=["GET"])
 def get_all_workers():
+    """?role=ICA (repeatable, or comma-separated) keeps only workers with all of those trainings."""
     try:
-        workers = Worker.query.all()
-        workers_list = [
-            {
-                "id": worker.id,
-                "name": worker.name,
-                "roles": worker.roles,
-                "availability": worker.availability
-            }
-            for worker in workers
-        ]
-        logging.info("Fetched all workers successfully.")
-        return jsonify({"workers": workers_list}), 200
+        trainings = [t.strip() for value in request.args.getlist("role") for t in value.split(",") if t.strip()]
+        unknown = [t for t in trainings if t not in TRAINING_BITS]
+        if unknown:
+            return jsonify({"error": f"Unknown role {unknown[0]!r}; expected one of {', '.join(TRAININGS)}"}), 400
+
+        def build():
+            query = Worker.query.filter_by(site_id=g.site_id).order_by(Worker.id)
+            if trainings:
+                query = query.filter(Worker.with_trainings(*trainings))
+            workers = query.all()
+            log_summary(workers=len(workers))
+            return {"workers": [worker.to_dict() for worker in workers]}
+
+        return cached_json(("workers",), ",".join(sorted(set(trainings))), build), 200
     except Exception as e:
-        logging.error(f"Error fetching workers: {e}")
+        logging.error("Error fetching workers: %s", e)
         return jsonify({"error": str(e)}), 500
     
-@app.route('/upload-excel', methods=['POST'])
-def upload_excel():
-    try:
-        file = request.files['file']
-        if not file:
-            return jsonify({'error': 'No file provided'}), 400
+EXPORT_COLUMNS = ["id", "name", "roles", "start", "end", "late"]
+EXPORT_MIMETYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
 
-        filename = file.filename
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
 
-        return jsonify({'message': f'File {filename} uploaded successfully'}), 200
-    except Exception as e:
-        logging.error(f"Error uploading file: {e}")
-        return jsonify({'error': str(e)}), 500
+def iter_worker_rows(site):
+    """(id, name, roles, availability) for every worker of a site, from a server-side cursor in batches."""
+    stmt = (
+        select(Worker.id, Worker.name, Worker.roles, Worker.availability)
+        .where(Worker.site_id == site)
+        .order_by(Worker.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    yield from db.session.execute(stmt)
+
+
+def iter_shift_rows(site):
+    """One flat row per availability entry; workers without any get one row with blank times."""
+    for worker_id, name, roles, availability in iter_worker_rows(site):
+        roles = ", ".join(roles or [])
+        if not availability:
+            yield [worker_id, name, roles, "", "", ""]
+        for a in availability or []:
+            yield [worker_id, name, roles, a.get("start", ""), a.get("end", ""), bool(a.get("late", False))]
+
+
+def export_csv(site):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for count, row in enumerate(iter_shift_rows(site), start=1):
+        writer.writerow(row)
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_jsonl(site):
+    lines = []
+    for worker_id, name, roles, availability in iter_worker_rows(site):
+        lines.append(app.json.dumps(
+            {"id": worker_id, "name": name, "roles": roles, "availability": availability}
+        ))
+        if len(lines) == EXPORT_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def export_xlsx(site):
+    """
+    openpyxl's write-only mode streams rows to a temp file instead of holding
+    the sheet in memory. An xlsx is a zip whose index comes last, so the file
+    is only sent once it is complete.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Availability")
+    sheet.append(EXPORT_COLUMNS)
+    for row in iter_shift_rows(site):
+        sheet.append(row)
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+# API endpoint to export every worker of the site and their availability
+@app.route("/workers/export", methods=["GET"])
+def export_workers():
+    export_format = request.args.get("format", "csv").lower()
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({"error": "format must be csv, xlsx or jsonl"}), 400
+    filename = f"workers-{datetime.now(TIMEZONE):%Y%m%d}.{export_format}"
 
-@app.route('/upload-worker-availability', methods=['POST'])
-def upload_worker_availability():
     try:
-        file = request.files['file']
-        if not file:
-            return jsonify({'error': 'No file provided'}), 400
-
-        workbook = openpyxl.load_workbook(file)
-
-        # --- Helper: robust time-range parser (handles -, – , —, spaces, 24h and 12h AM/PM) ---
-        DASH_PATTERN = r"[-–—]"  # hyphen, en dash, em dash
-
-        def parse_time_range(cell_val):
-            """
-            Accepts strings like '08:00 - 16:00', '08:00–16:00', '8:00 AM — 4:30 PM'.
-            Returns (start_time, end_time) as datetime.time.
-            """
-            s = str(cell_val).strip()
-
-            m = re.search(rf"(\d{{1,2}}:\d{{2}})\s*{DASH_PATTERN}\s*(\d{{1,2}}:\d{{2}})", s)
-            if m:
-                t1 = datetime.strptime(m.group(1), "%H:%M").time()
-                t2 = datetime.strptime(m.group(2), "%H:%M").time()
-                return t1, t2
-
-            m = re.search(rf"(\d{{1,2}}:\d{{2}}\s*[APap][Mm])\s*{DASH_PATTERN}\s*(\d{{1,2}}:\d{{2}}\s*[APap][Mm])", s)
-            if m:
-                t1 = datetime.strptime(m.group(1).upper(), "%I:%M %p").time()
-                t2 = datetime.strptime(m.group(2).upper(), "%I:%M %p").time()
-                return t1, t2
-
-            raise ValueError(f"Unrecognized time range: {cell_val!r}")
-
-        all_results = []  # collects a summary across all sheets
-        updated_count = 0  # counter of DB updates
-
-        # Process ALL worksheets in the file
-        for sheet in workbook.worksheets:
-            logging.info(f"🔎 Processing sheet: {sheet.title}")
-
-            # Step 1: Extract date from B22 area on this sheet
-            target_date = None
-            for row in sheet.iter_rows(min_row=22, max_row=22):
-                for cell in row:
-                    if cell.value and isinstance(cell.value, str) and re.search(r"\d{2}/\d{2}/\d{4}", cell.value):
-                        match = re.search(r"\d{2}/\d{2}/\d{4}", cell.value)
-                        if match:
-                            target_date = datetime.strptime(match.group(), "%d/%m/%Y")
-                            break
-                if target_date:
-                    break
+        if export_format == "xlsx":
+            return send_file(
+                export_xlsx(g.site_id), as_attachment=True, download_name=filename,
+                mimetype=EXPORT_MIMETYPES["xlsx"],
+            )
+
+        body = export_csv(g.site_id) if export_format == "csv" else export_jsonl(g.site_id)
+        return Response(
+            stream_with_context(body),
+            mimetype=EXPORT_MIMETYPES[export_format],
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+    except Exception as e:
+        logging.error("Error exporting workers: %s", e)
+        return jsonify({"error": str(e)}), 500
 
-            if not target_date:
-                logging.warning(f"⚠️ Skipping sheet '{sheet.title}' — no date found on row 22.")
-                continue  # move to next sheet
 
-            # Step 2: Collect names and times from row 24 down on this sheet
-            for i, row in enumerate(sheet.iter_rows(min_row=24), start=24):
-                name_cell = row[1] if len(row) > 1 else None  # Column B
-                time_cell = None
+def worker_changes_payload(since, site):
+    """Body of /workers/changes and of each change-stream event."""
+    cursor, upserts, deleted, reset = worker_changes_since(since, site)
+    return {
+        "version": cursor,
+        "reset": reset,
+        "workers": [worker.to_dict() for worker in upserts],
+        "deleted": deleted,
+    }
 
-                # Check columns D, E, F for a single-cell range first
-                for idx in [3, 4, 5]:
-                    if len(row) > idx and row[idx].value:
-                        time_cell = row[idx]
-                        break
 
-                logging.info(f"[{sheet.title}] Row {i} -> name: {name_cell.value if name_cell else 'None'}, time: {time_cell.value if time_cell else 'None'}")
+# API endpoint for the worker change feed: what changed after a cursor
+@app.route("/workers/changes", methods=["GET"])
+def get_worker_changes():
+    try:
+        since = request.args.get("since", default=0, type=int)
+        return jsonify(worker_changes_payload(since, g.site_id)), 200
+    except Exception as e:
+        logging.error("Error fetching worker changes: %s", e)
+        return jsonify({"error": str(e)}), 500
 
-                if not (name_cell and name_cell.value):
-                    continue
 
-                worker_name = str(name_cell.value).strip()
-
-                # Try single-cell time range first
-                start_t = end_t = None
-                if time_cell and time_cell.value:
-                    try:
-                        start_t, end_t = parse_time_range(time_cell.value)
-                    except Exception as parse_err:
-                        logging.debug(f"[{sheet.title}] Single-cell time parse failed at row {i}: {parse_err}")
-
-                # Fallback: if range not found in one cell, try separate start/end in D and E
-                if (start_t is None or end_t is None):
-                    start_cell = row[3] if len(row) > 3 else None  # col D
-                    end_cell   = row[4] if len(row) > 4 else None  # col E
-
-                    def to_time(val):
-                        """
-                        Convert an Excel cell value into datetime.time if possible.
-                        Handles datetime, time, 'HH:MM', and 'HH:MM AM/PM'.
-                        """
-                        if val is None:
-                            return None
-                        if isinstance(val, datetime):
-                            return val.time()
-                        try:
-                            from datetime import time as _time
-                            if isinstance(val, _time):
-                                return val
-                        except Exception:
-                            pass
-                        if isinstance(val, str):
-                            s = val.strip().upper()
-                            try:
-                                return datetime.strptime(s, "%H:%M").time()
-                            except ValueError:
-                                pass
-                            try:
-                                return datetime.strptime(s, "%I:%M %p").time()
-                            except ValueError:
-                                return None
-                        return None
-
-                    if start_cell and end_cell:
-                        start_t = to_time(start_cell.value)
-                        end_t = to_time(end_cell.value)
-
-                if not (start_t and end_t):
-                    # Nothing parseable on this row; continue to next row
-                    continue
+# Server-Sent Events version of /workers/changes. Each event carries the same
+# payload; the stream ends after CHANGE_STREAM_MAX_SECONDS and EventSource
+# reconnects with Last-Event-ID, so a stream never outlives the worker timeout.
+@app.route("/workers/changes/stream", methods=["GET"])
+def stream_worker_changes():
+    since = request.headers.get("Last-Event-ID", request.args.get("since", 0))
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        return jsonify({"error": "since must be an integer"}), 400
+
+    def events(since, site):
+        deadline = time.monotonic() + CHANGE_STREAM_MAX_SECONDS
+        first = True
+        yield "retry: 2000\n\n"
+        while time.monotonic() < deadline:
+            payload = worker_changes_payload(since, site)
+            if first or payload["version"] != since:
+                yield f"id: {payload['version']}\nevent: changes\ndata: {app.json.dumps(payload)}\n\n"
+                since = payload["version"]
+                first = False
+            else:
+                yield ": keep-alive\n\n"
+            db.session.remove()  # don't sit in a transaction between polls
+            time.sleep(CHANGE_STREAM_POLL_SECONDS)
+
+    return Response(
+        stream_with_context(events(since, g.site_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-                # Record for response logging (keeps your existing behavior)
-                time_range_display = f"{start_t.strftime('%H:%M')} - {end_t.strftime('%H:%M')}"
-                all_results.append({"sheet": sheet.title, "name": worker_name, "time": time_range_display, "date": target_date.strftime("%Y-%m-%d")})
-
-                # Update each worker's availability in the database (per-sheet date)
-                existing_worker = Worker.query.filter_by(name=worker_name).first()
-                if existing_worker:
-                    try:
-                        # Build datetimes on sheet's target_date using Europe/London timezone
-                        start_datetime = datetime.combine(target_date.date(), start_t).replace(tzinfo=ZoneInfo("Europe/London"))
-                        end_datetime   = datetime.combine(target_date.date(), end_t).replace(tzinfo=ZoneInfo("Europe/London"))
-
-                        new_availability = {
-                            "start": start_datetime.isoformat(),
-                            "end": end_datetime.isoformat(),
-                            "late": False
-                        }
-
-                        # Remove existing availability for this date (if any), then append
-                        updated_availability = [
-                            a for a in existing_worker.availability
-                            if parser.parse(a["start"]).date() != target_date.date()
-                        ]
-                        updated_availability.append(new_availability)
-                        existing_worker.availability = updated_availability
-
-                        updated_count += 1
-                    except Exception as parse_err:
-                        logging.warning(f" Could not save time for {worker_name} (sheet '{sheet.title}', row {i}): {parse_err}")
-                else:
-                    logging.warning(f" Worker not found in DB: {worker_name}")
+@app.route('/upload-excel', methods=['POST'])
+def upload_excel():
+    file = uploaded_file()
+    if file is None:
+        return jsonify({'error': 'No file provided'}), 400
+    filename = os.path.basename(file.filename or "")
+    if not filename:
+        return jsonify({'error': 'File name is required'}), 400
+    validate_xlsx(file.stream.path)
 
-        # Commit once after processing all sheets (reduces I/O)
-        db.session.commit()
+    try:
+        template, deduplicated = store_template(file.stream, filename, g.site_id)
+
+        return jsonify({
+            'message': f'File {filename} uploaded successfully',
+            'template': template.to_dict(),
+            'deduplicated': deduplicated,
+        }), 200
+    except Exception as e:
+        db.session.rollback()
+        logging.error("Error uploading file: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload-worker-availability', methods=['POST'])
+def upload_worker_availability():
+    file = uploaded_file()
+    if file is None:
+        return jsonify({'error': 'No file provided'}), 400
+    import_format = availability_import_format(file.filename, request.values.get("format"))
+    if import_format == "xlsx":
+        validate_xlsx(file.stream.path)
+
+    try:
+        # dry_run=true previews the diff without writing anything; force=true
+        # re-imports a file even when this exact upload was already applied
+        dry_run = str(request.values.get("dry_run", "")).lower() in ("1", "true", "yes")
+        force = str(request.values.get("force", "")).lower() in ("1", "true", "yes")
+
+        # UploadSpool already has the upload on disk, hashed, so parse tasks can each open their own sheet
+        upload_path, upload_sha256 = file.stream.path, file.stream.sha256
+        previous = None if dry_run or force else previous_import(g.site_id, upload_sha256, import_format)
+        if previous is not None:
+            log_summary(format=import_format, duplicate=True)
+            return jsonify({
+                **previous.result,
+                "duplicate": True,
+                "imported_at": previous.imported_at.isoformat(),
+            }), 200
+
+        parse_started = time.perf_counter()
+        if import_format != "xlsx":
+            # a CSV or iCalendar file is a single "sheet", keyed by the file hash
+            title = file.filename or import_format
+            with open(upload_path, "rb") as stream:
+                try:
+                    sheet_results, cached_sheets = parse_with_sheet_cache(
+                        import_format, {title: upload_sha256},
+                        lambda titles: parse_availability_text(stream, import_format, title),
+                    )
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+        else:
+            try:
+                sheet_hashes = workbook_sheet_hashes(upload_path)
+            except (zipfile.BadZipFile, ElementTree.ParseError, KeyError, IndexError, ValueError, StopIteration):
+                sheet_hashes = None  # not a workbook we can read directly; let openpyxl say why
+            if sheet_hashes is None:
+                sheet_results, cached_sheets = parse_availability_workbook(upload_path), []
+            else:
+                sheet_results, cached_sheets = parse_with_sheet_cache(
+                    import_format, sheet_hashes, lambda titles: parse_availability_workbook(upload_path, titles)
+                )
+        parse_ms = (time.perf_counter() - parse_started) * 1000
+
+        # Per-row summary for the response, in workbook order (keeps your existing behavior)
+        all_results = [
+            {"sheet": sheet_title, "name": worker_name, "time": f"{start_str} - {end_str}", "date": date_str}
+            for sheet_title, rows, _ in sheet_results
+            for date_str, worker_name, start_str, end_str in rows
+        ]
 
-        # Log the parsed availability (across all sheets)
-        logging.info(" Parsed worker availability from Excel (all sheets):")
+        # Resolve, diff and commit; retried from a fresh read if a concurrent
+        # edit bumps a worker's version between our read and our write
+        since = change_cursor(g.site_id)
+        for attempt in range(1, IMPORT_MAX_RETRIES + 1):
+            try:
+                updated_count, unchanged_count, changes_by_worker, unmatched = apply_availability_import(sheet_results, g.site_id, dry_run)
+                break
+            except StaleDataError as conflict:
+                db.session.rollback()
+                if attempt == IMPORT_MAX_RETRIES:
+                    return jsonify({'error': 'Availability changed during import, please retry', 'detail': str(conflict)}), 409
+                logging.warning("Import conflicted with a concurrent edit (attempt %s), retrying", attempt)
+
+        # Suggest close matches for names that didn't resolve (one index for the whole upload)
+        if unmatched and FUZZY_NAME_SUGGESTIONS:
+            trigram_index = NameTrigramIndex.from_db(g.site_id)
+            for worker_name in unmatched:
+                unmatched[worker_name] = trigram_index.suggest(worker_name)
+
+        # Per-row lines are sampled; the request summary carries the totals
         for entry in all_results:
-            logging.info(f"[{entry['sheet']}] {entry['date']} — {entry['name']} - {entry['time']}")
-        logging.info(f"Total availability updates: {updated_count}")
+            row_log.debug("[%s] %s — %s - %s", entry['sheet'], entry['date'], entry['name'], entry['time'])
+        log_summary(
+            format=import_format, dry_run=dry_run, sheets=len(sheet_results), rows=len(all_results),
+            cached_sheets=len(cached_sheets), updates=updated_count, unchanged=unchanged_count,
+            unmatched=len(unmatched), parse_ms=round(parse_ms, 1),
+        )
 
         # Build response summary by date/sheet
-        return jsonify({
+        result = {
+            "format": import_format,
+            "dry_run": dry_run,
+            "duplicate": False,
+            "parse_workers": import_pool_size(len(sheet_results) - len(cached_sheets)),
+            "parse_ms": round(parse_ms, 1),
+            "sheets": [
+                {"sheet": title, "rows": len(rows), "parse_ms": round(ms, 1), "cached": title in cached_sheets}
+                for title, rows, ms in sheet_results
+            ],
             "updates": updated_count,
-            "entries": all_results
-        }), 200
+            "unchanged": unchanged_count,
+            "changes": changes_by_worker,
+            "entries": all_results,
+            "unmatched": [
+                {"name": name, "suggestions": suggestions}
+                for name, suggestions in unmatched.items()
+            ],
+        }
+        if not dry_run:
+            record_import(g.site_id, upload_sha256, import_format, result, since, writes=len(changes_by_worker))
+        return jsonify(result), 200
 
     except Exception as e:
-        logging.error(f" Error parsing availability upload: {e}")
+        logging.error("Error parsing availability upload: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -295,110 +2853,178 @@ def upload_worker_availability():
 @app.route('/list-templates', methods=['GET'])
 def list_templates():
     try:
-        files = os.listdir(UPLOAD_FOLDER)
-        logging.debug(f"Templates found: {files}")
-        return jsonify({'templates': files}), 200
+        # served from the index; nothing on disk is read per request
+        def build():
+            templates = Template.query.filter_by(site_id=g.site_id).order_by(Template.name).all()
+            logging.debug("Templates found: %d", len(templates))
+            return {
+                'templates': [t.name for t in templates],
+                'details': [t.to_dict() for t in templates],
+            }
+
+        return cached_json(("templates",), "", build), 200
     except Exception as e:
-        logging.error(f"Error listing templates: {e}")
+        logging.error("Error listing templates: %s", e)
         return jsonify({'error': str(e)}), 500
 
-# API endpoint to generate the schedule and save to Excel
-@app.route('/generate-schedule', methods=['POST'])
-def generate_schedule():
+# API endpoint to set (or, with null, reset) a template's slot and rotation rules
+@app.route('/templates/<path:name>/rotation', methods=['PUT'])
+def set_template_rotation(name):
     try:
-        selected_file = request.json.get('template')
-        selected_date_str = request.json.get('date')  # Get selected date from request
-
-        ica_morning_count = request.json.get("ica_morning_count", 4)
-        ica_afternoon_count = request.json.get("ica_afternoon_count", 4)
-
-        # Clamp values to stay between 2 and 4
-        ica_morning_count = max(2, min(4, int(ica_morning_count)))
-        ica_afternoon_count = max(2, min(4, int(ica_afternoon_count)))
-
-        # option to extend non-ICA printing to 4pm, 5pm, or 6pm
-        print_until_hour = int(request.json.get("print_until_hour", 16))
-        if print_until_hour not in (16, 17, 18):
-            print_until_hour = 16
-
-        # Reset all stateful variables to prevent carryover issues
-        valid_roles = {}
-        used_workers = set()
-        afternoon_valid_roles = {}  
-        afternoon_used_workers = set()
-        course_workers = []  # Ensures fresh assignment
-        morning_assignments = {}  # Ensures morning roles are properly tracked
-
-        # Validate input
-        if not selected_file:
-            return jsonify({'error': 'Template is required'}), 400
-        if not selected_date_str:
-            return jsonify({'error': 'Date is required'}), 400
+        template = Template.query.filter_by(site_id=g.site_id, name=name).first()
+        if not template:
+            return jsonify({'error': 'Template not found'}), 404
+
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or "rotation" not in body:
+            return jsonify({'error': 'rotation is required; send {"rotation": null} to reset to the default layout'}), 400
+        rotation = body["rotation"]
+        if rotation is not None:
+            # compile once for every cutoff so a bad layout is rejected here, not at generation time
+            try:
+                check_rotation(rotation)
+                for hour in (16, 17, 18):
+                    SlotProgram(rotation, template.role_columns, hour)
+            except ValueError as e:
+                return jsonify({'error': f'Invalid rotation: {e}'}), 400
+
+        template.rotation = rotation
+        invalidate_after_commit("templates", g.site_id)
+        db.session.commit()
+        return jsonify(template.to_dict()), 200
+    except Exception as e:
+        db.session.rollback()
+        logging.error("Error updating rotation for template %s: %s", name, e)
+        return jsonify({'error': str(e)}), 500
 
+@app.route('/coverage', methods=['GET'])
+def coverage():
+    try:
+        started = time.perf_counter()
         try:
-            selected_date = datetime.strptime(selected_date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            first_day = datetime.strptime(request.args.get("start", ""), "%Y-%m-%d").date()
+            last_day = datetime.strptime(request.args.get("end") or request.args.get("start", ""), "%Y-%m-%d").date()
         except ValueError:
-            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+            return jsonify({'error': 'start and end are required as YYYY-MM-DD'}), 400
+        if last_day < first_day:
+            return jsonify({'error': 'end must not be before start'}), 400
+        if (last_day - first_day).days >= COVERAGE_MAX_DAYS:
+            return jsonify({'error': f'Range is limited to {COVERAGE_MAX_DAYS} days'}), 400
+
+        # Roles the template needs, per training (from the template index, not the file)
+        required = None
+        template_name = request.args.get("template")
+        if template_name:
+            template = Template.query.filter_by(site_id=g.site_id, name=template_name).first()
+            if not template:
+                return jsonify({'error': 'Selected template not found'}), 404
+            required = {
+                training: sum(1 for role in roles if role in template.role_columns)
+                for training, roles in ROLE_TO_TRAINING.items()
+            }
 
-        selected_date = datetime.strptime(selected_date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)  # ⬅️ Convert to datetime
-        if not selected_file:
-            return jsonify({'error': 'No template selected'}), 400
+        total, by_training = staffing_coverage(get_availability_store(g.site_id), first_day, last_day)
+
+        days = []
+        for offset in range(total.shape[0]):
+            day = {
+                "date": date.fromordinal(first_day.toordinal() + offset).isoformat(),
+                "total": total[offset].tolist(),
+                "by_training": {
+                    training: {kind: counts[offset].tolist() for kind, counts in split.items()}
+                    for training, split in by_training.items()
+                },
+            }
+            if required is not None:
+                # negative means fewer trained people in than the template has columns for
+                day["gap"] = {
+                    training: (split["early"][offset] + split["late"][offset] - required[training]).tolist()
+                    for training, split in by_training.items()
+                }
+            days.append(day)
 
-        filepath = os.path.join(UPLOAD_FOLDER, selected_file)
-        if not os.path.exists(filepath):
-            return jsonify({'error': 'Selected template not found'}), 404
+        return jsonify({
+            "start": first_day.isoformat(),
+            "end": last_day.isoformat(),
+            "slots": [f"{m // 60:02d}:{m % 60:02d}" for m in COVERAGE_SLOTS.tolist()],
+            "template": template_name,
+            "required": required,
+            "days": days,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }), 200
+    except Exception as e:
+        logging.error("Error computing coverage: %s", e)
+        return jsonify({'error': str(e)}), 500
 
-        # Fetch all workers from the database
-        workers = Worker.query.all()
+class DayPlanner:
+    """
+    Who takes each role for one day, independent of the workbook: the 9:00
+    assignments (assign_morning) and the 12:45 ones (assign_afternoon).
+    generate_schedule renders the result into the template; the absence
+    simulator runs it many times over reduced rosters.
+
+    `pick(candidates, role)` chooses among eligible workers and `kitup_key`
+    orders the Kit Up / Clip In queues, so callers decide how random or how
+    fair the choices are. A quiet planner logs nothing.
+    """
+
+    def __init__(self, in_today_workers, late_shift_workers, role_to_column,
+                 ica_morning_count=4, ica_afternoon_count=4, pick=None, kitup_key=None, quiet=False):
+        self.log = quiet_plan_log if quiet else plan_log
+        self.in_today_workers = in_today_workers
+        self.late_shift_workers = late_shift_workers
+        # candidates per training, split once from the roster's bitmasks (roster order kept)
+        self.trained_workers = {t: [w for w in in_today_workers + late_shift_workers if w.trained(t)] for t in TRAININGS}
+        self.trained_early = {t: [w for w in in_today_workers if w.trained(t)] for t in TRAININGS}
+        self.role_to_column = role_to_column
+        self.role_to_training = ROLE_TO_TRAINING
+        self.pick = pick or (lambda candidates, role: choice(candidates))
+        self.kitup_key = kitup_key or (lambda worker: 0)
+
+        self.valid_roles = {}  # morning role -> worker name
+        self.used_workers = set()
+        self.morning_assignments = {}  # worker name -> roles worked in the morning
+        self.morning_spare_workers = []
+        self.afternoon_valid_roles = {}  # Roles assigned in the afternoon
+        self.afternoon_used_workers = set()  # Workers used in the afternoon
+        self.afternoon_spare_workers = []
+        self.morning_slots = []  # per half-hour slot: role -> worker name
+        self.afternoon_slots = []
+
+        self.ica_roles_morning = [f"ICA {i}" for i in range(1, ica_morning_count + 1)]
+        self.ica_roles_afternoon = [f"ICA {i}" for i in range(1, ica_afternoon_count + 1)]
+
+        self.prioritized_roles_morning = (
+            self.ica_roles_morning +
+            [
+                'Mini Trek', 'Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1',
+                'TREE TREK 1', 'TREE TREK 2',
+                'Clip In 1', 'Clip In 2', 'Kit Up 3', 'Kit Up 2', 'Kit Up 1',
+            ]
+        )
 
-        # Separate workers into available and late-shift workers based on the selected date
-        in_today_workers = []
-        late_shift_workers = []
-        untrained_workers = []
+        # Only add 'Course Support 1' if it exists in the Excel file
+        if "Course Support 1" in role_to_column:
+            self.prioritized_roles_morning.insert(5, "Course Support 1")  # Insert at the correct position
 
-        for worker in workers:
-            for availability in worker.availability:
-                try:
-                    start = parser.parse(availability['start']).astimezone(timezone.utc)
-                    end = parser.parse(availability['end']).astimezone(timezone.utc)
-
-                    if start.date() <= selected_date.date() <= end.date():
-                        if bool(availability.get("late", False)):
-                            late_shift_workers.append(worker)
-                        else:
-                            in_today_workers.append(worker)
-
-                        # Check if worker is untrained
-                        if not any(role in worker.roles for role in ["KITUP", "AATT", "MT", "ICA"]):
-                            untrained_workers.append(worker)  # Store them separately
-                        break  # Stop checking once availability is confirmed
-                except Exception as e:
-                    logging.error(f"Error parsing availability for worker {worker.name}: {e}")
-
-
-        # Define role-to-training mapping
-        role_to_training = {
-            'KITUP': ['Host', 'Dekit', 'Kit Up 1', 'Kit Up 2', 'Kit Up 3', 'Clip In 1', 'Clip In 2'],
-            'AATT': ['TREE TREK 1', 'TREE TREK 2', 'Course Support 1', 'Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1'],
-            'MT': ['Mini Trek'],
-            'ICA': ['ICA 1', 'ICA 2', 'ICA 3', 'ICA 4']
-        }
+        # Ensure unassigned KITUP-trained workers are placed in Kit Up roles BEFORE Clip In or other roles
+        self.kitup_roles_priority = ['Kit Up 1', 'Kit Up 2']  # Highest priority
+        self.kitup_roles_secondary = ['Kit Up 3', 'Clip In 1', 'Clip In 2']  # Lower priority
 
-        # Dynamically map roles based on the Excel file
-        workbook = openpyxl.load_workbook(filepath)
-        sheet = workbook.active
-        role_to_column = {}
-        header_row = 1  
+        # Define role categories for clarity and maintainability
+        self.shed_roles = {'Host', 'Dekit', 'Kit Up 1', 'Kit Up 2', 'Kit Up 3', 'Clip In 1', 'Clip In 2'}
+        self.tree_trek_roles = {'TREE TREK 1', 'TREE TREK 2'}
+        self.course_roles = ['Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1']
 
-        for col in range(1, sheet.max_column + 1):
-            role = sheet.cell(row=header_row, column=col).value
-            if role:  # Skip empty cells
-                role_to_column[role.strip()] = col
+        # Only add 'Course Support 1' if it exists in the Excel file
+        if "Course Support 1" in role_to_column:
+            self.course_roles.insert(0, "Course Support 1")
 
-        ica_roles_morning = [f"ICA {i}" for i in range(1, ica_morning_count + 1)]
+        self.mini_trek_roles = {'Mini Trek'}
+        self.ica_roles = self.ica_roles_morning
 
-        prioritized_roles_morning = (
-            ica_roles_morning +
+        self.prioritized_roles_afternoon = (
+            self.ica_roles_afternoon +
             [
                 'Mini Trek', 'Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1',
                 'TREE TREK 1', 'TREE TREK 2',
@@ -408,786 +3034,1085 @@ def generate_schedule():
 
         # Only add 'Course Support 1' if it exists in the Excel file
         if "Course Support 1" in role_to_column:
-            prioritized_roles_morning.insert(5, "Course Support 1")  # Insert at the correct position
+            self.prioritized_roles_afternoon.insert(2, "Course Support 1")  # Put it with the other course roles
+
+    def get_eligible_workers(self, role):
+        self.log.debug("🔍 Role: %s | Eligible workers before filtering: %s", role, Lazy(lambda: [
+            w.name for w in self.in_today_workers + self.late_shift_workers if w.name not in self.used_workers
+        ]))
+
+        # KITUP Roles
+        if role in self.role_to_training['KITUP']:
+            return [
+                worker for worker in self.trained_workers['KITUP']
+                if worker.name not in self.used_workers
+            ]
 
-        valid_roles = {}
-        used_workers = set()
+        # AATT Roles
+        elif role in self.role_to_training['AATT']:
+            return [
+                worker for worker in self.trained_workers['AATT']
+                if worker.name not in self.used_workers
+            ]
 
-        def get_eligible_workers(role):
-            eligible = [
-                worker for worker in (in_today_workers + late_shift_workers)
-                if worker.name not in used_workers
+        # Mini Trek - Only early workers can be assigned
+        elif role in self.role_to_training['MT']:
+            return [
+                worker for worker in self.trained_early['MT']  # Only early workers
+                if worker.name not in self.used_workers
             ]
 
-            logging.debug(f"🔍 Role: {role} | Eligible workers before filtering: {[w.name for w in eligible]}")
+        # ICA - Only early workers can be assigned
+        elif role in self.role_to_training['ICA']:
+            return [
+                worker for worker in self.trained_early['ICA']  # Only early workers
+                if worker.name not in self.used_workers
+            ]
 
-            # KITUP Roles
-            if role in role_to_training['KITUP']:
-                return [
-                    worker for worker in (in_today_workers + late_shift_workers)
-                    if worker.name not in used_workers
-                    and 'KITUP' in worker.roles  # Must be trained in KITUP
-                ]
+        # RESTRICT LATE-SHIFT WORKERS from Course Support 2, Zip Top 1, Zip Top 2, and Zip Ground
+        elif role in ["Course Support 2", "Zip Top 1", "Zip Top 2", "Zip Ground"]:
+            return [
+                worker for worker in self.trained_early['AATT']  # ONLY early workers allowed
+                if worker.name not in self.used_workers
+            ]
 
-            # AATT Roles
-            elif role in role_to_training['AATT']:
-                return [
-                    worker for worker in (in_today_workers + late_shift_workers)
-                    if worker.name not in used_workers
-                    and 'AATT' in worker.roles  # Must be trained in AATT
-                ]
+        return []
 
-            # Mini Trek - Only early workers can be assigned
-            elif role in role_to_training['MT']:
-                return [
-                    worker for worker in in_today_workers  # Only early workers
-                    if worker.name not in used_workers
-                    and 'MT' in worker.roles  # Must be trained in Mini Trek
-                ]
+    def get_afternoon_eligible_workers(self, role):
+        eligible = [
+            worker for worker in (self.in_today_workers + self.late_shift_workers)
+            if worker.name not in self.afternoon_used_workers
+        ]
 
-            # ICA - Only early workers can be assigned
-            elif role in role_to_training['ICA']:
-                return [
-                    worker for worker in in_today_workers  # Only early workers
-                    if worker.name not in used_workers
-                    and 'ICA' in worker.roles  # Must be trained in ICA
-                ]
+        # Prefer different people for shed roles in the afternoon
+        if role in self.shed_roles:
+            # Try to avoid reusing the same person who did this role in the morning
+            preferred = [
+                worker for worker in eligible
+                if role not in self.morning_assignments.get(worker.name, [])
+            ]
+            if preferred:
+                eligible = preferred
+            else:
+                # Allow reuse only as fallback
+                self.log.warning("⚠️ No new workers for %s, reusing someone from the morning.", role)
 
-            # RESTRICT LATE-SHIFT WORKERS from Course Support 2, Zip Top 1, Zip Top 2, and Zip Ground
-            elif role in ["Course Support 2", "Zip Top 1", "Zip Top 2", "Zip Ground"]:
-                return [
-                    worker for worker in in_today_workers  # ONLY early workers allowed
-                    if worker.name not in used_workers
-                    and 'AATT' in worker.roles  # Must be trained in AATT
-                ]
+        if role in self.role_to_training['KITUP']:
+            eligible = [
+                worker for worker in eligible
+                if worker.trained('KITUP')  # Must be trained in KITUP
+            ]
 
-            return []
+        elif role in self.tree_trek_roles:
+            eligible = [
+                worker for worker in eligible
+                if worker.trained('AATT')  # Must be trained in AATT
+                and not any(m_role in self.tree_trek_roles for m_role in self.morning_assignments.get(worker.name, []))
+            ]
+
+        elif role in self.course_roles:
+            if role == "Course Support 1" and "Course Support 1" not in self.role_to_column:
+                return []
+            eligible = [
+                worker for worker in eligible
+                if worker.trained('AATT')  # Must be trained in AATT
+                and not any(m_role in self.course_roles for m_role in self.morning_assignments.get(worker.name, []))
+            ]
+
+        elif role in self.mini_trek_roles:
+            eligible = [
+                worker for worker in eligible
+                if worker.trained('MT')  # Must be trained in Mini Trek
+                and not any(m_role in self.mini_trek_roles for m_role in self.morning_assignments.get(worker.name, []))
+            ]
+
+        elif role in self.ica_roles_afternoon:
+            eligible = [
+                worker for worker in self.trained_early['ICA']  # Ensure only early workers can be assigned
+                if worker.name not in self.afternoon_used_workers
+                and not any(m_role in self.ica_roles for m_role in self.morning_assignments.get(worker.name, []))
+            ]
 
-        morning_assignments = {}  # Dictionary to store the morning role assignments
+        elif role in ["Course Support 2", "Zip Top 1", "Zip Top 2", "Zip Ground"]:
+            # Ensure late workers are NOT assigned in these positions
+            eligible = [
+                worker for worker in self.trained_early['AATT']  # ONLY early workers
+                if worker.name not in self.afternoon_used_workers
+            ]
 
+        return eligible
+
+    def assign_morning(self):
+        """Fill the 9:00 roles, then Kit Up/Clip In, then Host & Dekit."""
         # Assign workers to the first time slot (9:00-9:30)
-        for role in prioritized_roles_morning:
-            if role in role_to_column:
-                eligible_workers = get_eligible_workers(role)
-                logging.debug(f"Checking role: {role} | Eligible workers: {[w.name for w in eligible_workers]}")
+        for role in self.prioritized_roles_morning:
+            if role in self.role_to_column:
+                eligible_workers = self.get_eligible_workers(role)
+                self.log.debug("Checking role: %s | Eligible workers: %s", role, Lazy(lambda: [w.name for w in eligible_workers]))
 
                 # Exclude late-shift workers for specific roles at 9:00 AM
                 if role in ["Course Support 2", "Zip Top 1", "Zip Top 2", "Zip Ground"]:
-                    eligible_workers = [worker for worker in eligible_workers if worker not in late_shift_workers]
+                    eligible_workers = [worker for worker in eligible_workers if not worker.late]
 
                 if eligible_workers:
-                    selected_worker = choice(eligible_workers)
+                    selected_worker = self.pick(eligible_workers, role)
 
-                    if selected_worker.name in used_workers:
-                        logging.warning(f"Worker {selected_worker.name} was already marked as used before being assigned to {role}!")
+                    if selected_worker.name in self.used_workers:
+                        self.log.warning("Worker %s was already marked as used before being assigned to %s!", selected_worker.name, role)
 
-                    logging.debug(f"Assigning {selected_worker.name} to {role} from {len(eligible_workers)} options")
+                    self.log.debug("Assigning %s to %s from %d options", selected_worker.name, role, len(eligible_workers))
 
-                    valid_roles[role] = selected_worker.name
-                    used_workers.add(selected_worker.name)
+                    self.valid_roles[role] = selected_worker.name
+                    self.used_workers.add(selected_worker.name)
 
                 else:
-                    logging.warning(f"No eligible workers found for {role}")
+                    self.log.warning("No eligible workers found for %s", role)
 
-        # Ensure unassigned KITUP-trained workers are placed in Kit Up roles BEFORE Clip In or other roles
-        kitup_roles_priority = ['Kit Up 1', 'Kit Up 2']  # Highest priority
-        kitup_roles_secondary = ['Kit Up 3', 'Clip In 1', 'Clip In 2']  # Lower priority
 
         # Fix: Sort KITUP workers by experience (if needed) or randomize the list
         unassigned_kitup_workers = [
-            worker for worker in in_today_workers if worker.name not in used_workers and 'KITUP' in worker.roles
+            worker for worker in self.trained_early['KITUP'] if worker.name not in self.used_workers
         ]
+        unassigned_kitup_workers.sort(key=self.kitup_key)  # fewest recent shed shifts first
 
         # Fix: Ensure no KITUP worker is left unassigned
         if not unassigned_kitup_workers:
-            logging.warning("No unassigned KITUP-trained workers available!")
+            self.log.warning("No unassigned KITUP-trained workers available!")
 
         # Assign to Kit Up 1 & Kit Up 2 first
-        for role in kitup_roles_priority:
-            if role in role_to_column and role not in valid_roles and unassigned_kitup_workers:
+        for role in self.kitup_roles_priority:
+            if role in self.role_to_column and role not in self.valid_roles and unassigned_kitup_workers:
                 selected_worker = unassigned_kitup_workers.pop(0)  # Assign first available KITUP worker
-                valid_roles[role] = selected_worker.name
-                used_workers.add(selected_worker.name)
-                logging.debug(f"Assigning {selected_worker.name} to {role} (KITUP priority role)")
+                self.valid_roles[role] = selected_worker.name
+                self.used_workers.add(selected_worker.name)
+                self.log.debug("Assigning %s to %s (KITUP priority role)", selected_worker.name, role)
 
         # Assign to other Kit Up/Clip In roles after that
-        for role in kitup_roles_secondary:
-            if role in role_to_column and role not in valid_roles and unassigned_kitup_workers:
+        for role in self.kitup_roles_secondary:
+            if role in self.role_to_column and role not in self.valid_roles and unassigned_kitup_workers:
                 selected_worker = unassigned_kitup_workers.pop(0)  # Assign first available KITUP worker
-                valid_roles[role] = selected_worker.name
-                used_workers.add(selected_worker.name)
-                logging.debug(f"Assigning {selected_worker.name} to {role} (Secondary KITUP role)")
+                self.valid_roles[role] = selected_worker.name
+                self.used_workers.add(selected_worker.name)
+                self.log.debug("Assigning %s to %s (Secondary KITUP role)", selected_worker.name, role)
 
         # Fix: Log if any KITUP-trained workers are left unassigned (shouldn’t happen)
         if unassigned_kitup_workers:
-            logging.warning(f"These KITUP-trained workers were NOT assigned but should be: {[w.name for w in unassigned_kitup_workers]}")
+            self.log.warning("These KITUP-trained workers were NOT assigned but should be: %s", Lazy(lambda: [w.name for w in unassigned_kitup_workers]))
 
 
-        # Identify untrained workers (people without KITUP, AATT, MT, or ICA)
-        untrained_workers = [
-            worker for worker in in_today_workers if worker.name not in used_workers
-        ]
-
         # Ensure all Kit Up roles are filled FIRST
-        kitup_roles_priority = ['Kit Up 1', 'Kit Up 2']  # Highest priority
-        kitup_roles_secondary = ['Kit Up 3', 'Clip In 1', 'Clip In 2']  # Lower priority
 
         unassigned_kitup_workers = [
-            worker for worker in in_today_workers if worker.name not in used_workers and 'KITUP' in worker.roles
+            worker for worker in self.trained_early['KITUP'] if worker.name not in self.used_workers
         ]
+        unassigned_kitup_workers.sort(key=self.kitup_key)  # fewest recent shed shifts first
 
         # Assign to Kit Up 1 & Kit Up 2 first
-        for role in kitup_roles_priority:
-            if role in role_to_column and role not in valid_roles and unassigned_kitup_workers:
+        for role in self.kitup_roles_priority:
+            if role in self.role_to_column and role not in self.valid_roles and unassigned_kitup_workers:
                 selected_worker = unassigned_kitup_workers.pop(0)  # Assign first available KITUP worker
-                valid_roles[role] = selected_worker.name
-                used_workers.add(selected_worker.name)
-                logging.debug(f"Assigning {selected_worker.name} to {role} (KITUP priority role)")
+                self.valid_roles[role] = selected_worker.name
+                self.used_workers.add(selected_worker.name)
+                self.log.debug("Assigning %s to %s (KITUP priority role)", selected_worker.name, role)
 
         # Assign to other Kit Up/Clip In roles after that
-        for role in kitup_roles_secondary:
-            if role in role_to_column and role not in valid_roles and unassigned_kitup_workers:
+        for role in self.kitup_roles_secondary:
+            if role in self.role_to_column and role not in self.valid_roles and unassigned_kitup_workers:
                 selected_worker = unassigned_kitup_workers.pop(0)  # Assign first available KITUP worker
-                valid_roles[role] = selected_worker.name
-                used_workers.add(selected_worker.name)
-                logging.debug(f"Assigning {selected_worker.name} to {role} (Secondary KITUP role)")
+                self.valid_roles[role] = selected_worker.name
+                self.used_workers.add(selected_worker.name)
+                self.log.debug("Assigning %s to %s (Secondary KITUP role)", selected_worker.name, role)
 
         # Now, Assign Host & Dekit AFTER all Kit Up roles are filled
         unassigned_workers = [
-            worker for worker in in_today_workers if worker.name not in used_workers
+            worker for worker in self.in_today_workers if worker.name not in self.used_workers
         ]
 
         assigned_host_dekit = set()  # Track assigned workers for Host & Dekit
 
         for role in ["Host", "Dekit"]:
-            if role in role_to_column and role not in valid_roles:  # Only assign if still empty
+            if role in self.role_to_column and role not in self.valid_roles:  # Only assign if still empty
                 available_untrained = [
                     worker for worker in unassigned_workers
                     if worker.name not in assigned_host_dekit  # Ensure a different worker is assigned
                 ]
 
                 if available_untrained:
-                    selected_worker = choice(available_untrained)
-                    valid_roles[role] = selected_worker.name  # Assign worker
-                    used_workers.add(selected_worker.name)  # Mark them as used
+                    selected_worker = self.pick(available_untrained, role)
+                    self.valid_roles[role] = selected_worker.name  # Assign worker
+                    self.used_workers.add(selected_worker.name)  # Mark them as used
                     assigned_host_dekit.add(selected_worker.name)  # Track to avoid duplicate assignment
 
-                    logging.debug(f"Assigning {selected_worker.name} to {role} (Untrained Worker)")
-
-        # Ensure Host & Dekit are printed for all morning time slots (9:00 AM - 12:45 PM)
-        for slot_row in range(2, 9):  # Covers 9:00–9:30 to 12:45
-            for role in ["Host", "Dekit"]:
-                column = role_to_column.get(role)
-                if column:
-                    sheet.cell(row=slot_row, column=column).value = valid_roles.get(role, "")
+                    self.log.debug("Assigning %s to %s (Untrained Worker)", selected_worker.name, role)
 
         # Track morning assignments properly (store all roles)
-        for role, worker in valid_roles.items():
-            if worker not in morning_assignments:
-                morning_assignments[worker] = []  # Initialize list if not present
-            morning_assignments[worker].append(role)  # Store all roles they worked in the morning
+        for role, worker in self.valid_roles.items():
+            if worker not in self.morning_assignments:
+                self.morning_assignments[worker] = []  # Initialize list if not present
+            self.morning_assignments[worker].append(role)  # Store all roles they worked in the morning
         
         # Check if any worker was ignored for assignment
-        assigned_workers = set(valid_roles.values())
-        unassigned_workers = [worker.name for worker in in_today_workers + late_shift_workers if worker.name not in assigned_workers]
+        assigned_workers = set(self.valid_roles.values())
+        unassigned_workers = [worker.name for worker in self.in_today_workers + self.late_shift_workers if worker.name not in assigned_workers]
 
         if unassigned_workers:
-            logging.warning(f"Workers NOT assigned in the morning (shouldn't happen): {', '.join(unassigned_workers)}")
+            self.log.warning("Workers NOT assigned in the morning (shouldn't happen): %s", Lazy(lambda: ", ".join(unassigned_workers)))
 
-        logging.info("\n======= MORNING ASSIGNMENTS CHECK =======")
-        for role, worker in valid_roles.items():
-            logging.info(f"{role} -> {worker}")
-        logging.info("========================================")
+        self.log.debug("Morning assignments: %s", Lazy(lambda: ", ".join(f"{role} -> {worker}" for role, worker in self.valid_roles.items())))
 
         # Fallback: Force assign Host and Dekit if still unassigned and spares exist
         for role in ["Host", "Dekit"]:
-            if role in role_to_column and role not in valid_roles:
+            if role in self.role_to_column and role not in self.valid_roles:
                 available_spares = [
-                    worker for worker in in_today_workers + late_shift_workers
-                    if worker.name not in used_workers
+                    worker for worker in self.in_today_workers + self.late_shift_workers
+                    if worker.name not in self.used_workers
                 ]
 
                 if available_spares:
-                    selected_worker = choice(available_spares)
-                    valid_roles[role] = selected_worker.name
-                    used_workers.add(selected_worker.name)
-                    logging.warning(f"Fallback assigning {selected_worker.name} to {role} due to earlier miss.")
+                    selected_worker = self.pick(available_spares, role)
+                    self.valid_roles[role] = selected_worker.name
+                    self.used_workers.add(selected_worker.name)
+                    self.log.warning("Fallback assigning %s to %s due to earlier miss.", selected_worker.name, role)
 
         # Recalculate spare workers AFTER fallback assignment
-        morning_spare_workers = [
-            worker.name for worker in in_today_workers + late_shift_workers
-            if worker.name not in used_workers
+        self.morning_spare_workers = [
+            worker.name for worker in self.in_today_workers + self.late_shift_workers
+            if worker.name not in self.used_workers
         ]
 
 
         # Log morning spare workers clearly
-        if morning_spare_workers:
-            logging.info(f"Morning Spare Workers ({len(morning_spare_workers)}): {', '.join(morning_spare_workers)}")
-        else:
-            logging.info("No Morning Spare Workers found.")
-        
-        
-        # Write the assignments for the first time slot (9:00-9:30) to the Excel file
-        for role, column in role_to_column.items():
-            if role == "Course Support 1" and role not in role_to_column:
-                continue  # Skip if it doesn’t exist
-
-            assigned_worker = valid_roles.get(role)
-            if assigned_worker:
-                sheet.cell(row=2, column=column).value = assigned_worker
-
-        # Fill Shed (Host, Dekit, Kit Up 1), Tree Trek, Mini Trek, and ICA roles for all time slots till lunch
-        lunch_slots = [3, 4, 5, 6, 7, 8]  # Rows corresponding to 9:30, 10:00, ..., 12:00-12:45
-        for slot_row in lunch_slots:
-            for role in ['Host', 'Dekit', 'Kit Up 1', 'TREE TREK 1', 'TREE TREK 2', 'Mini Trek', 'ICA 1', 'ICA 2', 'ICA 3', 'ICA 4']:
-                column = role_to_column.get(role)
-                if column:
-                    sheet.cell(row=slot_row, column=column).value = valid_roles.get(role)
-
-        # Handle Kit Up 2, Kit Up 3, Clip In 1, and Clip In 2
-        for slot_row in lunch_slots:
-            if slot_row == 5:  # 10:30 row
-                # Swap Kit Up 2 with Clip In 1
-                temp_kit_up_2 = valid_roles.get('Kit Up 2')
-                temp_kit_up_3 = valid_roles.get('Kit Up 3')
-                valid_roles['Kit Up 2'], valid_roles['Clip In 1'] = valid_roles.get('Clip In 1'), temp_kit_up_2
-                valid_roles['Kit Up 3'], valid_roles['Clip In 2'] = valid_roles.get('Clip In 2'), temp_kit_up_3
-
-            # Assign updated roles for Kit Up 2, Kit Up 3, Clip In 1, and Clip In 2
-            for role in ['Kit Up 2', 'Kit Up 3', 'Clip In 1', 'Clip In 2']:
-                column = role_to_column.get(role)
-                if column:
-                    sheet.cell(row=slot_row, column=column).value = valid_roles.get(role)
-
-        # Handle Course role rotations till lunch
-        course_roles = [
-            'Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1'
-        ]
-
-        if "Course Support 1" in role_to_column:
-            course_roles.insert(0, "Course Support 1")  
-
-        # Assign initial workers to course roles (9:00-9:30)
-        course_workers = [valid_roles.get(role) for role in course_roles]
-
-        # Rotate course roles for each subsequent time slot until lunch
-        for slot_row in lunch_slots:
-            # Rotate workers: Last worker moves to the first position
-            course_workers = course_workers[-1:] + course_workers[:-1]
-
-            # Assign rotated workers to their roles for this time slot
-            for role, worker in zip(course_roles, course_workers):
-                column = role_to_column.get(role)
-                if column:
-                    sheet.cell(row=slot_row, column=column).value = worker
-
-        # Track assigned workers in the morning
-        assigned_workers = set(valid_roles.values())  
-        unassigned_workers = [worker.name for worker in in_today_workers + late_shift_workers if worker.name not in assigned_workers]
-
-        if unassigned_workers:
-            logging.warning(f"Unassigned workers found in the morning: {', '.join(unassigned_workers)}")
-
-        # Track afternoon usage
-        afternoon_valid_roles = {}  # Roles assigned in the afternoon
-        afternoon_used_workers = set()  # Workers used in the afternoon
-
-        # Define role categories for clarity and maintainability
-        shed_roles = {'Host', 'Dekit', 'Kit Up 1', 'Kit Up 2', 'Kit Up 3', 'Clip In 1', 'Clip In 2'}
-        tree_trek_roles = {'TREE TREK 1', 'TREE TREK 2'}
-        course_roles = ['Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1']
-
-        # Only add 'Course Support 1' if it exists in the Excel file
-        if "Course Support 1" in role_to_column:
-            course_roles.insert(0, "Course Support 1")
-
-        # Convert course_roles to a **list** for ordering
-        course_roles = list(course_roles)
-
-        mini_trek_roles = {'Mini Trek'}
-        ica_roles = [f"ICA {i}" for i in range(1, ica_morning_count + 1)]
-
-        # Function to get eligible workers for afternoon assignments
-        def get_afternoon_eligible_workers(role):
-            eligible = [
-                worker for worker in (in_today_workers + late_shift_workers)
-                if worker.name not in afternoon_used_workers
-            ]
-
-            # Prefer different people for shed roles in the afternoon
-            if role in shed_roles:
-                # Try to avoid reusing the same person who did this role in the morning
-                preferred = [
-                    worker for worker in eligible
-                    if role not in morning_assignments.get(worker.name, [])
-                ]
-                if preferred:
-                    eligible = preferred
-                else:
-                    # Allow reuse only as fallback
-                    logging.warning(f"⚠️ No new workers for {role}, reusing someone from the morning.")
-
-            if role in role_to_training['KITUP']:
-                eligible = [
-                    worker for worker in eligible
-                    if 'KITUP' in worker.roles  # Must be trained in KITUP
-                ]
-
-            elif role in tree_trek_roles:
-                eligible = [
-                    worker for worker in eligible
-                    if 'AATT' in worker.roles  # Must be trained in AATT
-                    and not any(m_role in tree_trek_roles for m_role in morning_assignments.get(worker.name, []))
-                ]
-
-            elif role in course_roles:
-                if role == "Course Support 1" and "Course Support 1" not in role_to_column:
-                    return []
-                eligible = [
-                    worker for worker in eligible
-                    if 'AATT' in worker.roles  # Must be trained in AATT
-                    and not any(m_role in course_roles for m_role in morning_assignments.get(worker.name, []))
-                ]
-
-            elif role in mini_trek_roles:
-                eligible = [
-                    worker for worker in eligible
-                    if 'MT' in worker.roles  # Must be trained in Mini Trek
-                    and not any(m_role in mini_trek_roles for m_role in morning_assignments.get(worker.name, []))
-                ]
-
-            elif role in ica_roles_afternoon:
-                eligible = [
-                    worker for worker in in_today_workers  # Ensure only early workers can be assigned
-                    if worker.name not in afternoon_used_workers
-                    and 'ICA' in worker.roles  # Must be trained in ICA
-                    and not any(m_role in ica_roles for m_role in morning_assignments.get(worker.name, []))
-                ]
-
-            elif role in ["Course Support 2", "Zip Top 1", "Zip Top 2", "Zip Ground"]:
-                # Ensure late workers are NOT assigned in these positions
-                eligible = [
-                    worker for worker in in_today_workers  # ONLY early workers
-                    if worker.name not in afternoon_used_workers
-                    and 'AATT' in worker.roles  # Must be trained in AATT
-                ]
-
-            return eligible
-            
-        ica_roles_afternoon = [f"ICA {i}" for i in range(1, ica_afternoon_count + 1)]
-
-        prioritized_roles_afternoon = (
-            ica_roles_afternoon +
-            [
-                'Mini Trek', 'Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1',
-                'TREE TREK 1', 'TREE TREK 2',
-                'Clip In 1', 'Clip In 2', 'Kit Up 3', 'Kit Up 2', 'Kit Up 1',
-            ]
-        )
-
-        # Only add 'Course Support 1' if it exists in the Excel file
-        if "Course Support 1" in role_to_column and "Course Support 1" not in prioritized_roles_afternoon:
-            prioritized_roles_afternoon.insert(2, "Course Support 1")  # Put it with the other course roles
-
-        
+        self.log.debug("Morning Spare Workers (%d): %s", len(self.morning_spare_workers), Lazy(lambda: ", ".join(self.morning_spare_workers) or "None"))
 
+    def assign_afternoon(self):
+        """Fill the 12:45 roles, preferring people who did something else in the morning."""
         # Assign workers for 12:45-1:30
-        for role in prioritized_roles_afternoon:
-            eligible_workers = get_afternoon_eligible_workers(role)
+        for role in self.prioritized_roles_afternoon:
+            eligible_workers = self.get_afternoon_eligible_workers(role)
             if eligible_workers:
-                selected_worker = choice(eligible_workers)  # Randomly select a worker
-                afternoon_valid_roles[role] = selected_worker.name
-                afternoon_used_workers.add(selected_worker.name)
+                selected_worker = self.pick(eligible_workers, role)  # Randomly select a worker
+                self.afternoon_valid_roles[role] = selected_worker.name
+                self.afternoon_used_workers.add(selected_worker.name)
 
         # Ensure unassigned KITUP-trained workers are placed in Kit Up and Clip In roles
         unassigned_kitup_workers_afternoon = [
-            worker for worker in in_today_workers if worker.name not in afternoon_used_workers and 'KITUP' in worker.roles
+            worker for worker in self.trained_early['KITUP'] if worker.name not in self.afternoon_used_workers
         ]
+        unassigned_kitup_workers_afternoon.sort(key=self.kitup_key)  # fewest recent shed shifts first
 
-        for role in kitup_roles_priority + kitup_roles_secondary:
-            if role in role_to_column and role not in afternoon_valid_roles and unassigned_kitup_workers_afternoon:
+        for role in self.kitup_roles_priority + self.kitup_roles_secondary:
+            if role in self.role_to_column and role not in self.afternoon_valid_roles and unassigned_kitup_workers_afternoon:
                 selected_worker = unassigned_kitup_workers_afternoon.pop(0)  # Assign first available KITUP worker
-                afternoon_valid_roles[role] = selected_worker.name
-                afternoon_used_workers.add(selected_worker.name)
-                logging.debug(f"Assigning {selected_worker.name} to {role} (Afternoon KITUP role)")
+                self.afternoon_valid_roles[role] = selected_worker.name
+                self.afternoon_used_workers.add(selected_worker.name)
+                self.log.debug("Assigning %s to %s (Afternoon KITUP role)", selected_worker.name, role)
 
         # Ensure all Kit Up roles are filled FIRST
         unassigned_kitup_workers_afternoon = [
-            worker for worker in in_today_workers if worker.name not in afternoon_used_workers and 'KITUP' in worker.roles
+            worker for worker in self.trained_early['KITUP'] if worker.name not in self.afternoon_used_workers
         ]
+        unassigned_kitup_workers_afternoon.sort(key=self.kitup_key)  # fewest recent shed shifts first
 
-        for role in kitup_roles_priority + kitup_roles_secondary:
-            if role in role_to_column and role not in afternoon_valid_roles and unassigned_kitup_workers_afternoon:
+        for role in self.kitup_roles_priority + self.kitup_roles_secondary:
+            if role in self.role_to_column and role not in self.afternoon_valid_roles and unassigned_kitup_workers_afternoon:
                 selected_worker = unassigned_kitup_workers_afternoon.pop(0)  # Assign first available KITUP worker
-                afternoon_valid_roles[role] = selected_worker.name
-                afternoon_used_workers.add(selected_worker.name)
-                logging.debug(f"Assigning {selected_worker.name} to {role} (Afternoon KITUP role)")
+                self.afternoon_valid_roles[role] = selected_worker.name
+                self.afternoon_used_workers.add(selected_worker.name)
+                self.log.debug("Assigning %s to %s (Afternoon KITUP role)", selected_worker.name, role)
 
         # Now, Assign Host & Dekit AFTER all Kit Up roles are filled
         unassigned_workers_afternoon = [
-            worker for worker in in_today_workers if worker.name not in afternoon_used_workers
+            worker for worker in self.in_today_workers if worker.name not in self.afternoon_used_workers
         ]
 
         assigned_host_dekit = set()  # Track assigned workers for Host & Dekit
 
         for role in ["Host", "Dekit"]:
-            if role in role_to_column and role not in afternoon_valid_roles:  # Only assign if still empty
+            if role in self.role_to_column and role not in self.afternoon_valid_roles:  # Only assign if still empty
                 available_untrained = [
                     worker for worker in unassigned_workers_afternoon
                     if worker.name not in assigned_host_dekit  # Ensure a different worker is assigned
                 ]
 
                 if available_untrained:
-                    selected_worker = choice(available_untrained)
-                    afternoon_valid_roles[role] = selected_worker.name  # Assign worker
-                    afternoon_used_workers.add(selected_worker.name)  # Mark them as used
+                    selected_worker = self.pick(available_untrained, role)
+                    self.afternoon_valid_roles[role] = selected_worker.name  # Assign worker
+                    self.afternoon_used_workers.add(selected_worker.name)  # Mark them as used
                     assigned_host_dekit.add(selected_worker.name)  # Track to avoid duplicate assignment
 
-                    logging.debug(f"Assigning {selected_worker.name} to {role} (Afternoon Untrained Worker)")
-
-        # Ensure Host & Dekit are printed for all afternoon time slots (12:45 PM - 4:00 PM)
-        for slot_row in range(10, 16):  # Rows for 12:45, 1:30, ..., 4:00
-            for role in ["Host", "Dekit"]:
-                column = role_to_column.get(role)
-                if column:
-                    sheet.cell(row=slot_row, column=column).value = afternoon_valid_roles.get(role, "")
-
-            # Write afternoon assignments (12:45-1:30) to the Excel sheet
-            logging.info("Writing afternoon assignments (12:45-1:30) to the Excel sheet...")
-
-            # Ensure the row for 12:45-1:30 is correctly found
-            afternoon_slot_row = None
-
-            for row in range(1, sheet.max_row + 1):
-                cell_value = sheet.cell(row=row, column=1).value
-                if cell_value and str(cell_value).strip() == "12:45-1:30":
-                    afternoon_slot_row = row
-                    break
-
-            # Ensure the assigned workers at 12:45 - 1:30 are **written** into the Excel sheet
-            if afternoon_slot_row:
-                for role, worker in afternoon_valid_roles.items():
-                    column = role_to_column.get(role)
-                    if column:
-                        sheet.cell(row=afternoon_slot_row, column=column).value = worker if worker else ""
-
-            # # Assign initial course and tree trek workers for the afternoon (12:45-1:30)
-            # course_workers = [afternoon_valid_roles.get(role) for role in course_roles]
-            tree_trek_workers = [afternoon_valid_roles.get(role) for role in tree_trek_roles]
-
-            # Store afternoon workers before rotation ####
-            saved_afternoon_workers = afternoon_valid_roles.copy() #####
-            tree_trek_workers = [saved_afternoon_workers.get(role) for role in tree_trek_roles]
-
-            # Ensure unassigned positions stay empty
-            course_workers = [worker if worker else None for worker in course_workers]
-            tree_trek_workers = [worker if worker else None for worker in tree_trek_workers]
-
-            # Define afternoon time slots in the Excel sheet based on actual labels
-            afternoon_slots_rows = [11, 12, 13, 14, 15]  # Corresponding rows for 13:30, 14:00, ..., 15:30
-
-            # Rotate roles for each subsequent time slot in the afternoon
-            for slot_index, slot_row in enumerate(afternoon_slots_rows):
-                if slot_index > 0:
-                    course_workers = course_workers[-1:] + course_workers[:-1]  # rotate the list
-
-                for role, worker in zip(course_roles, course_workers):
-                    column = role_to_column.get(role)
-                    if column:
-                        sheet.cell(row=slot_row, column=column).value = worker or ""
-
-                # Assign rotated workers to course roles
-                for role, worker in zip(course_roles, course_workers):
-                    column = role_to_column.get(role)
-                    if column:
-                        sheet.cell(row=slot_row, column=column).value = worker if worker else ""
-
-                # Assign rotated workers to tree trek roles
-                for role, worker in zip(tree_trek_roles, tree_trek_workers):
-                    column = role_to_column.get(role)
-                    if column:
-                        sheet.cell(row=slot_row, column=column).value = worker if worker else ""
-
-            # Identify workers who were not assigned in the afternoon
-            unassigned_workers = [worker.name for worker in in_today_workers + late_shift_workers if worker.name not in afternoon_valid_roles.values()]
-
-            # Attempt to assign unassigned workers to open slots
-            for role in afternoon_valid_roles:
-                if not afternoon_valid_roles[role] and unassigned_workers:
-                    afternoon_valid_roles[role] = unassigned_workers.pop(0)  # Assign first unassigned worker
-
-            logging.info("\n======= AFTERNOON ASSIGNMENTS CHECK =======")
-            for role, worker in afternoon_valid_roles.items():
-                logging.info(f"{role} -> {worker}")
-            logging.info("===========================================")
-
-            # Ensure ICA workers assigned at 12:45 - 1:30 are stored for reuse
-            ica_workers_after_lunch = {
-                role: afternoon_valid_roles[role] for role in ica_roles if role in afternoon_valid_roles
-            }
-
-        # Assign workers for each afternoon time slot
-        for slot_index, slot_row in enumerate(afternoon_slots_rows):
-
-            # Assign ICA roles using the same workers from 12:45 - 1:30
-            for role in ica_roles_afternoon:
-                column = role_to_column.get(role)
-                if column:
-                    sheet.cell(row=slot_row, column=column).value = ica_workers_after_lunch.get(role, "")
-
-            # Skip reassigning course roles that were already rotated and written
-            prioritized_roles_afternoon = [
-                role for role in prioritized_roles_afternoon
-                if role not in course_roles and role not in ica_roles
-            ]
-
-            for role in prioritized_roles_afternoon:
-                # ✅ Skip if already assigned at 12:45–1:30
-                if role in afternoon_valid_roles:
-                    continue
-                if role in ica_roles:  # Skip ICA roles since they are already assigned
-                    continue
-                if role == "Mini Trek":  # ⛔️ Also skip re-assigning Mini Trek after 12:45–1:30
+                    self.log.debug("Assigning %s to %s (Afternoon Untrained Worker)", selected_worker.name, role)
+
+    @staticmethod
+    def hand_over(assignments, pairs):
+        """Swap the people on each pair of posts (e.g. Kit Up 2 <-> Clip In 1)."""
+        for a, b in pairs:
+            assignments[a], assignments[b] = assignments.get(b), assignments.get(a)
+
+    def plan_morning_slots(self, slot_count, handovers=None):
+        """Morning posts per slot: the 9:00 assignment, with hand-overs applied from their slot on."""
+        handovers = handovers or {}
+        assignments = dict(self.valid_roles)
+        self.morning_slots = []
+        for slot in range(slot_count):
+            self.hand_over(assignments, handovers.get(slot, ()))
+            self.morning_slots.append(dict(assignments))
+        return self.morning_slots
+
+    def plan_afternoon_slots(self, slot_count, handovers=None):
+        """
+        Afternoon posts per slot. Slot 0 is the 12:45 assignment; in each later
+        slot empty posts are filled and posts move to anyone who has not worked
+        yet this afternoon. The Host/Dekit fallback comes last and is recorded
+        in afternoon_valid_roles but not in the slots.
+        """
+        handovers = handovers or {}
+        assignments = self.afternoon_valid_roles
+        self.afternoon_slots = [dict(assignments)]
+
+        # Course roles rotate and morning ICAs stay put, so neither is re-picked
+        roles = [
+            role for role in self.prioritized_roles_afternoon
+            if role not in self.course_roles and role not in self.ica_roles
+        ]
+        for slot in range(1, slot_count):
+            for role in roles:
+                if role in assignments or role == "Mini Trek":
                     continue
+                eligible_workers = self.get_afternoon_eligible_workers(role)
+                if eligible_workers:
+                    selected_worker = self.pick(eligible_workers, role)
+                    assignments[role] = selected_worker.name
+                    self.afternoon_used_workers.add(selected_worker.name)
 
+            self.hand_over(assignments, handovers.get(slot, ()))
 
-                eligible_workers = get_afternoon_eligible_workers(role)
-
-                if eligible_workers:
-                    selected_worker = choice(eligible_workers)  # Randomly select a worker
-                    afternoon_valid_roles[role] = selected_worker.name
-                    afternoon_used_workers.add(selected_worker.name)
-
-            # Handle Kit Up 2, Kit Up 3, Clip In 1, and Clip In 2 at 14:30
-            if slot_row == 13:  # Row corresponding to 14:30
-                # Swap Kit Up 2 with Clip In 1
-                temp_kit_up_2 = afternoon_valid_roles.get('Kit Up 2')
-                temp_kit_up_3 = afternoon_valid_roles.get('Kit Up 3')
-                afternoon_valid_roles['Kit Up 2'], afternoon_valid_roles['Clip In 1'] = afternoon_valid_roles.get('Clip In 1'), temp_kit_up_2
-                afternoon_valid_roles['Kit Up 3'], afternoon_valid_roles['Clip In 2'] = afternoon_valid_roles.get('Clip In 2'), temp_kit_up_3
-
-            # Assign workers for the current time slot
-            for role in prioritized_roles_afternoon:
-                if role == "Mini Trek" and role in afternoon_valid_roles:
+            for role in roles:
+                if role == "Mini Trek" and role in assignments:
                     continue
 
-                eligible_workers = get_afternoon_eligible_workers(role)
-                
+                eligible_workers = self.get_afternoon_eligible_workers(role)
+
                 # Filter out workers not trained for ICA roles if assigning to ICA roles
                 if role.startswith('ICA'):
-                    eligible_workers = [worker for worker in eligible_workers if 'ICA' in worker.roles]
-                
+                    eligible_workers = [worker for worker in eligible_workers if worker.trained('ICA')]
+
                 # Apply KITUP restrictions directly in assignment loop
                 if role in ['Kit Up 1', 'Kit Up 2', 'Kit Up 3', 'Clip In 1', 'Clip In 2']:
-                    eligible_workers = [worker for worker in eligible_workers if 'KITUP' in worker.roles]
+                    eligible_workers = [worker for worker in eligible_workers if worker.trained('KITUP')]
 
                 if eligible_workers:
-                    selected_worker = choice(eligible_workers)  # Randomly select a worker
-                    afternoon_valid_roles[role] = selected_worker.name
-                    afternoon_used_workers.add(selected_worker.name)
-
-            # Write assignments for the current time slot to the Excel sheet
-            logging.info(f"Writing assignments for Row {slot_row} to the Excel sheet...")
-            for role, worker in afternoon_valid_roles.items():
-                if role == "Course Support 1" and "Course Support 1" not in role_to_column:
-                    continue  # Skip if 'Course Support 1' is not in the Excel file
-
-                column = role_to_column.get(role)
-                if column:
-                    sheet.cell(row=slot_row, column=column).value = worker
-
-            # Handle Course role rotations for every half-hour time slot
-            course_roles = ['Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1']
-
-            # Only include 'Course Support 1' if it's in the Excel file
-            if "Course Support 1" in role_to_column:
-                course_roles.insert(0, "Course Support 1")
-
-            if slot_index == 0:  # Initialize course roles for the first slot
-                course_workers = [afternoon_valid_roles.get(role) for role in course_roles]
-
-            # Rotate course roles immediately after the first slot
-            if slot_index >= 0:
-                course_workers = course_workers[-1:] + course_workers[:-1]  # Rotate the roles
-                for role, worker in zip(course_roles, course_workers):
-                    column = role_to_column.get(role)
-                    if column:
-                        sheet.cell(row=slot_row, column=column).value = worker
-
-        evening_slots_rows = [16, 17, 18, 19, 20, 21]  # Rows for 16:00, 16:30, 17:00, 17:30, 18:00, 18:30
-
-        # Ensure we only assign available late workers (if fewer than 4 exist)
-        late_workers_for_ica = late_shift_workers[:min(4, len(late_shift_workers))]
-
-        # Assign them for each evening time slot
-        for slot_row in evening_slots_rows:
-            for i, ica_role in enumerate(['ICA 1', 'ICA 2', 'ICA 3', 'ICA 4']):
-                if i < len(late_workers_for_ica):  # Ensure we have a worker
-                    worker = late_workers_for_ica[i]
-                    column = role_to_column.get(ica_role)
-                    if column:
-                        sheet.cell(row=slot_row, column=column).value = worker.name
-        
-        # extend non-ICA roles printing up to selected cutoff hour
-        # row map: 10..15 are 12:45,13:30,14:00,14:30,15:00,15:30
-        # row map: 16..21 are 16:00,16:30,17:00,17:30,18:00,18:30
-        # for a cutoff of 16 print up to 15:30
-        # for a cutoff of 17 print up to 16:30
-        # for a cutoff of 18 print up to 17:30
-
-        cutoff_rows_map = {
-            16: [15],                 # up to 15:30
-            17: [15, 16, 17],         # up to 16:30
-            18: [15, 16, 17, 18, 19], # up to 17:30
-        }
-        non_ica_rows_to_fill = cutoff_rows_map.get(print_until_hour, [])
-
-        # ordered list of course roles for evening reuse
-        course_roles_evening = ['Course Support 2', 'Zip Top 1', 'Zip Top 2', 'Zip Ground', 'rotate to course 1']
-        if "Course Support 1" in role_to_column:
-            course_roles_evening.insert(0, "Course Support 1")
+                    selected_worker = self.pick(eligible_workers, role)  # Randomly select a worker
+                    assignments[role] = selected_worker.name
+                    self.afternoon_used_workers.add(selected_worker.name)
 
-        # seed the rotation list from the latest known order
-        if not course_workers:
-            course_workers = [afternoon_valid_roles.get(role) for role in course_roles_evening]
+            self.afternoon_slots.append(dict(assignments))
 
-        saved_afternoon_workers_all = afternoon_valid_roles.copy()
+        self.afternoon_spare_workers = [
+            worker.name for worker in self.in_today_workers + self.late_shift_workers
+            if worker.name not in assignments.values()
+        ]
 
-        for slot_row in non_ica_rows_to_fill:
-            if slot_row >= 16 and course_workers:
-                course_workers = course_workers[-1:] + course_workers[:-1]
+        # Fallback: Force assign Host and Dekit in afternoon if still unassigned and workers are left
+        for role in ["Host", "Dekit"]:
+            if role in self.role_to_column and role not in assignments:
+                available_spares = [
+                    worker for worker in self.in_today_workers + self.late_shift_workers
+                    if worker.name not in self.afternoon_used_workers
+                ]
 
-            for role, worker in zip(course_roles_evening, course_workers):
-                col = role_to_column.get(role)
-                if col:
-                    sheet.cell(row=slot_row, column=col).value = worker or ""
+                if available_spares:
+                    selected_worker = self.pick(available_spares, role)
+                    assignments[role] = selected_worker.name
+                    self.afternoon_used_workers.add(selected_worker.name)
+                    self.log.warning("⚠️ Fallback assigning %s to %s (afternoon fallback).", selected_worker.name, role)
+
+        return self.afternoon_slots
+
+
+
+class SlotProgram:
+    """
+    A template's rotation rules compiled against its columns.
+
+    `source` is a role x slot array: for each cell, the index into the day's
+    value vector (see values()) that feeds it, or -1 to leave the cell alone.
+    The value vector is every morning slot's posts, then every afternoon
+    slot's, then the late workers, so rendering a day is one pass over the
+    writing cells.
+    """
+
+    def __init__(self, rotation, role_to_column, print_until_hour):
+        phases = rotation["phases"]
+        self.roles = [role for role in role_to_column if role in PLANNER_ROLES]
+        self.morning_rows = [int(row) for row in phases["morning"]["rows"]]
+        self.afternoon_rows = [int(row) for row in phases["afternoon"]["rows"]]
+        self.evening_rows = [int(row) for row in phases.get("evening", {}).get("rows", [])]
+        self.morning_handovers = self._handovers(phases["morning"], self.morning_rows)
+        self.afternoon_handovers = self._handovers(phases["afternoon"], self.afternoon_rows)
+        self.late_roles = list(rotation.get("late_roles", []))
+        hold = int(rotation.get("evening_hold", {}).get(str(print_until_hour), 0))
+        if not self.morning_rows or not self.afternoon_rows:
+            raise ValueError("morning and afternoon need at least one row each")
+
+        position = {role: i for i, role in enumerate(self.roles)}
+        groups = [
+            np.array([position[role] for role in group if role in position], dtype=np.int32)
+            for group in rotation.get("rotate", [])
+        ]
 
-            for role in ['TREE TREK 1', 'TREE TREK 2']:
-                col = role_to_column.get(role)
-                if col:
-                    sheet.cell(row=slot_row, column=col).value = saved_afternoon_workers_all.get(role, "")
+        def readers(offset):
+            """Which role's post each role shows once the rotating groups have moved `offset` places."""
+            read = np.arange(len(self.roles), dtype=np.int32)
+            for group in groups:
+                if len(group):
+                    read[group] = group[(np.arange(len(group)) - offset) % len(group)]
+            return read
+
+        width = len(self.roles)
+        morning, afternoon = len(self.morning_rows), len(self.afternoon_rows)
+        late_base = (morning + afternoon) * width
+        rows = self.morning_rows + self.afternoon_rows + self.evening_rows
+        source = np.full((width, len(rows)), -1, dtype=np.int32)
+        for slot in range(morning):
+            source[:, slot] = slot * width + readers(slot)
+        for slot in range(afternoon):
+            source[:, morning + slot] = (morning + slot) * width + readers(slot)
+        for slot in range(len(self.evening_rows)):
+            column = morning + afternoon + slot
+            if slot < hold:
+                # afternoon posts carry on from the last afternoon slot, rotation keeps going
+                source[:, column] = (morning + afternoon - 1) * width + readers(afternoon + slot)
+            for i, role in enumerate(self.late_roles):
+                if role in position:
+                    source[position[role], column] = late_base + i
+        self.source = source
+        self.value_count = late_base + len(self.late_roles)
+
+        role_index, slot_index = np.nonzero(source >= 0)
+        columns = np.array([role_to_column[role] for role in self.roles], dtype=np.int32)
+        self.cells = list(zip(
+            np.array(rows, dtype=np.int32)[slot_index].tolist(),
+            columns[role_index].tolist(),
+            source[role_index, slot_index].tolist(),
+        ))
+
+    @staticmethod
+    def _handovers(phase, rows):
+        handovers = {}
+        for row, pairs in phase.get("handovers", {}).items():
+            if int(row) not in rows:
+                raise ValueError(f"Hand-over row {row} is not one of the phase rows {rows}")
+            handovers[rows.index(int(row))] = [tuple(pair) for pair in pairs]
+        return handovers
+
+    def values(self, morning_slots, afternoon_slots, late_names):
+        """The day's value vector; None means nobody, and the cell is left as it is."""
+        values = [slot.get(role) for slot in morning_slots for role in self.roles]
+        values += [slot.get(role) for slot in afternoon_slots for role in self.roles]
+        values += (list(late_names) + [None] * len(self.late_roles))[:len(self.late_roles)]
+        return values
+
+    def render(self, sheet, values):
+        for row, column, index in self.cells:
+            value = values[index]
+            if value:
+                sheet.cell(row=row, column=column).value = value
+
+
+def check_rotation(rotation):
+    """
+    Raise ValueError naming the first missing or malformed field of a
+    template's rotation rules; SlotProgram assumes this shape.
+    """
+    def strings(value, field):
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            raise ValueError(f"{field} must be a list of role names")
+
+    def row_numbers(value, field):
+        if not isinstance(value, list) or not all(isinstance(row, int) and not isinstance(row, bool) for row in value):
+            raise ValueError(f"{field} must be a list of sheet row numbers")
+
+    if not isinstance(rotation, dict):
+        raise ValueError("rotation must be an object or null")
+    phases = rotation.get("phases")
+    if not isinstance(phases, dict):
+        raise ValueError("rotation.phases is required and must be an object")
+    for name in ("morning", "afternoon", "evening"):
+        field = f"rotation.phases.{name}"
+        if name not in phases:
+            if name == "evening":
+                continue
+            raise ValueError(f"{field} is required")
+        phase = phases[name]
+        if not isinstance(phase, dict):
+            raise ValueError(f"{field} must be an object")
+        row_numbers(phase.get("rows"), f"{field}.rows")
+        if name != "evening" and not phase["rows"]:
+            raise ValueError(f"{field}.rows needs at least one row")
+        handovers = phase.get("handovers", {})
+        if not isinstance(handovers, dict):
+            raise ValueError(f"{field}.handovers must map a row to [role, role] pairs")
+        for row, pairs in handovers.items():
+            if not str(row).isdigit() or int(row) not in phase["rows"]:
+                raise ValueError(f"{field}.handovers row {row} is not one of the phase rows")
+            if not isinstance(pairs, list) or not all(
+                isinstance(pair, list) and len(pair) == 2 and all(isinstance(role, str) for role in pair)
+                for pair in pairs
+            ):
+                raise ValueError(f"{field}.handovers.{row} must be a list of [role, role] pairs")
+    rotate = rotation.get("rotate", [])
+    if not isinstance(rotate, list):
+        raise ValueError("rotation.rotate must be a list of role groups")
+    for i, group in enumerate(rotate):
+        strings(group, f"rotation.rotate[{i}]")
+    strings(rotation.get("late_roles", []), "rotation.late_roles")
+    hold = rotation.get("evening_hold", {})
+    if not isinstance(hold, dict) or not all(
+        isinstance(rows, int) and not isinstance(rows, bool) and rows >= 0 for rows in hold.values()
+    ):
+        raise ValueError("rotation.evening_hold must map a print_until_hour to a number of rows")
+
+
+# compiled programs, least recently used first; a rotation edit or a
+# re-uploaded template makes a new key and the old one ages out
+_slot_programs = OrderedDict()
+_slot_programs_lock = threading.Lock()
+
+
+def get_slot_program(template, print_until_hour):
+    """Compiled SlotProgram for a template, built once per layout and cutoff."""
+    rotation = template.rotation or ROTATION_DEFAULT
+    key = (template.sha256, json.dumps(rotation, sort_keys=True), print_until_hour)
+    with _slot_programs_lock:
+        program = _slot_programs.get(key)
+        if program is not None:
+            _slot_programs.move_to_end(key)
+            return program
+    program = SlotProgram(rotation, template.role_columns, print_until_hour)
+    with _slot_programs_lock:
+        program = _slot_programs.setdefault(key, program)
+        while len(_slot_programs) > SLOT_PROGRAM_CACHE_SIZE:
+            _slot_programs.popitem(last=False)
+    return program
+
+EVENING_ICA_ROLES = ['ICA 1', 'ICA 2', 'ICA 3', 'ICA 4']
+
+
+def simulate_absences(early, late, role_to_column, ica_morning_count, ica_afternoon_count,
+                      runs, min_absent, max_absent, seed):
+    """
+    Plan the day `runs` times, each time with a random min_absent..max_absent
+    workers off. Returns raw tallies so chunks from several processes can be
+    summed: unfilled counts per (phase, role), runs short of ICA / course
+    cover, and per worker how often they were out and what went unfilled.
+    """
+    rng = Random(seed)
+    roster = early + late
+    layout = DayPlanner([], [], role_to_column, ica_morning_count, ica_afternoon_count)
+    required = {
+        "morning": [r for r in layout.prioritized_roles_morning + ["Host", "Dekit"] if r in role_to_column],
+        "afternoon": [r for r in layout.prioritized_roles_afternoon + ["Host", "Dekit"] if r in role_to_column],
+        "evening": [r for r in EVENING_ICA_ROLES if r in role_to_column],
+    }
+    ica = set(ROLE_TO_TRAINING['ICA'])
+    course = set(layout.course_roles)
+
+    unfilled = defaultdict(int)
+    unfilled_total = ica_short = course_short = 0
+    absent_runs = defaultdict(int)
+    unfilled_when_absent = defaultdict(int)
+    ica_short_when_absent = defaultdict(int)
+
+    for _ in range(runs):
+        absent = rng.sample(roster, min(len(roster), rng.randint(min_absent, max_absent)))
+        out = {w.id for w in absent}
+        planner = DayPlanner(
+            [w for w in early if w.id not in out], [w for w in late if w.id not in out],
+            role_to_column, ica_morning_count, ica_afternoon_count,
+            pick=lambda candidates, role: rng.choice(candidates), quiet=True,
+        )
+        planner.assign_morning()
+        planner.assign_afternoon()
+        late_left = len(late) - sum(1 for w in absent if w.late)
+
+        missing = [("morning", r) for r in required["morning"] if r not in planner.valid_roles]
+        missing += [("afternoon", r) for r in required["afternoon"] if r not in planner.afternoon_valid_roles]
+        missing += [("evening", r) for r in required["evening"] if EVENING_ICA_ROLES.index(r) >= late_left]
+        for key in missing:
+            unfilled[key] += 1
+        short_ica = any(role in ica for _, role in missing)
+        ica_short += short_ica
+        course_short += any(role in course for _, role in missing)
+        unfilled_total += len(missing)
+        for worker_id in out:
+            absent_runs[worker_id] += 1
+            unfilled_when_absent[worker_id] += len(missing)
+            ica_short_when_absent[worker_id] += short_ica
+
+    return {
+        "runs": runs,
+        "required": required,
+        "unfilled": dict(unfilled),
+        "unfilled_total": unfilled_total,
+        "ica_short": ica_short,
+        "course_short": course_short,
+        "absent_runs": dict(absent_runs),
+        "unfilled_when_absent": dict(unfilled_when_absent),
+        "ica_short_when_absent": dict(ica_short_when_absent),
+    }
+
+
+def merge_simulations(chunks):
+    """Sum the tallies of several simulate_absences results."""
+    merged = {"runs": 0, "required": chunks[0]["required"], "unfilled_total": 0, "ica_short": 0, "course_short": 0}
+    for key in ("unfilled", "absent_runs", "unfilled_when_absent", "ica_short_when_absent"):
+        merged[key] = defaultdict(int)
+    for chunk in chunks:
+        for key in ("runs", "unfilled_total", "ica_short", "course_short"):
+            merged[key] += chunk[key]
+        for key in ("unfilled", "absent_runs", "unfilled_when_absent", "ica_short_when_absent"):
+            for k, v in chunk[key].items():
+                merged[key][k] += v
+    return merged
+
+
+def build_schedule(template, plan_date, ica_morning_count=4, ica_afternoon_count=4, print_until_hour=16):
+    """
+    Plan one day on a template from its site's roster. Returns the filled
+    workbook as xlsx bytes and the plan's assignments by worker id; get_plan
+    decides when those count toward fairness (record_day_plan).
+    """
+    # Separate workers into available and late-shift workers based on the selected date
+    in_today_workers, late_shift_workers = get_availability_store(template.site_id).roster(plan_date)
+    worker_ids = {w.name: w.id for w in in_today_workers + late_shift_workers}
+
+    # Recent per-role assignment counts for today's roster (one indexed read)
+    role_counts = load_role_counts(worker_ids.values())
+
+    def pick_worker(candidates, role):
+        """Random pick, weighted toward people who have done this role least lately."""
+        weights = [1.0 / (1 + role_counts.get((w.id, role), 0)) ** FAIRNESS_STRENGTH for w in candidates]
+        return choices(candidates, weights=weights)[0]
+
+    def kitup_load(worker):
+        return sum(role_counts.get((worker.id, r), 0) for r in ROLE_TO_TRAINING['KITUP'])
+
+
+    # Dynamically map roles based on the Excel file
+    workbook = openpyxl.load_workbook(template.path)
+    sheet = workbook.active
+    role_to_column = read_role_columns(sheet)
+
+    program = get_slot_program(template, print_until_hour)
+
+    planner = DayPlanner(
+        in_today_workers, late_shift_workers, role_to_column,
+        ica_morning_count, ica_afternoon_count, pick=pick_worker, kitup_key=kitup_load,
+    )
+    planner.assign_morning()
+    valid_roles = planner.valid_roles
+    morning_assignments = planner.morning_assignments
+    morning_spare_workers = planner.morning_spare_workers
+
+    # Track assigned workers in the morning
+    assigned_workers = set(valid_roles.values())
+    unassigned_workers = [worker.name for worker in in_today_workers + late_shift_workers if worker.name not in assigned_workers]
+
+    if unassigned_workers:
+        logging.debug("Unassigned workers found in the morning: %s", Lazy(lambda: ", ".join(unassigned_workers)))
+
+    planner.assign_afternoon()
+    planner.plan_morning_slots(len(program.morning_rows), program.morning_handovers)
+    planner.plan_afternoon_slots(len(program.afternoon_rows), program.afternoon_handovers)
+    afternoon_valid_roles = planner.afternoon_valid_roles
+    afternoon_spare_workers = planner.afternoon_spare_workers
+
+    logging.debug("Afternoon assignments: %s", Lazy(lambda: ", ".join(f"{role} -> {worker}" for role, worker in afternoon_valid_roles.items())))
+
+    # One pass over the compiled slot program writes every planner cell
+    late_names = [worker.name for worker in late_shift_workers]
+    program.render(sheet, program.values(planner.morning_slots, planner.afternoon_slots, late_names))
+
+    log_summary(
+        date=plan_date.isoformat(), template=template.name, print_until_hour=print_until_hour,
+        early=len(in_today_workers), late=len(late_shift_workers),
+        morning_spares=len(morning_spare_workers), afternoon_spares=len(afternoon_spare_workers),
+    )
+
+    # Track assigned workers in the afternoon
+    assigned_workers = set(afternoon_valid_roles.values())  
+    unassigned_workers = [worker.name for worker in in_today_workers + late_shift_workers if worker.name not in assigned_workers]
+
+    if unassigned_workers:
+        logging.debug("Unassigned workers found in the afternoon: %s", Lazy(lambda: ", ".join(unassigned_workers)))
+    
+    # spare summary section (after planner, around line 24+)
+    summary_start_row = 24
+
+    header_cell = sheet.cell(row=summary_start_row - 1, column=1)
+    header_cell.value = "Spare"
+    header_cell.font = Font(bold=True, size=14, color="FFFFFF")
+    header_cell.fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+
+    # Morning Spare Summary
+    morning_summary = (
+        f"Morning Spare Workers: {', '.join(morning_spare_workers)}"
+        if morning_spare_workers
+        else "Morning Spare Workers: No spare"
+    )
+    sheet.cell(row=summary_start_row, column=1).value = morning_summary
+
+    # Afternoon Spare Summary
+    afternoon_summary = (
+        f"Afternoon Spare Workers: {', '.join(afternoon_spare_workers)}"
+        if afternoon_spare_workers
+        else "Afternoon Spare Workers: No spare"
+    )
+    sheet.cell(row=summary_start_row + 1, column=1).value = afternoon_summary
+
+    # Define where to write the "Workers In Today" summary
+    summary_col = 27  # Column T
+    summary_start_row = 1
+
+    # Header
+    header_cell = sheet.cell(row=summary_start_row, column=summary_col)
+    header_cell.value = "Instructors"
+    header_cell.font = Font(bold=True, size=12, color="FFFFFF")
+    header_cell.fill = PatternFill(start_color="28A745", end_color="28A745", fill_type="solid")
+
+    # Sort workers by actual start time (shift times come straight from the store)
+    in_today_sorted = []
+
+    for worker in in_today_workers + late_shift_workers:
+        start_local = from_epoch_minutes(worker.start)
+        end_local = from_epoch_minutes(worker.end)
+        in_today_sorted.append((start_local, worker.name, start_local, end_local))
+
+    # Sort by start time
+    in_today_sorted.sort(key=lambda x: x[0])
+
+    # Write each worker
+    for i, (_, name, start_local, end_local) in enumerate(in_today_sorted, start=1):
+        row = summary_start_row + i
+        time_range = f"{start_local.strftime('%H:%M')} - {end_local.strftime('%H:%M')}"
+        sheet.cell(row=row, column=summary_col).value = f"{name} - {time_range}"
+
+    morning_by_role = {role: name for name, roles in morning_assignments.items() for role in roles}
+    assignments = plan_assignments(morning_by_role, afternoon_valid_roles, worker_ids)
+
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue(), assignments
+
+
+def record_day_plan(template, plan_date, assignments):
+    """Count a served plan toward the fairness counters for later days (commits; failures only log)."""
+    try:
+        save_day_plan(plan_date, template.name, assignments, template.site_id)
+    except Exception as e:
+        db.session.rollback()
+        logging.warning("Could not record plan for fairness tracking: %s", e)
+
+
+def roster_key(template, plan_date):
+    """Fingerprint of everything a day's plan is built from: the template, its rules and the roster."""
+    early, late = get_availability_store(template.site_id).roster(plan_date)
+    inputs = [template.sha256, template.rotation, early, late]
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_plan(template, plan_date, ica_morning_count=4, ica_afternoon_count=4, print_until_hour=16,
+             fresh=False, source="request"):
+    """
+    The stored workbook for these inputs while it is current, otherwise a newly
+    built one (which is stored). Returns (xlsx bytes, served from store).
+    Asking again returns the same plan until the roster changes; fresh=True
+    (the frontend's Regenerate) builds a new one, which replaces the stored
+    plan and its fairness counts.
+    The shared cache holds workbooks under their roster key, so a changed
+    roster simply misses and nothing needs invalidating.
+
+    Plans built with source="pregenerate" are speculative: their assignments
+    are parked on the stored plan and only reach the fairness counters when a
+    request first serves it, so unused pre-generated days don't skew picks.
+    """
+    options = f"{ica_morning_count}-{ica_afternoon_count}-{print_until_hour}"
+    key = roster_key(template, plan_date)
+    cache_key = f"plan:{template.site_id}:{template.name}:{plan_date}:{options}:{key}"
+    if not fresh:
+        xlsx = response_cache.get(cache_key, "plans")
+        if xlsx is not None:
+            return xlsx, True
+
+    stored = GeneratedPlan.query.filter_by(
+        site_id=template.site_id, plan_date=plan_date, template=template.name, options=options
+    ).first()
+    if stored is not None and stored.roster_key == key and not fresh:
+        xlsx = stored.workbook
+        if stored.pending_assignments is not None:
+            if source == "pregenerate":
+                return xlsx, True  # still speculative; not cached, so a request comes back here
+            assignments, stored.pending_assignments = stored.pending_assignments, None
+            record_day_plan(template, plan_date, assignments)  # commits the cleared flag with the counts
+        response_cache.set(cache_key, xlsx)
+        return xlsx, True
+
+    xlsx, assignments = build_schedule(template, plan_date, ica_morning_count, ica_afternoon_count, print_until_hour)
+    speculative = source == "pregenerate"
+    if not speculative:
+        record_day_plan(template, plan_date, assignments)
+    if stored is None:
+        stored = GeneratedPlan(site_id=template.site_id, plan_date=plan_date, template=template.name, options=options)
+        db.session.add(stored)
+    stored.roster_key = key
+    stored.workbook = xlsx
+    stored.source = source
+    stored.pending_assignments = assignments if speculative else None
+    stored.generated_at = datetime.now(timezone.utc)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # a concurrent request stored the same day first
+    if not speculative:
+        response_cache.set(cache_key, xlsx)
+    return xlsx, False
+
+
+def pregenerate_plans(site=DEFAULT_SITE, days=None, template_names=None, start=None):
+    """
+    Build a site's plans for `days` days from `start` (today) that are missing
+    or stale, warming the roster and slot-program caches on the way, and drop
+    its stored plans for past days. Returns counts of generated/current/empty days.
+    """
+    days = PREGENERATE_DAYS if days is None else days
+    start = start or datetime.now(TIMEZONE).date()
+    query = Template.query.filter_by(site_id=site).order_by(Template.name)
+    if template_names or PREGENERATE_TEMPLATES:
+        query = query.filter(Template.name.in_(template_names or PREGENERATE_TEMPLATES))
+
+    GeneratedPlan.query.filter(
+        GeneratedPlan.site_id == site, GeneratedPlan.plan_date < start
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+    counts = Counter()
+    for template in query.all():
+        if not template.path.exists():
+            continue
+        for offset in range(days):
+            plan_date = start + timedelta(days=offset)
+            early, late = get_availability_store(site).roster(plan_date)
+            if not early and not late:
+                counts["empty"] += 1
+                continue
+            for ica_morning_count, ica_afternoon_count, print_until_hour in PREGENERATE_OPTIONS:
+                get_slot_program(template, print_until_hour)
+                _, current = get_plan(
+                    template, plan_date, ica_morning_count, ica_afternoon_count, print_until_hour,
+                    source="pregenerate",
+                )
+                counts["current" if current else "generated"] += 1
+    return counts
+
+
+def known_sites():
+    """SITES plus every site that has uploaded a template."""
+    uploaded = {site for (site,) in db.session.query(Template.site_id).distinct()}
+    return sorted({DEFAULT_SITE, *SITES} | uploaded)
+
+
+def pregenerate_site(site, days=None, template_names=None):
+    """Pool task: one site's pass in a worker process."""
+    with app.app_context():
+        try:
+            return pregenerate_plans(site, days, template_names)
+        finally:
+            db.session.remove()
+
+
+def pregenerate_all_sites(days=None, template_names=None, sites=None):
+    """
+    pregenerate_plans() for every known site (or just `sites`). Sites share
+    nothing, so with more than one pool worker each site runs in its own
+    process. Returns {site: counts}.
+    """
+    sites = list(sites or known_sites())
+    if len(sites) == 1 or IMPORT_WORKERS == 1:
+        return {site: pregenerate_plans(site, days, template_names) for site in sites}
+    return dict(zip(sites, run_in_pool([(pregenerate_site, site, days, template_names) for site in sites])))
+
+
+pregenerate_wakeup = threading.Event()  # set by worker writes
+
+
+def pregenerate_loop():
+    """Background pass every PREGENERATE_INTERVAL, or soon after a worker write in this process."""
+    while True:
+        pregenerate_wakeup.wait(PREGENERATE_INTERVAL)
+        time.sleep(PREGENERATE_DEBOUNCE_SECONDS)
+        pregenerate_wakeup.clear()
+        slot = acquire_slot("pregenerate", 1)  # one gunicorn worker at a time
+        if slot is None:
+            continue
+        try:
+            with app.app_context():
+                counts_by_site = pregenerate_all_sites()
+            for site, counts in counts_by_site.items():
+                if counts["generated"]:
+                    logging.info("Pre-generated plans for site %s: %s", site, dict(counts))
+        except Exception as e:
+            logging.error("Error pre-generating plans: %s", e)
+        finally:
+            slot.close()
+
+
+@app.cli.command("pregenerate")
+@click.option("--days", type=int, default=None, help="Days ahead, starting today (default PREGENERATE_DAYS).")
+@click.option("--template", "template_names", multiple=True, help="Template name; repeat for several (default all).")
+@click.option("--site", "sites", multiple=True, help="Site id; repeat for several (default every known site).")
+def pregenerate_command(days, template_names, sites):
+    """Generate and store upcoming day plans (for cron)."""
+    for site, counts in pregenerate_all_sites(days, list(template_names), list(sites)).items():
+        click.echo(
+            f"{site}: {counts['generated']} generated, {counts['current']} already current, "
+            f"{counts['empty']} days with nobody in"
+        )
 
-            for role in ['Host', 'Dekit', 'Kit Up 1', 'Kit Up 2', 'Kit Up 3', 'Clip In 1', 'Clip In 2', 'Mini Trek']:
-                col = role_to_column.get(role)
-                if col:
-                    sheet.cell(row=slot_row, column=col).value = saved_afternoon_workers_all.get(role, "")
 
+# API endpoint to generate the schedule and save to Excel. Repeat requests get
+# the stored plan for the day (usually pre-generated) until the roster changes;
+# send {"fresh": true} to shuffle a new one.
+@app.route('/generate-schedule', methods=['POST'])
+def generate_schedule():
+    try:
+        selected_file = request.json.get('template')
+        selected_date_str = request.json.get('date')  # Get selected date from request
 
-        logging.info("\n======== SPARE WORKERS SUMMARY ========")
-        logging.info(f"Morning Spare Workers ({len(morning_spare_workers)}): {', '.join(morning_spare_workers) if morning_spare_workers else 'None'}")
-        afternoon_spare_workers = [
-            worker.name for worker in in_today_workers + late_shift_workers
-            if worker.name not in afternoon_valid_roles.values()
-        ]
+        ica_morning_count = request.json.get("ica_morning_count", 4)
+        ica_afternoon_count = request.json.get("ica_afternoon_count", 4)
 
-        # Log afternoon spare workers clearly
-        if afternoon_spare_workers:
-            logging.info(f"Afternoon Spare Workers ({len(afternoon_spare_workers)}): {', '.join(afternoon_spare_workers)}")
-        else:
-            logging.info("No Afternoon Spare Workers found.")
+        # Clamp values to stay between 2 and 4
+        ica_morning_count = max(2, min(4, int(ica_morning_count)))
+        ica_afternoon_count = max(2, min(4, int(ica_afternoon_count)))
 
-        logging.info("========================================")
+        # option to extend non-ICA printing to 4pm, 5pm, or 6pm
+        print_until_hour = int(request.json.get("print_until_hour", 16))
+        if print_until_hour not in (16, 17, 18):
+            print_until_hour = 16
 
-        # Fallback: Force assign Host and Dekit in afternoon if still unassigned and workers are left
-        for role in ["Host", "Dekit"]:
-            if role in role_to_column and role not in afternoon_valid_roles:
-                available_spares = [
-                    worker for worker in in_today_workers + late_shift_workers
-                    if worker.name not in afternoon_used_workers
-                ]
+        # Validate input
+        if not selected_file:
+            return jsonify({'error': 'Template is required'}), 400
+        if not selected_date_str:
+            return jsonify({'error': 'Date is required'}), 400
 
-                if available_spares:
-                    selected_worker = choice(available_spares)
-                    afternoon_valid_roles[role] = selected_worker.name
-                    afternoon_used_workers.add(selected_worker.name)
-                    logging.warning(f"⚠️ Fallback assigning {selected_worker.name} to {role} (afternoon fallback).")
+        try:
+            selected_date = datetime.strptime(selected_date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
 
+        selected_date = datetime.strptime(selected_date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)  # ⬅️ Convert to datetime
+        if not selected_file:
+            return jsonify({'error': 'No template selected'}), 400
 
-        # Track assigned workers in the afternoon
-        assigned_workers = set(afternoon_valid_roles.values())  
-        unassigned_workers = [worker.name for worker in in_today_workers + late_shift_workers if worker.name not in assigned_workers]
+        template = Template.query.filter_by(site_id=g.site_id, name=selected_file).first()
+        if not template or not template.path.exists():
+            return jsonify({'error': 'Selected template not found'}), 404
 
-        if unassigned_workers:
-            logging.warning(f"Unassigned workers found in the afternoon: {', '.join(unassigned_workers)}")
-        
-        # spare summary section (after planner, around line 24+)
-        summary_start_row = 24
-
-        header_cell = sheet.cell(row=summary_start_row - 1, column=1)
-        header_cell.value = "Spare"
-        header_cell.font = Font(bold=True, size=14, color="FFFFFF")
-        header_cell.fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-
-        # Morning Spare Summary
-        morning_summary = (
-            f"Morning Spare Workers: {', '.join(morning_spare_workers)}"
-            if morning_spare_workers
-            else "Morning Spare Workers: No spare"
+        xlsx, stored = get_plan(
+            template, selected_date.date(), ica_morning_count, ica_afternoon_count, print_until_hour,
+            fresh=bool(request.json.get("fresh")),
         )
-        sheet.cell(row=summary_start_row, column=1).value = morning_summary
+        log_summary(plan_stored=stored)
+        return send_file(BytesIO(xlsx), as_attachment=True, download_name="day_schedule.xlsx", mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
-        # Afternoon Spare Summary
-        afternoon_summary = (
-            f"Afternoon Spare Workers: {', '.join(afternoon_spare_workers)}"
-            if afternoon_spare_workers
-            else "Afternoon Spare Workers: No spare"
-        )
-        sheet.cell(row=summary_start_row + 1, column=1).value = afternoon_summary
+    except Exception as e:
+        logging.error("Error generating schedule: %s", e)
+        return jsonify({'error': str(e)}), 500
 
-        # Define where to write the "Workers In Today" summary
-        summary_col = 27  # Column T
-        summary_start_row = 1
 
-        # Header
-        header_cell = sheet.cell(row=summary_start_row, column=summary_col)
-        header_cell.value = "Instructors"
-        header_cell.font = Font(bold=True, size=12, color="FFFFFF")
-        header_cell.fill = PatternFill(start_color="28A745", end_color="28A745", fill_type="solid")
+# API endpoint to estimate staffing risk from random absences
+@app.route('/simulate', methods=['POST'])
+def simulate():
+    try:
+        started = time.perf_counter()
+        data = request.json or {}
+        try:
+            day = datetime.strptime(data.get("date", ""), "%Y-%m-%d").date()
+        except ValueError:
+            return jsonify({'error': 'Date is required as YYYY-MM-DD'}), 400
 
-        # Sort workers by actual start time
-        in_today_sorted = []
+        template = Template.query.filter_by(site_id=g.site_id, name=data.get("template")).first()
+        if not template:
+            return jsonify({'error': 'Selected template not found'}), 404
 
-        for worker in in_today_workers + late_shift_workers:
-            for availability in worker.availability:
-                try:
-                    start = parser.parse(availability["start"])
-                    end = parser.parse(availability["end"])
-
-                    # Normalize to local tz for display/sorting
-                    if start.tzinfo is None:
-                        start_local = start.replace(tzinfo=TIMEZONE)
-                    else:
-                        start_local = start.astimezone(TIMEZONE)
-
-                    if end.tzinfo is None:
-                        end_local = end.replace(tzinfo=TIMEZONE)
-                    else:
-                        end_local = end.astimezone(TIMEZONE)
-
-                    # Check date against the selected date (also in local tz)
-                    if start_local.date() <= selected_date.astimezone(TIMEZONE).date() <= end_local.date():
-                        in_today_sorted.append((start_local, worker.name, start_local, end_local))
-                        break
-                except Exception as e:
-                    logging.warning(f"Skipping invalid availability for {worker.name}: {e}")
-
-        # Sort by start time
-        in_today_sorted.sort(key=lambda x: x[0])
-
-        # Write each worker
-        for i, (_, name, start_local, end_local) in enumerate(in_today_sorted, start=1):
-            row = summary_start_row + i
-            time_range = f"{start_local.strftime('%H:%M')} - {end_local.strftime('%H:%M')}"
-            sheet.cell(row=row, column=summary_col).value = f"{name} - {time_range}"
-
-        # Save and send the Excel file
-        output = BytesIO()
-        workbook.save(output)
-        output.seek(0)
-        return send_file(output, as_attachment=True, download_name="day_schedule.xlsx", mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        numbers = {}
+        for field, default in (("ica_morning_count", 4), ("ica_afternoon_count", 4), ("runs", SIMULATION_RUNS),
+                               ("min_absent", 1), ("max_absent", 3), ("seed", None)):
+            value = data.get(field, default)
+            try:
+                numbers[field] = time.time_ns() if field == "seed" and value is None else int(value)
+            except (TypeError, ValueError):
+                return jsonify({'error': f'{field} must be an integer'}), 400
+        ica_morning_count = max(2, min(4, numbers["ica_morning_count"]))
+        ica_afternoon_count = max(2, min(4, numbers["ica_afternoon_count"]))
+        runs = max(1, min(SIMULATION_MAX_RUNS, numbers["runs"]))
+        min_absent = max(0, numbers["min_absent"])
+        max_absent = max(min_absent, numbers["max_absent"])
+        seed = numbers["seed"]
+
+        early, late = get_availability_store(g.site_id).roster(day)
+        if not early and not late:
+            return jsonify({'error': 'Nobody is available on that date'}), 400
+        role_to_column = template.role_columns
+
+        # One chunk per pool worker, each with its own seed so runs are reproducible
+        chunk_count = min(IMPORT_WORKERS, runs)
+        sizes = [runs // chunk_count + (i < runs % chunk_count) for i in range(chunk_count)]
+        args = (early, late, role_to_column, ica_morning_count, ica_afternoon_count)
+        if chunk_count == 1:
+            chunks = [simulate_absences(*args, runs, min_absent, max_absent, seed)]
+        else:
+            chunks = run_in_pool([
+                (simulate_absences, *args, size, min_absent, max_absent, seed + i) for i, size in enumerate(sizes)
+            ])
+        result = merge_simulations(chunks)
+
+        baseline = result["unfilled_total"] / runs
+        names = {w.id: w.name for w in early + late}
+        critical = []
+        for worker_id, absent_runs in result["absent_runs"].items():
+            mean_unfilled = result["unfilled_when_absent"][worker_id] / absent_runs
+            critical.append({
+                "id": worker_id,
+                "name": names[worker_id],
+                "absent_runs": absent_runs,
+                "mean_unfilled_when_absent": round(mean_unfilled, 3),
+                "impact": round(mean_unfilled - baseline, 3),
+                "p_ica_short_when_absent": round(result["ica_short_when_absent"][worker_id] / absent_runs, 4),
+            })
+        critical.sort(key=lambda c: c["impact"], reverse=True)
 
+        return jsonify({
+            "date": day.isoformat(),
+            "template": template.name,
+            "runs": runs,
+            "seed": seed,
+            "absent": [min_absent, max_absent],
+            "roster": {"early": len(early), "late": len(late)},
+            "p_unfilled": {
+                phase: {role: round(result["unfilled"].get((phase, role), 0) / runs, 4) for role in roles}
+                for phase, roles in result["required"].items()
+            },
+            "p_ica_short": round(result["ica_short"] / runs, 4),
+            "p_course_short": round(result["course_short"] / runs, 4),
+            "mean_unfilled": round(baseline, 3),
+            "critical_workers": critical[:10],
+            "parallel_chunks": chunk_count,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }), 200
     except Exception as e:
-        logging.error(f"Error generating schedule: {e}")
+        logging.error("Error running absence simulation: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -1205,60 +4130,73 @@ def create_worker():
             name=data["name"],
             roles=data["roles"],
             availability=data["availability"],
+            site_id=g.site_id,
         )
         db.session.add(new_worker)
-        db.session.commit()
+        try:
+            record_worker_changes([new_worker], "create")
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({"error": f"A worker named {data['name']!r} already exists"}), 409
 
-        logging.info(f"Worker {new_worker.name} created successfully.")
+        log_summary(worker_id=new_worker.id)
         return jsonify({
             "message": "Worker created successfully",
-            "worker": {
-                "id": new_worker.id,
-                "name": new_worker.name,
-                "roles": new_worker.roles,
-                "availability": new_worker.availability,
-            },
+            "worker": new_worker.to_dict(),
         }), 201
     except Exception as e:
-        logging.error(f"Error creating worker: {e}")
+        logging.error("Error creating worker: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # API endpoint to update a worker by ID
 @app.route("/workers/<int:worker_id>", methods=["PUT"])
 def update_worker(worker_id):
     try:
-        worker = Worker.query.get(worker_id)
+        worker = site_worker(worker_id)
         if not worker:
             return jsonify({"error": f"No worker found with ID {worker_id}"}), 404
 
         data = request.get_json()
 
+        # Clients send back the version they loaded (body or If-Match); a stale one is a conflict
+        try:
+            expected_version = expected_worker_version(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if expected_version is not None and expected_version != worker.version:
+            return version_conflict(worker)
+
         worker.name = data.get("name", worker.name)
         worker.roles = data.get("roles", worker.roles)
 
         if "availability" in data:
             worker.availability = [
                 {
-                    "start": parser.parse(a["start"]).isoformat(),
-                    "end": parser.parse(a["end"]).isoformat(),
+                    "start": parse_timestamp(a["start"]).isoformat(),
+                    "end": parse_timestamp(a["end"]).isoformat(),
                     "late": bool(a.get("late", False)),
                 }
                 for a in data["availability"]
             ]
 
-        db.session.commit()
+        try:
+            record_worker_changes([worker], "update")
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({"error": f"A worker named {data.get('name')!r} already exists"}), 409
+        except StaleDataError:
+            # someone else committed between our read and our write
+            db.session.rollback()
+            return version_conflict(site_worker(worker_id))
 
         return jsonify({
             "message": "Worker updated successfully",
-            "worker": {
-                "id": worker.id,
-                "name": worker.name,
-                "roles": worker.roles,
-                "availability": worker.availability,
-            },
+            "worker": worker.to_dict(),
         }), 200
     except Exception as e:
-        logging.error(f"Error updating worker {worker_id}: {e}")
+        logging.error("Error updating worker %s: %s", worker_id, e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -1266,17 +4204,144 @@ def update_worker(worker_id):
 @app.route("/workers/<int:worker_id>", methods=["DELETE"])
 def delete_worker(worker_id):
     try:
-        worker = Worker.query.get(worker_id)
+        worker = site_worker(worker_id)
         if not worker:
             return jsonify({"error": f"Worker with ID {worker_id} not found"}), 404
 
-        db.session.delete(worker)
-        db.session.commit()
+        try:
+            expected_version = expected_worker_version(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if expected_version is not None and expected_version != worker.version:
+            return version_conflict(worker)
+
+        try:
+            db.session.delete(worker)
+            record_worker_changes([worker], "delete")
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            current = site_worker(worker_id)
+            if current is None:
+                return jsonify({"error": f"Worker with ID {worker_id} not found"}), 404
+            return version_conflict(current)
 
         return jsonify({"message": "Worker deleted successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+
+def site_worker(worker_id):
+    """The worker with this id if it belongs to the request's site; other sites' ids are not found."""
+    return Worker.query.filter_by(id=worker_id, site_id=g.site_id).first()
+
+
+def expected_worker_version(data):
+    """
+    Version the client based its edit on, from the JSON body or an If-Match
+    header. Raises ValueError (answered as a 400) when it isn't a number.
+    """
+    raw = (data or {}).get("version", request.headers.get("If-Match"))
+    if raw is None or raw == "":
+        return None
+    try:
+        return int(str(raw).strip('"W/'))
+    except ValueError:
+        source = "version" if data and "version" in data else "If-Match"
+        raise ValueError(f"{source} must be a worker version number, got {raw!r}")
+
+
+def version_conflict(worker):
+    """409 carrying the current state so the client can merge and resend."""
+    return jsonify({
+        "error": "Worker was changed by someone else, reload and try again",
+        "worker": worker.to_dict(),
+    }), 409
+
+# Admin endpoints for recorded profiles (same X-Profile-Token as profiling itself)
+@app.route("/admin/profiles", methods=["GET"])
+def list_profiles():
+    if not profile_token_ok():
+        return jsonify({"error": "Forbidden"}), 403
+    profiles = []
+    for meta in sorted(PROFILE_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True):
+        try:
+            profiles.append(json.loads(meta.read_text()))
+        except (OSError, ValueError):
+            continue
+    return jsonify({"profiles": profiles}), 200
+
+
+@app.route("/admin/profiles/<profile_id>", methods=["GET"])
+def download_profile(profile_id):
+    """?format=pstats (default, for snakeviz / pstats), folded (flamegraphs) or text (top functions)."""
+    if not profile_token_ok():
+        return jsonify({"error": "Forbidden"}), 403
+    profile_id = re.sub(r"[^A-Za-z0-9_-]", "", profile_id)
+    kind = request.args.get("format", "pstats")
+    if kind not in ("pstats", "folded", "text"):
+        return jsonify({"error": "format must be pstats, folded or text"}), 400
+    stats_path = PROFILE_DIR / f"{profile_id}.pstats"
+    if not stats_path.exists():
+        return jsonify({"error": "Profile not found"}), 404
+
+    if kind == "pstats":
+        return send_file(stats_path.resolve(), as_attachment=True, download_name=stats_path.name)
+    if kind == "folded":
+        return send_file(
+            (PROFILE_DIR / f"{profile_id}.folded").resolve(), as_attachment=True,
+            download_name=f"{profile_id}.folded", mimetype="text/plain",
+        )
+    out = io.StringIO()
+    pstats.Stats(str(stats_path), stream=out).sort_stats("cumulative").print_stats(40)
+    return Response(out.getvalue(), mimetype="text/plain")
+
+
+# Admission metrics: slot and queue gauges are host-wide; rejection counts are
+# this worker process's (the request log's "rejected" field covers all of them)
+@app.route("/admin/admission", methods=["GET"])
+def admission_metrics():
+    if not profile_token_ok():
+        return jsonify({"error": "Forbidden"}), 403
+    endpoints = {}
+    for endpoint, limit in ADMISSION_LIMITS.items():
+        if not limit:
+            continue
+        endpoints[endpoint] = {
+            "limit": limit,
+            "in_flight": slots_in_use(endpoint, limit),
+            "queued": slots_in_use(f"{endpoint}.queue", ADMISSION_QUEUE_DEPTH),
+            "rejected": {reason: n for (name, reason), n in admission_rejections.items() if name == endpoint},
+        }
+    return jsonify({
+        "pid": os.getpid(),
+        "capacity": ADMISSION_CAPACITY,
+        "heavy_slots": ADMISSION_HEAVY_SLOTS,
+        "heavy_in_use": slots_in_use("heavy", ADMISSION_HEAVY_SLOTS),
+        "queue_depth": ADMISSION_QUEUE_DEPTH,
+        "queue_timeout": ADMISSION_QUEUE_TIMEOUT,
+        "endpoints": endpoints,
+    }), 200
+
+
+@app.route("/admin/cache", methods=["GET"])
+def cache_metrics():
+    if not profile_token_ok():
+        return jsonify({"error": "Forbidden"}), 403
+    kinds = {}
+    for kind, counts in response_cache.stats.items():
+        lookups = counts["hits"] + counts["misses"]
+        kinds[kind] = {**counts, "hit_rate": round(counts["hits"] / lookups, 3) if lookups else None}
+    return jsonify({
+        "pid": os.getpid(),  # hit/miss counts are this process's; entries are the backend's
+        "backend": response_cache.name,
+        "ttl": CACHE_TTL,
+        **response_cache.describe(),
+        "kinds": kinds,
+        "invalidations": dict(response_cache.invalidations),
+    }), 200
+
+
 @app.route("/login", methods=["POST"])
 def login():
     data = request.get_json() or {}
@@ -1292,11 +4357,318 @@ def login():
 def home():
     return "Flask app is running!"
 
-# Create the database tables
-with app.app_context():
+# Columns added after the first deploy: create_all() never alters an existing
+# table, so these are added in place (and backfilled) by ensure_schema()
+COLUMN_MIGRATIONS = [
+    ("worker", "name_normalized", "VARCHAR(100)"),
+    ("worker", "version", "INTEGER NOT NULL DEFAULT 1"),
+    ("template", "rotation", "JSON"),
+    ("worker", "roles_mask", "INTEGER NOT NULL DEFAULT 0"),
+    *(
+        (table, "site_id", f"VARCHAR(50) NOT NULL DEFAULT '{DEFAULT_SITE}'")  # existing rows join the default site
+        for table in ("worker", "template", "day_plan", "generated_plan", "worker_change")
+    ),
+    ("generated_plan", "pending_assignments", "JSON"),
+]
+
+# global uniqueness that became per-site: (table, index or constraint name)
+SUPERSEDED_INDEXES = [
+    ("worker", "ix_worker_name_normalized"),
+    ("worker", "ix_worker_roles_mask"),
+    ("template", "ix_template_name"),
+]
+SUPERSEDED_CONSTRAINTS = [
+    ("day_plan", "uq_day_plan_date_template"),
+    ("generated_plan", "uq_generated_plan"),
+]
+
+
+def backfill_name_normalized(conn):
+    """Fill name_normalized for rows created before the column existed."""
+    rows = conn.execute(text("SELECT id, name FROM worker WHERE name_normalized IS NULL ORDER BY id")).all()
+    if not rows:
+        return
+    taken = {k for (k,) in conn.execute(text("SELECT name_normalized FROM worker WHERE name_normalized IS NOT NULL"))}
+    for worker_id, name in rows:
+        key = normalize_name(name)
+        if key in taken:
+            # keep the index unique; the older row keeps the clean key
+            logging.warning("Duplicate worker name %r (id %s); rename it to make it importable", name, worker_id)
+            key = f"{key} #{worker_id}"
+        taken.add(key)
+        conn.execute(
+            text("UPDATE worker SET name_normalized = :key WHERE id = :id"),
+            {"key": key, "id": worker_id},
+        )
+    logging.info("Backfilled normalized names for %s workers", len(rows))
+
+
+def backfill_roles_mask(conn):
+    """Fill roles_mask for rows written before the column existed (or by hand)."""
+    rows = conn.execute(text("SELECT id, roles, roles_mask FROM worker WHERE roles_mask = 0")).all()
+    stale = []
+    for worker_id, roles, mask in rows:
+        if isinstance(roles, str):  # JSON comes back as text on some drivers
+            roles = json.loads(roles)
+        if roles_mask(roles) != mask:
+            stale.append({"mask": roles_mask(roles), "id": worker_id})
+    if stale:
+        conn.execute(text("UPDATE worker SET roles_mask = :mask WHERE id = :id"), stale)
+        logging.info("Backfilled roles_mask for %s workers", len(stale))
+
+
+def drop_superseded_indexes(conn):
+    """Drop indexes replaced by (site_id, ...) ones; a global unique name index would block per-site names."""
+    inspector = inspect(conn)
+    for table, name in SUPERSEDED_INDEXES:
+        if name in {index["name"] for index in inspector.get_indexes(table)}:
+            conn.execute(text(f"DROP INDEX {name} ON {table}" if conn.dialect.name == "mysql" else f"DROP INDEX {name}"))
+            logging.info("Dropped index %s", name)
+
+
+def rebuild_sqlite_table(conn, table):
+    """SQLite can't drop a constraint: recreate the table from the model and copy its rows across."""
+    columns = ", ".join(c["name"] for c in inspect(conn).get_columns(table.name) if c["name"] in table.c)
+    indexes = conn.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"),
+        {"table": table.name},
+    ).scalars().all()
+    for name in indexes:
+        conn.execute(text(f"DROP INDEX {name}"))
+    conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {table.name}_old"))
+    table.create(conn)
+    conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {table.name}_old"))
+    conn.execute(text(f"DROP TABLE {table.name}_old"))
+
+
+def rescope_unique_constraints(conn):
+    """Swap the plans' unique constraints for the per-site ones on the models."""
+    inspector = inspect(conn)
+    for table_name, name in SUPERSEDED_CONSTRAINTS:
+        if name not in {c["name"] for c in inspector.get_unique_constraints(table_name)}:
+            continue
+        table = db.metadata.tables[table_name]
+        if conn.dialect.name == "sqlite":
+            rebuild_sqlite_table(conn, table)
+        else:
+            keyword = "INDEX" if conn.dialect.name == "mysql" else "CONSTRAINT"
+            conn.execute(text(f"ALTER TABLE {table_name} DROP {keyword} {name}"))
+            for constraint in table.constraints:
+                if isinstance(constraint, db.UniqueConstraint):
+                    conn.execute(AddConstraint(constraint))
+        logging.info("Replaced constraint %s with a per-site one", name)
+
+
+@contextmanager
+def schema_lock():
+    """
+    Serialize schema changes across every process that boots the app: each
+    gunicorn worker runs them at import, and two of them adding the same
+    column would fail the second. Postgres and MySQL take a session lock on a
+    connection held for the duration, so it covers every host; SQLite, a local
+    file, takes an flock next to the admission slots.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        with db.engine.connect() as conn:
+            key = advisory_lock_key("dayplanner:schema")
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": key})
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+    elif dialect in ("mysql", "mariadb"):
+        with db.engine.connect() as conn:
+            if conn.execute(text("SELECT GET_LOCK('dayplanner_schema', 300)")).scalar() != 1:
+                raise RuntimeError("Timed out waiting for another process to finish migrating the schema")
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT RELEASE_LOCK('dayplanner_schema')"))
+    else:
+        with open(ADMISSION_DIR / "schema.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+
+def ensure_schema():
+    """
+    Add missing columns and indexes to an existing database. Call it under
+    schema_lock(), so the columns it sees missing are still missing when it
+    adds them.
+    """
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        for table, column, ddl in COLUMN_MIGRATIONS:
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            if column not in existing:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                logging.info("Added column %s.%s", table, column)
+
+        backfill_name_normalized(conn)
+        backfill_roles_mask(conn)
+        drop_superseded_indexes(conn)
+        rescope_unique_constraints(conn)
+
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+
+def check_sqlite_json():
+    """The JSON columns need SQLite's JSON1 functions (built in since SQLite 3.38)."""
+    if db.engine.dialect.name != "sqlite":
+        return
+    with db.engine.connect() as conn:
+        try:
+            conn.execute(text("SELECT json_valid('{}')"))
+        except Exception as e:
+            raise RuntimeError(f"SQLite {sqlite3.sqlite_version} was built without JSON support") from e
+        mode = conn.execute(text("PRAGMA journal_mode")).scalar()
+    # DATABASE_URI wins over EMBEDDED_DB, so only the fallback file is "embedded"
+    kind = "Embedded SQLite" if EMBEDDED_DB and not os.getenv("DATABASE_URI") else "SQLite"
+    logging.info("%s database at %s (journal_mode=%s)", kind, db.engine.url.database, mode)
+
+
+def copy_database(source_engine, target_engine, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Copy every app table from one database to another, e.g. embedded SQLite to
+    Postgres/MySQL or back. The target gets this app's schema and must be empty;
+    the source must be up to date (start the app against it once first).
+    Returns {table: rows copied}.
+    """
+    db.metadata.create_all(target_engine)
+    copied = {}
+    with source_engine.connect() as source, target_engine.begin() as target:
+        for table in db.metadata.sorted_tables:
+            if target.execute(select(func.count()).select_from(table)).scalar():
+                raise ValueError(f"Target table {table.name} is not empty")
+
+        # parents before children, so foreign keys hold on the way in
+        for table in db.metadata.sorted_tables:
+            copied[table.name] = 0
+            result = source.execute(select(table).execution_options(yield_per=batch_size))
+            for rows in result.partitions():
+                target.execute(table.insert(), [row._asdict() for row in rows])
+                copied[table.name] += len(rows)
+
+        # explicit ids don't advance Postgres sequences; point them past the copied rows
+        if target.dialect.name == "postgresql":
+            for table in db.metadata.sorted_tables:
+                if "id" in table.c and table.c.id.autoincrement is not False and table.c.id.primary_key:
+                    target.execute(text(
+                        f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                        f"COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1, false)"
+                    ))
+    return copied
+
+
+@app.cli.command("copy-db")
+@click.argument("target")
+@click.option("--source", default=None, help="Database URI to copy from (default: this app's database).")
+def copy_db_command(target, source):
+    """Copy all data to the database at TARGET (a SQLAlchemy URI)."""
+    source_engine = create_engine(source) if source else db.engine
+    try:
+        copied = copy_database(source_engine, create_engine(target))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for table, rows in copied.items():
+        click.echo(f"{table}: {rows} rows")
+
+
+def bench_worker_payload(workers, entries=60, repeat=5):
+    """
+    Best-of-`repeat` serialize and compress times and sizes for a synthetic
+    /workers body of `workers` workers with `entries` shifts each, through
+    the stdlib encoder, the app's JSON provider and each response encoding.
+    """
+    base = datetime(2026, 1, 5, 9, tzinfo=TIMEZONE)
+    payload = {"workers": [
+        Worker(
+            id=i, name=f"Worker {i:04d}", roles=TRAININGS[:i % 4], version=1,
+            availability=[
+                {
+                    "start": (base + timedelta(days=d)).isoformat(),
+                    "end": (base + timedelta(days=d, hours=8)).isoformat(),
+                    "late": d % 5 == 0,
+                }
+                for d in range(entries)
+            ],
+        ).to_dict()
+        for i in range(1, workers + 1)
+    ]}
+
+    def best(fn):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = fn()
+            timings.append((time.perf_counter() - started) * 1000)
+        return min(timings), result
+
+    stdlib_ms, body = best(lambda: json.dumps(payload).encode())
+    cases = [("stdlib json", stdlib_ms, body)]
+    if orjson is not None:
+        cases.append(("orjson", *best(lambda: app.json.dumps(payload).encode())))
+        body = cases[-1][2]
+    cases.append((f"gzip -{COMPRESS_LEVEL}", *best(lambda: gzip.compress(body, compresslevel=COMPRESS_LEVEL))))
+    if brotli is not None:
+        cases.append((f"brotli q{BROTLI_QUALITY}", *best(lambda: brotli.compress(body, quality=BROTLI_QUALITY))))
+
+    click.echo(f"{workers} workers x {entries} shifts, best of {repeat}")
+    for label, ms, data in cases:
+        click.echo(f"  {label:<24} {ms:7.2f} ms   {len(data) / 1024:9.1f} KB")
+
+
+@app.cli.command("bench")
+@click.option("--requests", "count", type=int, default=50, help="Requests per endpoint.")
+@click.option("--payload-workers", type=int, default=1000, help="Workers in the /workers serialization case (0 skips it).")
+def bench_command(count, payload_workers):
+    """
+    Latency of the read endpoints against the configured database. Run it once
+    with EMBEDDED_DB=1 (the local SQLite file) and once with DATABASE_URI set to
+    a server to compare. Then serializes and compresses a synthetic /workers
+    payload (bench_worker_payload).
+    """
+    client = app.test_client()
+    start = datetime.now(TIMEZONE).date()
+    targets = {
+        "SELECT 1 (round trip)": None,
+        "GET /workers": "/workers",
+        "GET /workers/changes": "/workers/changes?since=0",
+        "GET /coverage (7 days)": f"/coverage?start={start}&end={start + timedelta(days=6)}",
+        "GET /list-templates": "/list-templates",
+    }
+    request_log.setLevel(logging.WARNING)  # keep the summary lines out of the report
+    click.echo(f"{db.engine.dialect.name} ({db.engine.url.render_as_string(hide_password=True)}), {count} requests each")
+    for label, path in targets.items():
+        timings = []
+        for _ in range(count):
+            started = time.perf_counter()
+            if path is None:
+                with db.engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+            else:
+                client.get(path)
+            timings.append((time.perf_counter() - started) * 1000)
+        p50, p95 = np.percentile(timings, [50, 95])
+        click.echo(f"  {label:<24} p50 {p50:7.2f} ms   p95 {p95:7.2f} ms")
+    if payload_workers:
+        bench_worker_payload(payload_workers)
+
+
+# Create the database tables, one booting process at a time
+with app.app_context(), schema_lock():
     db.create_all()
+    ensure_schema()
+    check_sqlite_json()
+    index_legacy_templates()
     logging.info("Database tables created successfully!")
 
+if PREGENERATE_INTERVAL > 0:
+    threading.Thread(target=pregenerate_loop, name="pregenerate", daemon=True).start()
+
 # Run the app
 if __name__ == "__main__":
     logging.info("Starting Flask app...")
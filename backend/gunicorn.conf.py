@@ -0,0 +1,10 @@
+# Gunicorn settings; the Procfile points gunicorn here.
+# gthread workers, so a streamed response (/workers/changes/stream) holds one
+# thread rather than a whole worker process. WEB_CONCURRENCY x GUNICORN_THREADS
+# is also the app's default ADMISSION_CAPACITY.
+import os
+
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
@@ -0,0 +1,135 @@
+"""
+Shared fixtures. The app configures itself from the environment when it is
+imported, so this points it at a scratch directory (SQLite database,
+template store, admission slots) before importing it once per session.
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+from datetime import date
+from pathlib import Path
+
+import openpyxl
+import pytest
+
+BACKEND = Path(__file__).resolve().parents[1]
+SCRATCH = Path(tempfile.mkdtemp(prefix="dayplanner-tests-"))
+
+os.environ.update({
+    "DATABASE_URI": f"sqlite:///{SCRATCH / 'test.db'}",
+    "CACHE_BACKEND": "memory",
+    "ADMISSION_DIR": str(SCRATCH / "admission"),
+    "IMPORT_WORKERS": "1",
+    "PREGENERATE_INTERVAL": "0",
+    "LOG_LEVEL": "WARNING",
+    "LOG_FORMAT": "text",
+    "MAX_UPLOAD_BYTES": str(1024 * 1024),
+    "MAX_UPLOAD_SHEETS": "5",
+})
+(SCRATCH / "uploaded_templates").mkdir()
+for bundled in (BACKEND / "uploaded_templates").glob("*.xlsx"):
+    shutil.copy(bundled, SCRATCH / "uploaded_templates")
+os.chdir(SCRATCH)
+sys.path.insert(0, str(BACKEND))
+
+import app as dayplanner  # noqa: E402
+
+# clean_state empties every table, so never run against anything but the scratch database
+assert dayplanner.app.config["SQLALCHEMY_DATABASE_URI"] == f"sqlite:///{SCRATCH / 'test.db'}", "tests must use the scratch database"
+
+WEEKDAY_TEMPLATE = "Empty - Weekday.xlsx"
+PLAN_DAY = date(2026, 11, 16)
+ROLE_MIX = [["KITUP"], ["AATT"], ["KITUP", "AATT"], ["ICA"], ["MT", "AATT"], ["ICA", "KITUP"]]
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    """Every test starts from empty tables (bundled templates re-indexed) and empty caches."""
+    with dayplanner.app.app_context():
+        for table in reversed(dayplanner.db.metadata.sorted_tables):
+            dayplanner.db.session.execute(table.delete())
+        dayplanner.db.session.commit()
+        dayplanner.index_legacy_templates()
+    dayplanner.availability_stores.clear()
+    dayplanner.response_cache = dayplanner.make_cache("memory")
+    yield
+    with dayplanner.app.app_context():
+        dayplanner.db.session.remove()
+
+
+@pytest.fixture
+def app_module():
+    return dayplanner
+
+
+@pytest.fixture
+def client():
+    return dayplanner.app.test_client()
+
+
+@pytest.fixture
+def make_worker(client):
+    """POST a worker and return its JSON; shifts are (start, end) ISO pairs."""
+    def make(name, roles=(), shifts=(), site=None, late=False):
+        resp = client.post(
+            "/workers",
+            json={
+                "name": name,
+                "roles": list(roles),
+                "availability": [{"start": start, "end": end, "late": late} for start, end in shifts],
+            },
+            headers={"X-Site-ID": site} if site else {},
+        )
+        assert resp.status_code == 201, resp.get_json()
+        return resp.get_json()["worker"]
+    return make
+
+
+@pytest.fixture
+def availability_workbook():
+    """
+    xlsx bytes in the rota layout the importer reads: one sheet per
+    (title, "DD/MM/YYYY", [(name, "09:00-17:00"), ...]), date in B22 and rows from B24/D24.
+    """
+    def build(sheets):
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        for title, day, rows in sheets:
+            sheet = workbook.create_sheet(title)
+            sheet["B22"] = f"Date {day}"
+            for offset, (name, hours) in enumerate(rows):
+                sheet.cell(24 + offset, 2).value = name
+                sheet.cell(24 + offset, 4).value = hours
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        return buffer.getvalue()
+    return build
+
+
+@pytest.fixture
+def upload(client):
+    """POST bytes as a multipart file to an upload endpoint."""
+    def post(path, data, filename, **params):
+        query = "&".join(f"{key}={value}" for key, value in params.items())
+        return client.post(
+            f"{path}?{query}" if query else path,
+            data={"file": (io.BytesIO(data), filename)},
+            content_type="multipart/form-data",
+        )
+    return post
+
+
+@pytest.fixture
+def staffed_day(make_worker):
+    """Eighteen workers with mixed roles on PLAN_DAY, every sixth of them on the late shift."""
+    workers = []
+    for n in range(18):
+        late = n % 6 == 5
+        start, end = ("13:00", "21:00") if late else ("08:30", "17:00")
+        workers.append(make_worker(
+            f"W{n:02d}", roles=ROLE_MIX[n % len(ROLE_MIX)],
+            shifts=[(f"{PLAN_DAY}T{start}:00+00:00", f"{PLAN_DAY}T{end}:00+00:00")], late=late,
+        ))
+    return workers
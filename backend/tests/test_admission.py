@@ -0,0 +1,82 @@
+"""Admission control: endpoint queues, the heavy-work share and stream slots."""
+import threading
+import time
+
+import pytest
+
+from conftest import PLAN_DAY, WEEKDAY_TEMPLATE
+
+COVERAGE = f"/coverage?start={PLAN_DAY}&end={PLAN_DAY}"
+
+
+@pytest.fixture
+def held(app_module):
+    """Hold slots the way a running request does; all released at teardown."""
+    slots = []
+
+    def hold(pool, size):
+        taken = [app_module.acquire_slot(pool, size) for _ in range(size)]
+        assert None not in taken
+        slots.extend(taken)
+        return taken
+    yield hold
+    for slot in slots:
+        slot.close()
+
+
+@pytest.fixture
+def limits(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "ADMISSION_HEAVY_SLOTS", 2)
+    monkeypatch.setattr(app_module, "ADMISSION_QUEUE_DEPTH", 2)
+    monkeypatch.setattr(app_module, "ADMISSION_QUEUE_TIMEOUT", 5)
+    monkeypatch.setitem(app_module.ADMISSION_LIMITS, "generate_schedule", 1)
+    return app_module
+
+
+def rejection(resp):
+    return resp.status_code, resp.get_json().get("reason")
+
+
+def test_queued_requests_hold_no_heavy_slot(app_module, limits, held, staffed_day):
+    running, = held("generate_schedule", 1)  # one plan already running
+    results = []
+
+    def queued():
+        client = app_module.app.test_client()
+        results.append(client.post("/generate-schedule", json={"template": WEEKDAY_TEMPLATE, "date": str(PLAN_DAY)}))
+
+    waiters = [threading.Thread(target=queued) for _ in range(2)]
+    for thread in waiters:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while app_module.slots_in_use("generate_schedule.queue", 2) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    client = app_module.app.test_client()
+    assert app_module.slots_in_use("heavy", 2) == 0
+    assert client.get(COVERAGE).status_code == 200  # other heavy endpoints still run
+    assert rejection(client.post("/generate-schedule", json={})) == (429, "queue_full")
+
+    running.close()  # the running plan finishes; the waiters go one at a time
+    for thread in waiters:
+        thread.join()
+    assert [resp.status_code for resp in results] == [200, 200]
+
+
+def test_full_heavy_share_is_503_and_frees_the_endpoint_slot(app_module, limits, held):
+    held("heavy", 2)
+    resp = app_module.app.test_client().get(COVERAGE)
+    assert rejection(resp) == (503, "capacity")
+    assert resp.headers["Retry-After"] == str(app_module.ADMISSION_RETRY_AFTER)
+    assert app_module.slots_in_use("coverage", app_module.ADMISSION_LIMITS["coverage"]) == 0
+
+
+def test_streams_use_their_own_slots(app_module, held, monkeypatch):
+    monkeypatch.setattr(app_module, "ADMISSION_HEAVY_SLOTS", 1)
+    monkeypatch.setitem(app_module.ADMISSION_LIMITS, "stream_worker_changes", 1)
+    held("heavy", 1)
+    client = app_module.app.test_client()
+    assert client.get("/workers").status_code == 200  # light requests are never admitted
+
+    held("stream_worker_changes", 1)
+    assert rejection(client.get("/workers/changes/stream")) == (503, "streams_full")
@@ -0,0 +1,92 @@
+"""Availability imports: duplicate uploads, force, dry runs and the parsed-sheet cache."""
+import pytest
+
+CSV = b"name,date,start,end\nAnn,2026-11-20,09:00,17:00\nBob,2026-11-20,10:00,18:00\n"
+
+
+@pytest.fixture
+def roster(make_worker):
+    return [make_worker("Ann"), make_worker("Bob")]
+
+
+def import_availability(upload, data, filename, **params):
+    resp = upload("/upload-worker-availability", data, filename, **params)
+    assert resp.status_code == 200, resp.get_json()
+    return resp.get_json()
+
+
+def availability(client):
+    return {w["name"]: [(a["start"][:16], a["end"][:16]) for a in w["availability"]]
+            for w in client.get("/workers").get_json()["workers"]}
+
+
+def test_reupload_is_answered_as_a_duplicate(client, upload, roster):
+    first = import_availability(upload, CSV, "rota.csv")
+    assert first["duplicate"] is False
+    assert first["updates"] == 2
+    versions = {w["id"]: w["version"] for w in client.get("/workers").get_json()["workers"]}
+
+    again = import_availability(upload, CSV, "rota.csv")
+    assert again["duplicate"] is True
+    assert again["changes"] == first["changes"]
+    assert {w["id"]: w["version"] for w in client.get("/workers").get_json()["workers"]} == versions
+
+
+def test_a_worker_write_ends_the_duplicate(client, upload, roster):
+    import_availability(upload, CSV, "rota.csv")
+    ann = client.get("/workers").get_json()["workers"][0]
+    client.put(f"/workers/{ann['id']}", json={"availability": [], "version": ann["version"]})
+
+    again = import_availability(upload, CSV, "rota.csv")
+    assert again["duplicate"] is False
+    assert again["updates"] == 1
+    assert again["unchanged"] == 1
+
+
+def test_force_reimports_from_the_sheet_cache(upload, roster):
+    import_availability(upload, CSV, "rota.csv")
+    forced = import_availability(upload, CSV, "rota.csv", force="true")
+    assert forced["duplicate"] is False
+    assert forced["sheets"] == [{"sheet": "rota.csv", "rows": 2, "parse_ms": 0.0, "cached": True}]
+    assert forced["updates"] == 0
+    assert forced["unchanged"] == 2
+
+
+def test_dry_run_writes_nothing(client, upload, roster):
+    before = client.get("/workers").get_json()["workers"]
+    preview = import_availability(upload, CSV, "rota.csv", dry_run="1")
+    assert preview["dry_run"] is True
+    assert preview["updates"] == 2
+    assert client.get("/workers").get_json()["workers"] == before
+
+    # a preview is not remembered as an applied import
+    assert import_availability(upload, CSV, "rota.csv")["duplicate"] is False
+
+
+def test_workbook_sheets_are_cached_individually(upload, roster, availability_workbook, client):
+    monday = ("Mon", "16/11/2026", [("Ann", "09:00-17:00")])
+    tuesday = ("Tue", "17/11/2026", [("Bob", "09:00-17:00")])
+    import_availability(upload, availability_workbook([monday]), "rota.xlsx")
+
+    result = import_availability(upload, availability_workbook([monday, tuesday]), "rota.xlsx")
+    assert [(s["sheet"], s["cached"]) for s in result["sheets"]] == [("Mon", True), ("Tue", False)]
+    assert availability(client) == {
+        "Ann": [("2026-11-16T09:00", "2026-11-16T17:00")],
+        "Bob": [("2026-11-17T09:00", "2026-11-17T17:00")],
+    }
+
+
+def test_same_bytes_in_another_format_are_parsed_again(upload, roster):
+    import_availability(upload, CSV, "rota.csv")
+    as_ics = import_availability(upload, CSV, "rota.csv", format="ics")
+    assert as_ics["format"] == "ics"
+    assert as_ics["duplicate"] is False
+    assert as_ics["sheets"][0]["cached"] is False
+    assert as_ics["entries"] == []  # no VEVENTs, rather than the CSV's rows
+
+
+def test_cache_key_follows_the_parser_version(app_module, upload, roster, monkeypatch):
+    import_availability(upload, CSV, "rota.csv")
+    monkeypatch.setattr(app_module, "AVAILABILITY_PARSER_VERSION", app_module.AVAILABILITY_PARSER_VERSION + 1)
+    forced = import_availability(upload, CSV, "rota.csv", force="1")
+    assert forced["sheets"][0]["cached"] is False
@@ -0,0 +1,77 @@
+"""CSV and iCalendar availability parsing, and how overnight shifts are stored."""
+import io
+
+import pytest
+
+
+def parse(app_module, kind, text):
+    (_, rows, _), = app_module.parse_availability_text(io.BytesIO(text.encode()), kind, "upload")
+    return rows
+
+
+def calendar(*events):
+    body = "".join(f"BEGIN:VEVENT\r\n{event}END:VEVENT\r\n" for event in events)
+    return f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n{body}END:VCALENDAR\r\n"
+
+
+@pytest.mark.parametrize("header", [
+    "name,date,start,end",
+    "Employee,Shift Date,Start Time,Finish",
+    " Staff , DAY , From , To ",
+])
+def test_csv_header_aliases(app_module, header):
+    assert parse(app_module, "csv", f"{header}\nAnn,2026-11-20,09:00,17:00\n") == [
+        ("2026-11-20", "Ann", "09:00", "17:00"),
+    ]
+
+
+def test_csv_time_range_column_and_day_first_dates(app_module):
+    text = "Worker,Day,Hours\nAnn,20/11/2026,9:00-17:00\nBob,03/12/2026,8:00 AM - 4:30 PM\n"
+    assert parse(app_module, "csv", text) == [
+        ("2026-11-20", "Ann", "09:00", "17:00"),
+        ("2026-12-03", "Bob", "08:00", "16:30"),
+    ]
+
+
+def test_csv_skips_unparseable_and_zero_length_rows(app_module):
+    text = "name,date,time\nAnn,someday,9:00-17:00\nBob,2026-11-20,soon\nCat,2026-11-20,09:00-09:00\n,2026-11-20,9:00-17:00\n"
+    assert parse(app_module, "csv", text) == []
+
+
+def test_csv_without_required_columns_is_rejected(app_module):
+    with pytest.raises(ValueError):
+        parse(app_module, "csv", "name,start,end\nAnn,09:00,17:00\n")
+
+
+def test_ics_folded_lines_and_attendee_name(app_module):
+    event = (
+        "DTSTART:20261120T090000Z\r\nDTEND:20261120T170000Z\r\n"
+        "SUMMARY:Shift\r\n"
+        'ATTENDEE;ROLE=REQ-PARTICIPANT;CN="Ann\r\n  Smith":mailto:ann@example.com\r\n'
+    )
+    assert parse(app_module, "ics", calendar(event)) == [("2026-11-20", "Ann Smith", "09:00", "17:00")]
+
+
+def test_ics_tzid_is_converted_to_the_import_zone(app_module):
+    event = "DTSTART;TZID=America/New_York:20261120T090000\r\nDTEND;TZID=America/New_York:20261120T120000\r\nSUMMARY:Bob\r\n"
+    assert parse(app_module, "ics", calendar(event)) == [("2026-11-20", "Bob", "14:00", "17:00")]
+
+
+def test_ics_skips_all_day_and_impossible_events(app_module):
+    all_day = "DTSTART;VALUE=DATE:20261120\r\nDTEND;VALUE=DATE:20261121\r\nSUMMARY:Ann\r\n"
+    inverted = "DTSTART:20261120T170000Z\r\nDTEND:20261120T090000Z\r\nSUMMARY:Bob\r\n"
+    two_days = "DTSTART:20261120T090000Z\r\nDTEND:20261122T090000Z\r\nSUMMARY:Cat\r\n"
+    assert parse(app_module, "ics", calendar(all_day, inverted, two_days)) == []
+
+
+def test_overnight_shifts_end_the_next_day(client, make_worker, upload):
+    make_worker("Ann")
+    make_worker("Bob")
+    event = "DTSTART:20261121T220000Z\r\nDTEND:20261122T060000Z\r\nSUMMARY:Ann\r\n"
+    assert upload("/upload-worker-availability", calendar(event).encode(), "rota.ics").status_code == 200
+    csv = b"name,date,time\nBob,2026-11-21,22:00-06:00\n"
+    assert upload("/upload-worker-availability", csv, "rota.csv").status_code == 200
+
+    stored = {w["name"]: w["availability"] for w in client.get("/workers").get_json()["workers"]}
+    for name in ("Ann", "Bob"):
+        assert [(a["start"][:16], a["end"][:16]) for a in stored[name]] == [("2026-11-21T22:00", "2026-11-22T06:00")]
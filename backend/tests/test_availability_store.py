@@ -0,0 +1,73 @@
+"""AvailabilityStore publishes immutable snapshots: readers never see a half-applied refresh."""
+import threading
+
+import numpy as np
+import pytest
+
+ROUNDS = 12
+
+
+def shifts(count):
+    return [
+        {"start": f"2026-11-{day:02d}T09:00:00+00:00", "end": f"2026-11-{day:02d}T17:00:00+00:00", "late": False}
+        for day in range(1, count + 1)
+    ]
+
+
+def snapshot(app_module, site="default"):
+    with app_module.app.app_context():
+        return app_module.get_availability_store(site)
+
+
+def test_snapshot_columns_are_read_only(app_module, make_worker):
+    make_worker("Ann", shifts=[("2026-11-02T09:00:00+00:00", "2026-11-02T17:00:00+00:00")])
+    current = snapshot(app_module)
+    assert len(current.start) == 1
+    with pytest.raises(ValueError):
+        current.start[0] = 0
+
+
+def test_refresh_publishes_a_new_snapshot_and_keeps_the_old_one(app_module, client, make_worker):
+    ann = make_worker("Ann", shifts=[("2026-11-02T09:00:00+00:00", "2026-11-02T17:00:00+00:00")])
+    before = snapshot(app_module)
+    assert snapshot(app_module) is before  # nothing changed, nothing rebuilt
+
+    client.put(f"/workers/{ann['id']}", json={"availability": shifts(3), "version": ann["version"]})
+    after = snapshot(app_module)
+    assert len(before.start) == 1
+    assert len(after.start) == 3
+    assert snapshot(app_module) is after
+
+
+def test_readers_see_whole_generations_during_writes(app_module, client, make_worker):
+    ann = make_worker("Round 0")
+    make_worker("Bystander", shifts=[("2026-11-30T09:00:00+00:00", "2026-11-30T17:00:00+00:00")])
+    done = threading.Event()
+    torn = []
+
+    def reader():
+        while not done.is_set():
+            current = snapshot(app_module)
+            lengths = {len(column) for column in current[:7]}
+            name, _ = current.workers[ann["id"]]
+            own = int(np.count_nonzero(current.worker == ann["id"]))
+            # the name and the shift count are written together, so they must match
+            if len(lengths) != 1 or own != int(name.split()[1]):
+                torn.append((name, own, lengths))
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in readers:
+        thread.start()
+    worker = ann
+    for n in range(1, ROUNDS + 1):
+        resp = client.put(
+            f"/workers/{worker['id']}",
+            json={"name": f"Round {n}", "availability": shifts(n), "version": worker["version"]},
+        )
+        worker = resp.get_json()["worker"]
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    assert torn == []
+    assert int(np.count_nonzero(snapshot(app_module).worker == ann["id"])) == ROUNDS
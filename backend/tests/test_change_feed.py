@@ -0,0 +1,111 @@
+"""The /workers/changes cursor: resets, incremental deltas, site isolation and the SSE stream."""
+import threading
+
+
+def changes(client, since, site=None):
+    resp = client.get(f"/workers/changes?since={since}", headers={"X-Site-ID": site} if site else {})
+    assert resp.status_code == 200, resp.get_json()
+    return resp.get_json()
+
+
+def apply(mirror, payload):
+    """Fold one change-feed payload into a {id: worker} mirror, as the frontend does."""
+    if payload["reset"]:
+        mirror.clear()
+    for worker_id in payload["deleted"]:
+        mirror.pop(worker_id, None)
+    for worker in payload["workers"]:
+        mirror[worker["id"]] = worker
+    return payload["version"]
+
+
+def test_since_zero_is_a_full_reset(client, make_worker):
+    ann, bob = make_worker("Ann"), make_worker("Bob")
+    payload = changes(client, 0)
+    assert payload["reset"] is True
+    assert [w["id"] for w in payload["workers"]] == [ann["id"], bob["id"]]
+    assert payload["version"] > 0
+
+
+def test_incremental_upserts_and_deletes(client, make_worker):
+    ann, bob = make_worker("Ann"), make_worker("Bob")
+    cursor = changes(client, 0)["version"]
+    assert changes(client, cursor) == {"version": cursor, "reset": False, "workers": [], "deleted": []}
+
+    client.put(f"/workers/{ann['id']}", json={"roles": ["Lead"], "version": ann["version"]})
+    client.delete(f"/workers/{bob['id']}")
+    payload = changes(client, cursor)
+    assert payload["reset"] is False
+    assert payload["version"] > cursor
+    assert [(w["id"], w["roles"]) for w in payload["workers"]] == [(ann["id"], ["Lead"])]
+    assert payload["deleted"] == [bob["id"]]
+
+
+def test_cursor_ahead_of_the_log_resets(client, make_worker):
+    make_worker("Ann")
+    cursor = changes(client, 0)["version"]
+    payload = changes(client, cursor + 100)
+    assert payload["reset"] is True
+    assert payload["version"] == cursor
+
+
+def test_sites_have_separate_feeds(client, make_worker):
+    make_worker("Ann", site="north")
+    make_worker("Bob", site="south")
+    north = changes(client, 0, site="north")
+    assert [w["name"] for w in north["workers"]] == ["Ann"]
+
+    make_worker("Cat", site="south")
+    assert changes(client, north["version"], site="north")["workers"] == []
+
+
+def test_polling_reader_converges_under_concurrent_writes(app_module, make_worker):
+    workers = [make_worker(f"Worker {n}") for n in range(6)]
+    done = threading.Event()
+    mirror = {}
+
+    def writer(worker):
+        client = app_module.app.test_client()
+        for round_ in range(5):
+            resp = client.put(f"/workers/{worker['id']}", json={"roles": [f"R{round_}"], "version": worker["version"]})
+            assert resp.status_code == 200, resp.get_json()
+            worker = resp.get_json()["worker"]
+        if worker["id"] % 2:
+            assert client.delete(f"/workers/{worker['id']}").status_code == 200
+
+    def reader():
+        client = app_module.app.test_client()
+        cursor = 0
+        while not done.is_set():
+            cursor = apply(mirror, changes(client, cursor))
+        apply(mirror, changes(client, cursor))
+
+    poller = threading.Thread(target=reader)
+    poller.start()
+    writers = [threading.Thread(target=writer, args=(worker,)) for worker in workers]
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    done.set()
+    poller.join()
+
+    current = app_module.app.test_client().get("/workers").get_json()["workers"]
+    assert {w["id"]: (w["version"], w["roles"]) for w in current} == {
+        worker_id: (w["version"], w["roles"]) for worker_id, w in mirror.items()
+    }
+
+
+def test_stream_sends_the_payload_with_its_cursor(app_module, client, make_worker, monkeypatch):
+    monkeypatch.setattr(app_module, "CHANGE_STREAM_MAX_SECONDS", 0.2)
+    monkeypatch.setattr(app_module, "CHANGE_STREAM_POLL_SECONDS", 0.05)
+    make_worker("Ann")
+    cursor = changes(client, 0)["version"]
+
+    resp = client.get("/workers/changes/stream", headers={"Last-Event-ID": str(cursor)})
+    body = resp.get_data(as_text=True)
+    assert resp.mimetype == "text/event-stream"
+    assert f"id: {cursor}\nevent: changes\n" in body
+    assert ": keep-alive" in body
+
+    assert client.get("/workers/changes/stream?since=soon").status_code == 400
@@ -0,0 +1,88 @@
+"""Day plans: slot programs, stored workbooks and what reaches the fairness counters."""
+import io
+
+import openpyxl
+import pytest
+
+from conftest import PLAN_DAY, WEEKDAY_TEMPLATE
+
+
+def generate(client, print_until_hour=16):
+    return client.post("/generate-schedule", json={
+        "template": WEEKDAY_TEMPLATE, "date": str(PLAN_DAY), "print_until_hour": print_until_hour,
+    })
+
+
+def pregenerate(app_module):
+    with app_module.app.app_context():
+        return app_module.pregenerate_plans(days=1, template_names=[WEEKDAY_TEMPLATE], start=PLAN_DAY)
+
+
+def counted(app_module):
+    with app_module.app.app_context():
+        total = sum(counter.count for counter in app_module.RoleAssignmentCount.query)
+        return total, app_module.DayPlan.query.count()
+
+
+def pending(app_module):
+    with app_module.app.app_context():
+        return app_module.GeneratedPlan.query.filter(app_module.GeneratedPlan.pending_assignments.isnot(None)).count()
+
+
+def test_slot_program_is_compiled_once_per_layout_and_cutoff(app_module):
+    with app_module.app.app_context():
+        template = app_module.Template.query.filter_by(name=WEEKDAY_TEMPLATE).first()
+        program = app_module.get_slot_program(template, 16)
+        assert app_module.get_slot_program(template, 16) is program
+        assert app_module.get_slot_program(template, 18) is not program
+
+
+@pytest.mark.parametrize("print_until_hour", [16, 17, 18])
+def test_schedule_renders_for_each_cutoff(client, staffed_day, print_until_hour):
+    resp = generate(client, print_until_hour)
+    assert resp.status_code == 200, resp.get_json()
+    sheet = openpyxl.load_workbook(io.BytesIO(resp.data)).active
+    names = {cell for row in sheet.iter_rows(values_only=True) for cell in row if isinstance(cell, str)}
+    assert names & {worker["name"] for worker in staffed_day}
+
+
+def test_pregenerated_plans_stay_out_of_the_fairness_counters(app_module, client, staffed_day):
+    assert pregenerate(app_module)["generated"] == 1
+    assert pregenerate(app_module)["current"] == 1
+    assert counted(app_module) == (0, 0)
+    assert pending(app_module) == 1
+
+    # the first request serves the stored workbook and counts it, once
+    first = generate(client)
+    assert first.status_code == 200
+    total, plans = counted(app_module)
+    assert total > 0 and plans == 1
+    assert pending(app_module) == 0
+
+    again = generate(client)
+    assert again.data == first.data
+    assert counted(app_module) == (total, 1)
+
+
+def test_requested_plans_are_counted_when_built(app_module, client, staffed_day):
+    assert generate(client).status_code == 200
+    total, plans = counted(app_module)
+    assert total > 0 and plans == 1
+    assert pending(app_module) == 0
+
+
+def test_repeat_requests_reuse_the_plan_until_asked_for_a_fresh_one(app_module, client, staffed_day):
+    first = generate(client)
+    assert generate(client).data == first.data
+
+    regenerated = client.post("/generate-schedule", json={
+        "template": WEEKDAY_TEMPLATE, "date": str(PLAN_DAY), "fresh": True,
+    })
+    assert regenerated.status_code == 200
+    assert generate(client).data == regenerated.data  # the new plan is the stored one now
+
+    # the fresh plan replaced the first in the fairness counts rather than adding to them
+    with app_module.app.app_context():
+        plan = app_module.DayPlan.query.one()
+        assigned = sum(1 for half in plan.assignments.values() for worker_id in half.values() if worker_id)
+    assert counted(app_module) == (assigned, 1)
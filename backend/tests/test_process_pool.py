@@ -0,0 +1,46 @@
+"""The shared process pool: recovery from a dead child and state inherited through fork."""
+import os
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+
+def take_store_lock():
+    """Pool task: needs the lock a parent thread may have held at fork time."""
+    import app
+
+    with app.availability_stores_lock:
+        return os.getpid()
+
+
+@pytest.fixture
+def fresh_pool(app_module):
+    """Start and end each test without a pool, so the first submit forks."""
+    def discard():
+        if app_module._process_pool is not None:
+            app_module.discard_process_pool(app_module._process_pool)
+    discard()
+    yield
+    discard()
+
+
+def test_dead_child_is_replaced_and_the_batch_retried(app_module, fresh_pool):
+    broken = app_module.get_process_pool()
+    with pytest.raises(BrokenProcessPool):
+        broken.submit(os._exit, 1).result()
+
+    assert app_module.run_in_pool([(pow, 2, 5), (pow, 3, 2)]) == [32, 9]
+    assert app_module._process_pool is not broken
+
+
+def test_child_gets_fresh_locks_when_forked_mid_critical_section(app_module, fresh_pool):
+    pool = app_module.get_process_pool()
+    with app_module.availability_stores_lock:
+        future = pool.submit(take_store_lock)
+        try:
+            assert future.result(timeout=10) != os.getpid()
+        except TimeoutError:
+            for process in pool._processes.values():
+                process.kill()  # or the deadlocked child holds up interpreter exit
+            pytest.fail("pool child deadlocked on a lock held at fork time")
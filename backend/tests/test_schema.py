@@ -0,0 +1,54 @@
+"""Schema migrations run at import in every gunicorn worker, so they must serialize."""
+import logging
+import threading
+
+import pytest
+
+from sqlalchemy import inspect, text
+
+BOOTS = 4
+
+
+def columns(app_module, table):
+    with app_module.app.app_context():
+        return {c["name"] for c in inspect(app_module.db.engine).get_columns(table)}
+
+
+def test_concurrent_boots_add_a_missing_column_once(app_module):
+    with app_module.app.app_context():
+        with app_module.db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE generated_plan DROP COLUMN pending_assignments"))
+    assert "pending_assignments" not in columns(app_module, "generated_plan")
+
+    barrier = threading.Barrier(BOOTS)
+    errors = []
+
+    def boot():
+        barrier.wait()
+        try:
+            with app_module.app.app_context(), app_module.schema_lock():
+                app_module.db.create_all()
+                app_module.ensure_schema()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=boot) for _ in range(BOOTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert "pending_assignments" in columns(app_module, "generated_plan")
+
+
+@pytest.mark.parametrize("embedded, label", [(False, "SQLite database at"), (True, "Embedded SQLite database at")])
+def test_sqlite_is_only_called_embedded_for_the_fallback_file(app_module, monkeypatch, caplog, embedded, label):
+    monkeypatch.setattr(app_module, "EMBEDDED_DB", embedded)
+    if embedded:
+        monkeypatch.delenv("DATABASE_URI", raising=False)
+    caplog.set_level(logging.INFO)
+    with app_module.app.app_context():
+        app_module.check_sqlite_json()
+    message, = [r.getMessage() for r in caplog.records if "database at" in r.getMessage()]
+    assert message.startswith(label)
@@ -0,0 +1,54 @@
+"""/simulate: input validation, reproducible seeds, and a simulation's logging staying its own."""
+import logging
+import threading
+
+import pytest
+
+from conftest import PLAN_DAY, WEEKDAY_TEMPLATE
+
+
+def simulate(client, **fields):
+    return client.post("/simulate", json={"template": WEEKDAY_TEMPLATE, "date": str(PLAN_DAY), **fields})
+
+
+@pytest.mark.parametrize("field, value", [
+    ("seed", "x"), ("runs", "many"), ("min_absent", [1]), ("max_absent", "3.5"), ("ica_morning_count", {}),
+])
+def test_non_integer_inputs_are_400(client, staffed_day, field, value):
+    resp = simulate(client, **{field: value})
+    assert resp.status_code == 400
+    assert resp.get_json()["error"] == f"{field} must be an integer"
+
+
+def test_unknown_template_and_empty_day(client, staffed_day):
+    assert simulate(client, template="Nope.xlsx").status_code == 404
+    assert simulate(client, date="2026-12-25").status_code == 400
+
+
+def test_same_seed_same_result(client, staffed_day):
+    first = simulate(client, runs=40, seed=7).get_json()
+    second = simulate(client, runs=40, seed="7").get_json()
+    first.pop("elapsed_ms"), second.pop("elapsed_ms")
+    assert first == second
+    assert first["runs"] == 40 and first["seed"] == 7
+    assert first["roster"] == {"early": 15, "late": 3}
+
+
+def test_simulation_is_quiet_without_muting_other_threads(client, staffed_day, caplog):
+    caplog.set_level(logging.WARNING)
+    running = threading.Thread(target=simulate, args=(client,), kwargs={"runs": 400, "seed": 1})
+    sent = 0
+    running.start()
+    while running.is_alive():
+        logging.getLogger("dayplanner.test").warning("still heard")
+        sent += 1
+    running.join()
+
+    assert logging.root.manager.disable == logging.NOTSET
+    assert not [r for r in caplog.records if r.name.startswith("dayplanner.planner")]
+    assert sum(r.getMessage() == "still heard" for r in caplog.records) == sent
+
+    # an ordinary plan for the same day still narrates its fallbacks
+    caplog.clear()
+    client.post("/generate-schedule", json={"template": WEEKDAY_TEMPLATE, "date": str(PLAN_DAY)})
+    assert [r for r in caplog.records if r.name == "dayplanner.planner"]
@@ -0,0 +1,67 @@
+"""Per-template rotation rules: validation, explicit resets and the compiled-program cache."""
+import copy
+
+import pytest
+
+from conftest import WEEKDAY_TEMPLATE
+
+ROTATION = f"/templates/{WEEKDAY_TEMPLATE}/rotation"
+
+
+@pytest.fixture
+def layout(app_module):
+    """A rotation that differs from the default only in its evening hold."""
+    rotation = copy.deepcopy(app_module.ROTATION_DEFAULT)
+    rotation["evening_hold"]["18"] = 3
+    return rotation
+
+
+def stored_rotation(app_module):
+    with app_module.app.app_context():
+        return app_module.Template.query.filter_by(name=WEEKDAY_TEMPLATE).one().to_dict()["rotation"]
+
+
+def test_set_and_explicitly_reset(app_module, client, layout):
+    assert client.put(ROTATION, json={"rotation": layout}).status_code == 200
+    assert stored_rotation(app_module) == layout
+
+    assert client.put(ROTATION, json={"rotation": None}).status_code == 200
+    assert stored_rotation(app_module) == app_module.ROTATION_DEFAULT
+
+
+@pytest.mark.parametrize("body", [{}, {"phases": {}}, None])
+def test_missing_rotation_key_is_400_and_keeps_the_layout(app_module, client, layout, body):
+    client.put(ROTATION, json={"rotation": layout})
+    resp = client.put(ROTATION, json=body)
+    assert resp.status_code == 400
+    assert "rotation is required" in resp.get_json()["error"]
+    assert stored_rotation(app_module) == layout
+
+
+@pytest.mark.parametrize("change, field", [
+    (lambda r: r["phases"].pop("afternoon"), "rotation.phases.afternoon is required"),
+    (lambda r: r["phases"]["morning"].update(rows="2-8"), "rotation.phases.morning.rows"),
+    (lambda r: r["phases"]["morning"].update(rows=[]), "rotation.phases.morning.rows"),
+    (lambda r: r["phases"]["afternoon"]["handovers"].update({"99": []}), "rotation.phases.afternoon.handovers row 99"),
+    (lambda r: r["rotate"].append("Zip Top 1"), "rotation.rotate[1]"),
+    (lambda r: r.update(late_roles="ICA 1"), "rotation.late_roles"),
+    (lambda r: r.update(evening_hold={"18": "four"}), "rotation.evening_hold"),
+])
+def test_invalid_rotation_names_the_field(client, layout, change, field):
+    change(layout)
+    resp = client.put(ROTATION, json={"rotation": layout})
+    assert resp.status_code == 400
+    assert field in resp.get_json()["error"]
+
+
+def test_slot_program_cache_is_bounded(app_module, client, layout, monkeypatch):
+    monkeypatch.setattr(app_module, "SLOT_PROGRAM_CACHE_SIZE", 3)
+    with app_module.app.app_context():
+        template = app_module.Template.query.filter_by(name=WEEKDAY_TEMPLATE).first()
+        for hold in range(6):
+            layout["evening_hold"]["18"] = hold
+            template.rotation = copy.deepcopy(layout)
+            app_module.get_slot_program(template, 18)
+        assert len(app_module._slot_programs) == 3
+        # the most recent layouts survive
+        assert [app_module.json.loads(key[1])["evening_hold"]["18"] for key in app_module._slot_programs] == [3, 4, 5]
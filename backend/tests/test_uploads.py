@@ -0,0 +1,96 @@
+"""Upload limits: size, zip structure, sheet count and zip bombs, both while streaming and after."""
+import io
+import zipfile
+
+import pytest
+
+AVAILABILITY = "/upload-worker-availability"
+
+
+class Unseekable(io.RawIOBase):
+    """Write-only sink zipfile can't seek in, so it defers sizes to data descriptors."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def zip_bytes(members, streamed=False):
+    """A zip of {name: bytes}; streamed=True hides the sizes from the local headers."""
+    sink = Unseekable() if streamed else io.BytesIO()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return (sink.buffer if streamed else sink).getvalue()
+
+
+def error(resp):
+    return resp.status_code, resp.get_json()["error"]
+
+
+def test_oversized_upload_is_413(app_module, upload):
+    body = b"x" * (app_module.MAX_UPLOAD_BYTES + 1)
+    assert upload(AVAILABILITY, body, "rota.csv").status_code == 413
+
+
+def test_missing_file_is_400(client):
+    resp = client.post(AVAILABILITY, data={}, content_type="multipart/form-data")
+    assert error(resp) == (400, "No file provided")
+
+
+def test_non_zip_workbook_is_refused_while_streaming(upload):
+    status, message = error(upload(AVAILABILITY, b"not a workbook at all, just text", "rota.xlsx"))
+    assert status == 400
+    assert "isn't a zip archive" in message
+
+
+def test_template_upload_runs_the_same_checks(upload):
+    status, message = error(upload("/upload-excel", b"garbage" * 10, "template.xlsx"))
+    assert status == 400
+    assert "zip" in message
+
+
+def test_zip_without_a_workbook_part_is_400(upload):
+    status, message = error(upload(AVAILABILITY, zip_bytes({"readme.txt": b"hello"}), "rota.xlsx"))
+    assert (status, message) == (400, "Not an Excel workbook (no xl/workbook.xml)")
+
+
+@pytest.mark.parametrize("streamed", [False, True], ids=["local-headers", "central-directory"])
+def test_too_many_sheets(app_module, upload, streamed):
+    sheets = {f"xl/worksheets/sheet{n}.xml": b"<worksheet/>" for n in range(app_module.MAX_UPLOAD_SHEETS + 1)}
+    members = {"xl/workbook.xml": b"<workbook/>", **sheets}
+    status, message = error(upload(AVAILABILITY, zip_bytes(members, streamed), "rota.xlsx"))
+    assert status == 400
+    assert "sheets" in message
+
+
+@pytest.mark.parametrize("streamed", [False, True], ids=["local-headers", "central-directory"])
+def test_zip_bomb_member_is_refused(upload, streamed):
+    members = {"xl/workbook.xml": b"<workbook/>", "xl/worksheets/sheet1.xml": b"\0" * (4 * 1024 * 1024)}
+    status, message = error(upload(AVAILABILITY, zip_bytes(members, streamed), "rota.xlsx"))
+    assert status == 400
+    assert message == "xl/worksheets/sheet1.xml expands more than 100:1"
+
+
+@pytest.mark.parametrize("streamed", [False, True], ids=["local-headers", "central-directory"])
+def test_unpacked_size_limit(app_module, upload, monkeypatch, streamed):
+    monkeypatch.setattr(app_module, "MAX_UPLOAD_RATIO", 10 ** 6)
+    member = b"\0" * (1024 * 1024)
+    count = app_module.MAX_UPLOAD_UNPACKED_BYTES // len(member) + 1
+    members = {"xl/workbook.xml": b"<workbook/>", **{f"xl/media/blob{n}.bin": member for n in range(count)}}
+    status, message = error(upload(AVAILABILITY, zip_bytes(members, streamed), "rota.xlsx"))
+    assert status == 400
+    assert "unpacks to more than" in message
+
+
+def test_workbook_within_limits_is_imported(upload, make_worker, availability_workbook):
+    make_worker("Ann")
+    workbook = availability_workbook([("Mon", "16/11/2026", [("Ann", "09:00-17:00")])])
+    resp = upload(AVAILABILITY, workbook, "rota.xlsx")
+    assert resp.status_code == 200, resp.get_json()
+    assert resp.get_json()["updates"] == 1
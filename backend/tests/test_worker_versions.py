@@ -0,0 +1,109 @@
+"""Optimistic concurrency on worker writes: version checks, 409s and the importer's retries."""
+import io
+import threading
+
+WRITERS = 8
+
+
+def shift(day):
+    return {"start": f"2026-11-{day:02d}T09:00:00+00:00", "end": f"2026-11-{day:02d}T17:00:00+00:00", "late": False}
+
+
+def shift_days(worker):
+    return sorted(int(entry["start"][8:10]) for entry in worker["availability"])
+
+
+def add_shift(client, worker, day, barrier=None):
+    """
+    Read-modify-write one shift onto `worker` the way the frontend does,
+    rereading from the 409 body until the write lands. Returns the 409 count.
+    """
+    conflicts = 0
+    if barrier is not None:
+        barrier.wait()
+    while True:
+        resp = client.put(
+            f"/workers/{worker['id']}",
+            json={"availability": worker["availability"] + [shift(day)], "version": worker["version"]},
+        )
+        if resp.status_code == 200:
+            return conflicts
+        assert resp.status_code == 409, resp.get_json()
+        conflicts += 1
+        worker = resp.get_json()["worker"]
+
+
+def run_threads(targets):
+    threads = [threading.Thread(target=target) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_stale_version_is_rejected_with_current_state(client, make_worker):
+    worker = make_worker("Ann")
+    first = client.put(f"/workers/{worker['id']}", json={"availability": [shift(1)], "version": worker["version"]})
+    assert first.status_code == 200
+    assert first.get_json()["worker"]["version"] == worker["version"] + 1
+
+    stale = client.put(f"/workers/{worker['id']}", json={"availability": [shift(2)], "version": worker["version"]})
+    assert stale.status_code == 409
+    assert shift_days(stale.get_json()["worker"]) == [1]
+
+    via_header = client.put(
+        f"/workers/{worker['id']}", json={"availability": []}, headers={"If-Match": f'"{worker["version"]}"'}
+    )
+    assert via_header.status_code == 409
+
+
+
+def test_malformed_version_is_a_bad_request(client, make_worker):
+    worker = make_worker("Ann")
+    for kwargs in ({"json": {"version": "abc"}}, {"json": {}, "headers": {"If-Match": '"xyz"'}}):
+        resp = client.put(f"/workers/{worker['id']}", **kwargs)
+        assert resp.status_code == 400
+        assert "must be a worker version number" in resp.get_json()["error"]
+    assert client.delete(f"/workers/{worker['id']}", json={"version": [1]}).status_code == 400
+    assert client.get("/workers").get_json()["workers"][0]["version"] == worker["version"]
+
+def test_concurrent_edits_lose_no_update(app_module, make_worker):
+    worker = make_worker("Ann")
+    barrier = threading.Barrier(WRITERS)
+    conflicts = []
+
+    def writer(day):
+        conflicts.append(add_shift(app_module.app.test_client(), worker, day, barrier))
+
+    run_threads([lambda day=day: writer(day) for day in range(1, WRITERS + 1)])
+
+    final = app_module.app.test_client().get("/workers").get_json()["workers"][0]
+    assert shift_days(final) == list(range(1, WRITERS + 1))
+    assert final["version"] == worker["version"] + WRITERS
+    # every writer started from the same version, so all but one lost the first round
+    assert sum(conflicts) >= WRITERS - 1
+
+
+def test_import_alongside_edits_keeps_both(app_module, make_worker, monkeypatch):
+    monkeypatch.setattr(app_module, "IMPORT_MAX_RETRIES", 50)
+    worker = make_worker("Ann")
+    barrier = threading.Barrier(WRITERS)
+    results = {}
+
+    def importer():
+        barrier.wait()
+        csv = b"name,date,start,end\nAnn,2026-11-20,10:00,18:00\n"
+        results["import"] = app_module.app.test_client().post(
+            "/upload-worker-availability",
+            data={"file": (io.BytesIO(csv), "rota.csv")},
+            content_type="multipart/form-data",
+        )
+
+    def editor(day):
+        add_shift(app_module.app.test_client(), worker, day, barrier)
+
+    run_threads([importer] + [lambda day=day: editor(day) for day in range(1, WRITERS)])
+
+    assert results["import"].status_code == 200, results["import"].get_json()
+    final = app_module.app.test_client().get("/workers").get_json()["workers"][0]
+    assert shift_days(final) == list(range(1, WRITERS)) + [20]
@@ -0,0 +1,137 @@
+-- Day Planner schema (PostgreSQL).
+-- The Flask app creates these tables itself (db.create_all + ensure_schema);
+-- this file documents the layout and can be used to provision a fresh database.
+--
+-- Every worker, template and plan belongs to one site (activity centre),
+-- named by a short slug; requests are scoped to the site in their X-Site-ID
+-- header, so indexes lead with site_id.
+
+CREATE TABLE IF NOT EXISTS worker (
+    id              SERIAL PRIMARY KEY,
+    name            VARCHAR(100) NOT NULL,
+    -- casefolded, accent-stripped, whitespace-collapsed copy of name
+    name_normalized VARCHAR(100) NOT NULL,
+    roles           JSON NOT NULL,
+    -- trainings in roles as bits (KITUP 1, AATT 2, MT 4, ICA 8), kept in sync by the app
+    roles_mask      INTEGER NOT NULL DEFAULT 0,
+    availability    JSON NOT NULL,
+    -- optimistic concurrency: every UPDATE/DELETE checks and bumps it
+    version         INTEGER NOT NULL DEFAULT 1,
+    site_id         VARCHAR(50) NOT NULL DEFAULT 'default'
+);
+
+-- names are unique per site; imports resolve names through this index in one bulk query
+CREATE UNIQUE INDEX IF NOT EXISTS ix_worker_site_name ON worker (site_id, name_normalized);
+-- role filters (GET /workers?role=ICA) match roles_mask IN (<masks with that bit>)
+CREATE INDEX IF NOT EXISTS ix_worker_site_roles ON worker (site_id, roles_mask);
+
+-- Uploaded schedule templates. Workbooks live on disk once per content hash
+-- (uploaded_templates/objects/<sha256>.xlsx); this table is the index
+-- /list-templates serves from. Sites share blobs but not names.
+CREATE TABLE IF NOT EXISTS template (
+    id           SERIAL PRIMARY KEY,
+    name         VARCHAR(255) NOT NULL,
+    sha256       VARCHAR(64) NOT NULL,
+    size         INTEGER NOT NULL,
+    sheet_names  JSON NOT NULL,
+    role_columns JSON NOT NULL,
+    rotation     JSON,  -- slot rows and rotation rules; NULL means the built-in default
+    uploaded_at  TIMESTAMP WITH TIME ZONE NOT NULL,
+    site_id      VARCHAR(50) NOT NULL DEFAULT 'default'
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_template_site_name ON template (site_id, name);
+CREATE INDEX IF NOT EXISTS ix_template_sha256 ON template (sha256);
+
+-- Generated plans, one per site, date and template. Assignments are keyed by worker id.
+CREATE TABLE IF NOT EXISTS day_plan (
+    id          SERIAL PRIMARY KEY,
+    plan_date   DATE NOT NULL,
+    template    VARCHAR(255) NOT NULL,
+    assignments JSON NOT NULL,
+    counted     BOOLEAN NOT NULL DEFAULT TRUE,  -- still inside the fairness window
+    created_at  TIMESTAMP WITH TIME ZONE NOT NULL,
+    site_id     VARCHAR(50) NOT NULL DEFAULT 'default',
+    CONSTRAINT uq_day_plan_site_date_template UNIQUE (site_id, plan_date, template)
+);
+
+CREATE INDEX IF NOT EXISTS ix_day_plan_plan_date ON day_plan (plan_date);
+
+-- Finished schedule workbooks, pre-generated for upcoming days or stored on
+-- first request. roster_key hashes the template, its rules and that day's
+-- roster; a stored plan whose key no longer matches is rebuilt.
+CREATE TABLE IF NOT EXISTS generated_plan (
+    id           SERIAL PRIMARY KEY,
+    plan_date    DATE NOT NULL,
+    template     VARCHAR(255) NOT NULL,
+    options      VARCHAR(20) NOT NULL,  -- <ica morning>-<ica afternoon>-<print until>
+    roster_key   VARCHAR(64) NOT NULL,
+    workbook     BYTEA NOT NULL,
+    source       VARCHAR(20) NOT NULL DEFAULT 'request',  -- request | pregenerate
+    -- a pre-generated plan's assignments, kept out of role_assignment_count
+    -- until a request first serves the plan (NULL once counted)
+    pending_assignments JSON,
+    generated_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    site_id      VARCHAR(50) NOT NULL DEFAULT 'default',
+    CONSTRAINT uq_generated_plan_site UNIQUE (site_id, plan_date, template, options)
+);
+
+CREATE INDEX IF NOT EXISTS ix_generated_plan_plan_date ON generated_plan (plan_date);
+
+-- Per-worker, per-role assignment counts over the fairness window,
+-- maintained incrementally whenever a plan is saved.
+CREATE TABLE IF NOT EXISTS role_assignment_count (
+    worker_id INTEGER NOT NULL REFERENCES worker (id) ON DELETE CASCADE,
+    role      VARCHAR(100) NOT NULL,
+    count     INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (worker_id, role)
+);
+
+-- Append-only log of worker writes (API and imports). The id is the cursor
+-- for GET /workers/changes?since=<id> (each site reads only its own rows);
+-- rows older than the retention window are pruned on write.
+CREATE TABLE IF NOT EXISTS worker_change (
+    id             SERIAL PRIMARY KEY,
+    worker_id      INTEGER NOT NULL,  -- no FK: deletes are logged too
+    op             VARCHAR(10) NOT NULL,  -- create | update | delete
+    worker_version INTEGER,
+    source         VARCHAR(20) NOT NULL DEFAULT 'api',  -- api | import
+    changed_at     TIMESTAMP WITH TIME ZONE NOT NULL,
+    site_id        VARCHAR(50) NOT NULL DEFAULT 'default'
+);
+
+CREATE INDEX IF NOT EXISTS ix_worker_change_changed_at ON worker_change (changed_at);
+CREATE INDEX IF NOT EXISTS ix_worker_change_site ON worker_change (site_id, id);
+
+-- Parsed rows of availability sheets (or whole CSV/iCalendar uploads) by a
+-- hash of their content, format and parser version, so a re-uploaded sheet
+-- isn't parsed again. Entries older than IMPORT_CACHE_DAYS are dropped on
+-- write.
+CREATE TABLE IF NOT EXISTS parsed_sheet (
+    sha256    VARCHAR(64) PRIMARY KEY,
+    rows      JSON NOT NULL,  -- [[date, name, start, end], ...]
+    parsed_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_parsed_sheet_parsed_at ON parsed_sheet (parsed_at);
+
+-- The response of each applied availability upload, by file hash. An
+-- identical re-upload is answered from here while the site's change log is
+-- still at change_cursor; records behind the cursor are dropped on write.
+CREATE TABLE IF NOT EXISTS availability_import (
+    id            SERIAL PRIMARY KEY,
+    site_id       VARCHAR(50) NOT NULL,
+    sha256        VARCHAR(64) NOT NULL,
+    format        VARCHAR(10) NOT NULL,  -- xlsx | csv | ics
+    change_cursor INTEGER NOT NULL,
+    result        JSON NOT NULL,
+    imported_at   TIMESTAMP WITH TIME ZONE NOT NULL,
+    CONSTRAINT uq_availability_import UNIQUE (site_id, sha256)
+);
+
+-- Optional: server-side trigram index for fuzzy name suggestions.
+-- The app builds an equivalent in-memory trigram index per upload, so this
+-- is only useful for ad-hoc queries such as
+--   SELECT name FROM worker ORDER BY similarity(name_normalized, 'ciara') DESC LIMIT 3;
+-- CREATE EXTENSION IF NOT EXISTS pg_trgm;
+-- CREATE INDEX IF NOT EXISTS ix_worker_name_trgm ON worker USING gin (name_normalized gin_trgm_ops);
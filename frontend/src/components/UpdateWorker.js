@@ -26,6 +26,7 @@ const UpdateWorker = () => {
     const [name, setName] = useState("");
     const [selectedRoles, setSelectedRoles] = useState([]); // Updated to handle checkboxes
     const [availability, setAvailability] = useState([]); // Updated for date ranges
+    const [version, setVersion] = useState(null); // Version we loaded, sent back to detect conflicting edits
 
     useEffect(() => {
         const fetchWorker = async () => {
@@ -46,6 +47,7 @@ const UpdateWorker = () => {
                     setName(worker.name);
                     setSelectedRoles(worker.roles);
                     setAvailability(filteredAvailability);
+                    setVersion(worker.version ?? null);
                 }
             } catch (error) {
                 console.error("Error fetching worker:", error);
@@ -116,12 +118,17 @@ const UpdateWorker = () => {
                 name,
                 roles: selectedRoles,
                 availability: adjustedAvailability,
+                version,
             };
     
             await updateWorker(id, updatedWorker);
             navigate("/workers");
         } catch (error) {
             console.error("Error updating worker:", error);
+            if (error.response?.status === 409) {
+                alert("Someone else changed this worker while you were editing. Reload the page and try again.");
+                return;
+            }
             alert("Failed to update worker. Please check your input format.");
         }
     };
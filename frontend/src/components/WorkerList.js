@@ -1,6 +1,7 @@
 import React, { useEffect, useState } from "react";
 import {
-  getAllWorkers,
+  syncWorkers,
+  subscribeWorkerChanges,
   deleteWorker,
   apiRequest,
   uploadTemplate,
@@ -38,24 +39,32 @@ const WorkerList = () => {
     // };    
 
     useEffect(() => {
+        // Only shifts that haven't ended yet are shown
+        const cleanWorkers = (list) => {
+            const now = new Date();
+            return list.map((worker) => {
+                const filteredAvailability = worker.availability
+                    .map(({ start, end, late }) => ({
+                    start,
+                    end,
+                    late: !!late, 
+                    }))
+                    .filter(({ end }) => new Date(end) >= now);
+
+                return { ...worker, availability: filteredAvailability };
+                });
+        };
+
+        let cancelled = false;
+        let unsubscribe = () => {};
+
         const fetchWorkers = async () => {
             try {
-                const data = await getAllWorkers();
-                const now = new Date();
-    
-                const cleanedWorkers = data.workers.map((worker) => {
-                    const filteredAvailability = worker.availability
-                        .map(({ start, end, late }) => ({
-                        start,
-                        end,
-                        late: !!late, 
-                        }))
-                        .filter(({ end }) => new Date(end) >= now);
-
-                    return { ...worker, availability: filteredAvailability };
-                    });
-    
-                setWorkers(cleanedWorkers);
+                const data = await syncWorkers();
+                if (cancelled) return;
+                setWorkers(cleanWorkers(data.workers));
+                // Keep the list current as other users and imports change workers
+                unsubscribe = subscribeWorkerChanges((list) => setWorkers(cleanWorkers(list)));
             } catch (error) {
                 console.error("Error fetching workers:", error);
             }
@@ -72,6 +81,10 @@ const WorkerList = () => {
     
         fetchWorkers();
         fetchTemplates();
+        return () => {
+            cancelled = true;
+            unsubscribe();
+        };
     }, []);
     
 
@@ -85,7 +98,8 @@ const WorkerList = () => {
     };    
     
 
-    const handleDownloadSchedule = async () => {
+    // fresh asks for a newly shuffled plan instead of the stored one for that day
+    const handleDownloadSchedule = async (fresh = false) => {
         if (!selectedTemplate) {
             alert("Please select a template to generate the schedule.");
             return;
@@ -98,6 +112,7 @@ const WorkerList = () => {
                 ica_morning_count: morningIcaCount,
                 ica_afternoon_count: afternoonIcaCount,
                 print_until_hour: printUntilHour,
+                fresh,
             });
 
             const url = window.URL.createObjectURL(blob); 
@@ -148,13 +163,13 @@ const WorkerList = () => {
 
     const handleAvailabilityFileChange = (e) => {
         const selectedFile = e.target.files[0];
-        if (selectedFile && selectedFile.name.endsWith(".xlsx")) {
+        if (selectedFile && /\.(xlsx|csv|ics)$/i.test(selectedFile.name)) {
             setAvailabilityFile(selectedFile);
             setAvailabilityUploadError(null);
             setAvailabilityUploadSuccess(null);
         } else {
             setAvailabilityFile(null);
-            setAvailabilityUploadError("Please upload a valid Excel (.xlsx) file.");
+            setAvailabilityUploadError("Please upload an Excel (.xlsx), CSV (.csv) or calendar (.ics) file.");
         }
     };
     
@@ -348,10 +363,17 @@ const WorkerList = () => {
                                 <option value={18}>6:00 PM</option>
                             </select>
                         </div>
-                    <div className="col-md-2 d-grid">
-                        <button className="btn btn-success mt-4" onClick={handleDownloadSchedule}>
+                    <div className="col-md-2 d-grid gap-2">
+                        <button className="btn btn-success mt-4" onClick={() => handleDownloadSchedule()}>
                             Generate Schedule
                         </button>
+                        <button
+                            className="btn btn-outline-success btn-sm"
+                            title="Build a new plan for this day instead of the saved one"
+                            onClick={() => handleDownloadSchedule(true)}
+                        >
+                            Regenerate
+                        </button>
                     </div>
                 </div>
             </div>
@@ -361,7 +383,7 @@ const WorkerList = () => {
                 <input
                     type="file"
                     className="form-control mb-2"
-                    accept=".xlsx"
+                    accept=".xlsx,.csv,.ics"
                     onChange={handleAvailabilityFileChange}
                 />
                 <button className="btn btn-primary" onClick={handleUploadAvailability}>
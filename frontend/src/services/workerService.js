@@ -1,19 +1,83 @@
 import axios from "axios";
 
 const API_URL = (process.env.REACT_APP_API_URL || "").replace(/\/+$/, "");
+// Activity centre this build serves; the backend scopes every request to it
+const SITE_ID = process.env.REACT_APP_SITE_ID || "";
 
 // Axios instance for reusable configurations
 const axiosInstance = axios.create({
   baseURL: API_URL,
-  headers: { "Content-Type": "application/json" },
+  headers: {
+    "Content-Type": "application/json",
+    ...(SITE_ID ? { "X-Site-ID": SITE_ID } : {}),
+  },
 });
 
-// Fetch all workers
-export const getAllWorkers = async () => {
-  const { data } = await axiosInstance.get("/workers");
+// Fetch all workers, optionally only those with a training (e.g. "ICA")
+export const getAllWorkers = async (role) => {
+  const { data } = await axiosInstance.get("/workers", { params: role ? { role } : {} });
   return data;
 };
 
+// Changes since a change-feed cursor (0 = everything)
+export const getWorkerChanges = async (since = 0) => {
+  const { data } = await axiosInstance.get("/workers/changes", { params: { since } });
+  return data;
+};
+
+// Local copy of the worker list, kept current from the change feed
+let workerCache = null;
+let workerCursor = 0;
+
+const applyWorkerChanges = (changes) => {
+  const byId = new Map(changes.reset ? [] : (workerCache || []).map((w) => [w.id, w]));
+  changes.workers.forEach((w) => byId.set(w.id, w));
+  changes.deleted.forEach((id) => byId.delete(id));
+  workerCache = [...byId.values()].sort((a, b) => a.id - b.id);
+  workerCursor = changes.version;
+  return workerCache;
+};
+
+// Same shape as getAllWorkers, but after the first call only fetches what changed
+export const syncWorkers = async () => {
+  const changes = await getWorkerChanges(workerCache ? workerCursor : 0);
+  return { workers: applyWorkerChanges(changes) };
+};
+
+// Push updates over Server-Sent Events; returns a function that closes the stream.
+// EventSource reconnects by itself when a stream ends; if the server refuses
+// one (e.g. 503 while busy), sync by polling once and try the stream again later.
+export const subscribeWorkerChanges = (onWorkers, retryMs = 30000) => {
+  let source = null;
+  let retryTimer = null;
+  let closed = false;
+
+  const open = () => {
+    source = new EventSource(`${API_URL}/workers/changes/stream?since=${workerCache ? workerCursor : 0}${SITE_ID ? `&site=${encodeURIComponent(SITE_ID)}` : ""}`);
+    source.addEventListener("changes", (event) => {
+      onWorkers(applyWorkerChanges(JSON.parse(event.data)));
+    });
+    source.onerror = () => {
+      if (closed || source.readyState !== EventSource.CLOSED) return;
+      retryTimer = setTimeout(async () => {
+        try {
+          onWorkers((await syncWorkers()).workers);
+        } catch (error) {
+          console.error("Error syncing workers:", error);
+        }
+        if (!closed) open();
+      }, retryMs);
+    };
+  };
+
+  open();
+  return () => {
+    closed = true;
+    clearTimeout(retryTimer);
+    source.close();
+  };
+};
+
 // Create a new worker
 export const createWorker = async (workerData) => {
   const { data } = await axiosInstance.post("/workers", workerData);
@@ -58,7 +122,8 @@ export const uploadAvailability = async (formData) => {
   return data;
 };
 
-// Generate schedule (returns a Blob)
+// Generate schedule (returns a Blob). The server keeps the day's plan, so the
+// same inputs download the same workbook; pass fresh: true to shuffle a new one.
 export const generateSchedule = async (payload) => {
   const resp = await axiosInstance.post("/generate-schedule", payload, {
     responseType: "blob",